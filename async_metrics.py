@@ -0,0 +1,96 @@
+"""
+asyncio variant of the metrics retrieval, in separate module
+so that asyncio is imported only when used.
+"""
+
+import asyncio
+import time
+
+from metrics import Metrics
+
+
+class AsyncMetrics(Metrics):
+    """
+    asyncio variant of the Metrics class. The MQTT traffic and the expiry
+    of stale values are handled by tasks, get_metrics() returns the latest values
+    and wait_for_update() allows to wait for them to change.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Connect to the MQTT broker and subcribe to the topics.
+        Accepts the same arguments as Metrics, except for background.
+        """
+        kwargs.pop("background", None)
+        super().__init__(*args, **kwargs)
+
+        self.tasks = []
+        self.updated = None
+
+    def start(self):
+        """
+        Create the tasks to receive MQTT messages and to expire stale values.
+        Has to be called from a coroutine.
+        """
+        self.updated = asyncio.Event()
+        self.tasks = [
+            asyncio.create_task(self.receive(), name="mqtt receive"),
+            asyncio.create_task(self.expire_stale(), name="metrics expiry"),
+        ]
+
+    def stop(self):
+        """
+        Cancel the tasks.
+        """
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        super().stop()
+
+    async def receive(self):
+        """
+        Process the MQTT traffic. The blocking MQTT client runs in a worker thread
+        so that the event loop stays responsive.
+        """
+        while True:
+            updates = self.updates
+            await asyncio.to_thread(self.poll)
+            if self.updates != updates:
+                self.updated.set()
+
+    async def expire_stale(self):
+        """
+        Invalidate the values as they become stale.
+        """
+        while True:
+            expiry = self.next_expiry()
+            if expiry is None:
+                delay = self.metric_timeout
+            else:
+                delay = max(expiry - time.monotonic(), 0) + 0.01
+            await asyncio.sleep(delay)
+
+            with self.lock:
+                expired = self.expire(time.monotonic())
+            if expired:
+                self.updated.set()
+
+    def get_metrics(self):
+        """
+        :return: tuple of the latest metric values, in the order of the registry
+        """
+        return self.read_metrics()
+
+    async def wait_for_update(self, timeout):
+        """
+        Wait for the values to change.
+        :param timeout: timeout in seconds
+        :return: True if the values changed, False on timeout
+        """
+        try:
+            await asyncio.wait_for(self.updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        self.updated.clear()
+        return True
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite covering the rendering, the MQTT message handling, the conversion
+of images to the display framebuffer and the whole main loop against simulated
+display and mocked MQTT client. The results can be stored as JSON and compared
+with a baseline to catch performance regressions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import PIL
+
+from benchmark_data import FONTS, get_adafruit_display, get_metrics, get_values
+from display import SimulatedDisplay, pack_image
+from history import MetricHistory
+from loop_cond import CondLimit
+from loop_profiler import CondCallback
+from metrics import message_handler
+from metrics_drawer import MetricsDrawer
+from metrics_log import MetricsLog, read_log
+from report import loop
+
+# Name to the function generating list of (temperature, CO2, pressure) tuples.
+VALUE_RANGES = {
+    "typical": get_values,
+    "extreme": lambda count: [
+        (-25.5 + i % 70, 400 + i * 997 % 20000, 950 + i % 100) for i in range(count)
+    ],
+    "missing": lambda count: [(None, None, None)] * count,
+}
+
+# Payload size name to the number of extra fields in the payload.
+PAYLOAD_SIZES = {"small": 0, "medium": 40, "large": 400}
+
+# Width and height of the display and rotation of its framebuffer.
+WIDTH = 250
+HEIGHT = 122
+ROTATION = 1
+
+# Timing of the simulated display so that the loop measures the CPU work only.
+NO_DELAY_TIMING = {"power_up": 0, "full_refresh": 0, "partial_refresh": 0}
+
+
+def measure(function, number, repeat):
+    """
+    :param function: function to call, performs the given number of operations
+    :param number: number of operations per call
+    :param repeat: number of calls
+    :return: dictionary with statistics of the time per operation in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) / number)
+
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "max": max(times),
+    }
+
+
+def get_draw_cases(number):
+    """
+    :param number: number of frames per measurement
+    :return: list of (name, function, number) tuples
+    """
+    cases = []
+    for font_name, (medium_font, large_font) in FONTS.items():
+        if not os.path.exists(medium_font) or not os.path.exists(large_font):
+            continue
+        for range_name, get_range in VALUE_RANGES.items():
+            drawer = MetricsDrawer(WIDTH, HEIGHT, medium_font, large_font, mode="1")
+            values = get_range(number)
+
+            def draw(drawer=drawer, values=values):
+                for frame in values:
+                    drawer.draw_image(*frame)
+
+            cases.append((f"draw_image/{font_name}/{range_name}", draw, number))
+
+        drawer = MetricsDrawer(WIDTH, HEIGHT, medium_font, large_font, mode="1")
+        values = tuple(get_values(number))
+        trends = tuple(
+            [(value - 0.5, value + 0.5) for value in series]
+            for series in zip(*get_values(60))
+        )
+        extremes = tuple((min(series), max(series), 0) for series in zip(*values))
+
+        def draw_trends(drawer=drawer, values=values, trends=trends, extremes=extremes):
+            for frame in values:
+                drawer.draw_image(*frame, trends=trends, extremes=extremes)
+
+        cases.append((f"draw_image/{font_name}/trends", draw_trends, number))
+    return cases
+
+
+def get_payload(index, extra_fields):
+    """
+    :param index: message index
+    :param extra_fields: number of fields in the payload not used by the metrics
+    :return: (topic, message) tuple
+    """
+    payload = {"co2_ppm": 400 + index % 1000, "temperature": 22.5}
+    for field in range(extra_fields):
+        payload[f"field_{field}"] = index + field
+    return "co2/topic", json.dumps(payload)
+
+
+def get_message_cases(number):
+    """
+    :param number: number of messages in the burst
+    :return: list of (name, function, number) tuples
+    """
+    cases = []
+    for size_name, extra_fields in PAYLOAD_SIZES.items():
+        metrics = get_metrics()
+        messages = [get_payload(i, extra_fields) for i in range(number)]
+
+        def burst(metrics=metrics, messages=messages):
+            for topic, message in messages:
+                message_handler(metrics.mqtt, topic, message)
+            metrics.get_values()
+
+        cases.append((f"message_handler/{size_name}", burst, number))
+    return cases
+
+
+def get_history_cases(number):
+    """
+    :param number: number of values added per measurement
+    :return: list of (name, function, number) tuples
+    """
+    history = MetricHistory()
+    values = [(i * 0.5, 400 + i * 997 % 2000) for i in range(number)]
+    offset = [0]
+
+    def add():
+        # Keep the time increasing across the measurements.
+        for timestamp, value in values:
+            history.add(offset[0] + timestamp, value)
+        offset[0] += number * 0.5
+        history.stats("hour")
+        history.stats("day")
+
+    return [("history/add", add, number)]
+
+
+def get_metrics_log_cases(number):
+    """
+    :param number: number of values written and read per measurement
+    :return: list of (name, function, number) tuples
+    """
+    # Removed when the process exits.
+    directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+    metrics_log = MetricsLog(directory.name, ["temp", "co2", "pressure"])
+    names = metrics_log.names
+    offset = [0]
+
+    def append():
+        for i in range(number):
+            metrics_log.append(offset[0] + i, names[i % 3], i)
+            metrics_log.flush(force=False)
+        metrics_log.flush()
+        offset[0] += number
+
+    def read():
+        records = read_log(directory.name, start=0, end=number)
+        assert len(records) == number
+
+    # The values to read.
+    append()
+    return [("metrics_log/append", append, number), ("metrics_log/read", read, number)]
+
+
+def get_framebuffer_cases(number):
+    """
+    :param number: number of conversions per measurement
+    :return: list of (name, function, number) tuples
+    """
+    drawer = MetricsDrawer(WIDTH, HEIGHT, *FONTS["sans"], mode="RGB")
+    rgb_image = drawer.draw_image(21.5, 800, 1013).copy()
+    images = {mode: rgb_image.convert(mode) for mode in ["1", "L", "RGB"]}
+
+    cases = []
+    for mode, image in images.items():
+
+        def pack(image=image):
+            for _ in range(number):
+                pack_image(image, HEIGHT, WIDTH, ROTATION)
+
+        cases.append((f"pack_image/{mode}", pack, number))
+
+    display = get_adafruit_display(WIDTH, HEIGHT, ROTATION)
+
+    def load(image=images["1"]):
+        for _ in range(number):
+            display.load_framebuffer(image)
+
+    cases.append(("load_framebuffer/1", load, number))
+    return cases
+
+
+def get_loop_cases(number):
+    """
+    :param number: number of loop iterations per measurement
+    :return: list of (name, function, number) tuples
+    """
+    cases = []
+    for partial in [False, True]:
+        metrics = get_metrics()
+        drawer = MetricsDrawer(WIDTH, HEIGHT, *FONTS["sans"], mode="1")
+        e_display = SimulatedDisplay(
+            WIDTH,
+            HEIGHT,
+            full_refresh_interval=10 if partial else 0,
+            timing=NO_DELAY_TIMING,
+            record=False,
+        )
+
+        def inject(iteration, metrics=metrics):
+            """
+            Deliver new message between the iterations.
+            """
+            message_handler(metrics.mqtt, *get_payload(iteration, 0))
+
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        def run_loop(
+            metrics=metrics,
+            drawer=drawer,
+            e_display=e_display,
+            inject=inject,
+            partial=partial,
+        ):
+            cond = CondCallback(CondLimit(number), inject)
+            loop(cond, 0, drawer, e_display, metrics, partial=partial)
+
+        name = "loop/partial" if partial else "loop/full"
+        cases.append((name, run_loop, number))
+    return cases
+
+
+def get_cases(scale=1):
+    """
+    :param scale: multiplier of the number of operations per measurement
+    :return: list of (name, function, number) tuples
+    """
+    cases = get_draw_cases(max(int(100 * scale), 1))
+    cases += get_message_cases(max(int(1000 * scale), 1))
+    cases += get_history_cases(max(int(1000 * scale), 1))
+    cases += get_metrics_log_cases(max(int(1000 * scale), 1))
+    cases += get_framebuffer_cases(max(int(100 * scale), 1))
+    cases += get_loop_cases(max(int(20 * scale), 1))
+    return cases
+
+
+def run(cases, repeat, name_filter=None):
+    """
+    :param cases: list of (name, function, number) tuples
+    :param repeat: number of measurements of each case
+    :param name_filter: substring the case names have to contain, or None
+    :return: dictionary with the environment description and the results
+    """
+    results = {}
+    for name, function, number in cases:
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(function, number, repeat)
+        print(f"{name:>32}: {results[name]['median'] * 1e6:10.1f} us/op", flush=True)
+
+    return {
+        "environment": {
+            "python": sys.version.split()[0],
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: dictionary produced by run()
+    :param baseline: dictionary produced by run() to compare with
+    :param tolerance: allowed relative slowdown of the median
+    :return: list of (name, baseline median, median) tuples of the regressed cases
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        if result["median"] > previous["median"] * (1 + tolerance):
+            regressions.append((name, previous["median"], result["median"]))
+    return regressions
+
+
+def main():
+    """
+    Run the benchmarks, store the results and compare them with the baseline.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", help="JSON file to store the results to")
+    parser.add_argument("--baseline", help="JSON file with the results to compare to")
+    parser.add_argument(
+        "--tolerance",
+        help="allowed relative slowdown compared to the baseline",
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument("--repeat", help="number of measurements", type=int, default=5)
+    parser.add_argument(
+        "--scale",
+        help="multiplier of the number of operations per measurement",
+        type=float,
+        default=1,
+    )
+    parser.add_argument("--filter", help="run only the cases containing this string")
+    args = parser.parse_args()
+
+    results = run(get_cases(args.scale), args.repeat, args.filter)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, previous, current in regressions:
+            print(
+                f"Regression in {name}: {previous * 1e6:.1f} -> {current * 1e6:.1f} us/op"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
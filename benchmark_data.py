@@ -0,0 +1,77 @@
+"""
+Values, fonts and mocked objects shared by the benchmarks.
+"""
+
+import random
+
+from display import AdafruitDisplay
+from metric_registry import get_default_registry
+from metrics import Metrics
+
+FONT_DIR = "/usr/share/fonts/truetype/dejavu"
+# Name to (medium font path, large font path).
+FONTS = {
+    "sans": (f"{FONT_DIR}/DejaVuSans.ttf", f"{FONT_DIR}/DejaVuSans-Bold.ttf"),
+    "serif": (f"{FONT_DIR}/DejaVuSerif.ttf", f"{FONT_DIR}/DejaVuSerif-Bold.ttf"),
+    "mono": (f"{FONT_DIR}/DejaVuSansMono.ttf", f"{FONT_DIR}/DejaVuSansMono-Bold.ttf"),
+}
+
+# (topic, payload field) of the default metrics in the benchmark messages.
+TEMPERATURE = ("temp/topic", "temperature")
+CO2 = ("co2/topic", "co2_ppm")
+PRESSURE = ("pressure/topic", "pressure_hpa")
+
+
+def get_values(count, seed=0):
+    """
+    :param count: number of frames
+    :param seed: random seed
+    :return: list of (temperature, CO2, pressure) tuples changing slowly
+    """
+    rnd = random.Random(seed)
+    temp, co2, pressure = 20.0, 800.0, 1013.0
+    values = []
+    for _ in range(count):
+        temp += rnd.uniform(-0.5, 0.5)
+        co2 += rnd.uniform(-50, 50)
+        pressure += rnd.uniform(-0.5, 0.5)
+        values.append((temp, co2, pressure))
+    return values
+
+
+def get_metrics():
+    """
+    :return: Metrics object with the default metrics and the MQTT client mocked
+    """
+    # The modules not used by the application are imported only when needed,
+    # so that the first pixel benchmark of benchmark_startup is not skewed.
+    # pylint: disable=import-outside-toplevel
+    import unittest.mock
+
+    registry = get_default_registry(*TEMPERATURE, *CO2, *PRESSURE)
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = Metrics("localhost", 1883, 1800, registry)
+    metrics.mqtt.user_data = metrics
+    return metrics
+
+
+def get_adafruit_display(width, height, rotation):
+    """
+    :param width: display width
+    :param height: display height
+    :param rotation: rotation of the framebuffer
+    :return: AdafruitDisplay object with the SPI bus and the pins of the driver mocked
+    """
+    # pylint: disable=import-outside-toplevel
+    import unittest.mock
+
+    from adafruit_epd.ssd1680 import Adafruit_SSD1680
+
+    spi, cs_pin, dc_pin = (unittest.mock.MagicMock() for _ in range(3))
+    # The SRAM, reset and busy pins are optional.
+    unused_pins = dict.fromkeys(["sramcs_pin", "rst_pin", "busy_pin"])
+    driver = Adafruit_SSD1680(
+        height, width, spi, cs_pin=cs_pin, dc_pin=dc_pin, **unused_pins
+    )
+    driver.rotation = rotation
+    return AdafruitDisplay(driver, width, height)
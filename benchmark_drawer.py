@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-frame cost of MetricsDrawer with and without
+the caching of the base layer and the text renderings.
+"""
+
+import argparse
+import time
+
+from benchmark_data import FONTS, get_values
+from metrics_drawer import MetricsDrawer
+
+
+def run(drawer, values):
+    """
+    :param drawer: MetricsDrawer object
+    :param values: list of value tuples
+    :return: elapsed time in seconds
+    """
+    start = time.perf_counter()
+    for frame in values:
+        drawer.draw_image(*frame)
+    return time.perf_counter() - start
+
+
+def main():
+    """
+    Run the benchmark and print the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--medium_font",
+        help="Path to the medium font",
+        default=FONTS["sans"][0],
+    )
+    parser.add_argument(
+        "--large_font",
+        help="Path to the large font",
+        default=FONTS["sans"][1],
+    )
+    parser.add_argument("--frames", help="number of frames", type=int, default=1000)
+    parser.add_argument("--mode", choices=["1", "L", "RGB"], default="1")
+    args = parser.parse_args()
+
+    values = get_values(args.frames)
+    for name, cache_size in [("uncached", 0), ("cached", 128)]:
+        drawer = MetricsDrawer(
+            250,
+            122,
+            args.medium_font,
+            args.large_font,
+            mode=args.mode,
+            cache_size=cache_size,
+        )
+        elapsed = run(drawer, values)
+        print(f"{name:>8}: {elapsed / len(values) * 1e6:.0f} us/frame")
+
+
+if __name__ == "__main__":
+    main()
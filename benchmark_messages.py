@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of MQTT message processing: compare decoding every message
+as it arrives with the lazy decoding of the latest payload on read.
+"""
+
+import argparse
+import json
+import time
+
+from benchmark_data import get_metrics
+from metrics import message_handler
+
+
+def eager_handler(client, topic, message):
+    """
+    Decode the message right away, like the message handler used to.
+    """
+    metrics = client.user_data
+    definitions = metrics.registry.by_topic.get(topic)
+    if not definitions:
+        return
+
+    payload_dict = json.loads(message)
+    with metrics.lock:
+        now = time.monotonic()
+        for definition in definitions:
+            metrics.values[definition.name] = payload_dict.get(definition.field)
+            metrics.timestamps[definition.name] = now
+            metrics.expiry.schedule(definition.name, now + metrics.metric_timeout)
+        metrics.updates += 1
+    metrics.update_event.set()
+
+
+def get_messages(count):
+    """
+    :param count: number of messages
+    :return: list of (topic, message) tuples, mostly from the chatty CO2 sensor
+    """
+    messages = []
+    for i in range(count):
+        if i % 10 == 0:
+            messages.append(
+                ("pressure/topic", json.dumps({"pressure_hpa": 1000 + i % 30}))
+            )
+        elif i % 10 == 1:
+            messages.append(("temp/topic", json.dumps({"temperature": 20 + i % 5})))
+        else:
+            payload = {"co2_ppm": 400 + i % 1000, "temperature": 22.5, "humidity": 40}
+            messages.append(("co2/topic", json.dumps(payload)))
+    return messages
+
+
+def run(handler, messages, rate, redraw_interval):
+    """
+    Feed the messages to the handler and read the values at the redraw rate.
+    :param handler: message handler function
+    :param messages: list of (topic, message) tuples
+    :param rate: number of messages per second
+    :param redraw_interval: simulated time between redraws in seconds
+    :return: elapsed time in seconds
+    """
+    metrics = get_metrics()
+    per_redraw = max(int(rate * redraw_interval), 1)
+
+    start = time.perf_counter()
+    for i, (topic, message) in enumerate(messages, start=1):
+        handler(metrics.mqtt, topic, message)
+        if i % per_redraw == 0:
+            metrics.get_values()
+    metrics.get_values()
+    return time.perf_counter() - start
+
+
+def main():
+    """
+    Run the benchmark and print the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", help="messages per second", type=int, default=100)
+    parser.add_argument(
+        "--duration", help="simulated duration in seconds", type=int, default=600
+    )
+    parser.add_argument(
+        "--redraw_interval",
+        help="simulated time between redraws in seconds",
+        type=float,
+        default=180,
+    )
+    parser.add_argument("--repeat", help="number of repetitions", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = get_messages(args.rate * args.duration)
+    print(
+        f"{len(messages)} messages at {args.rate} msg/s, "
+        f"redraw every {args.redraw_interval} s"
+    )
+    for name, handler in [("eager", eager_handler), ("lazy", message_handler)]:
+        elapsed = min(
+            run(handler, messages, args.rate, args.redraw_interval)
+            for _ in range(args.repeat)
+        )
+        print(
+            f"{name:>5}: {elapsed * 1000:.1f} ms total, "
+            f"{elapsed / len(messages) * 1e6:.2f} us/message"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: measures the import time of the report module with
+python -X importtime, lists the slowest imports and the time from interpreter
+start to the first rendered image. The results can be stored as JSON
+and compared with a baseline to catch startup regressions.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that should be imported only when actually used.
+LAZY_MODULES = ["board", "busio", "digitalio", "adafruit_epd", "asyncio"]
+
+# Rendering the first image, run in a fresh interpreter.
+FIRST_PIXEL_CODE = """
+import time
+import report
+from benchmark_data import FONTS, get_values
+from metrics_drawer import MetricsDrawer
+
+drawer = MetricsDrawer(
+    report.DISPLAY_WIDTH, report.DISPLAY_HEIGHT, *FONTS["sans"], mode="RGB"
+)
+drawer.draw_image(*get_values(1)[0])
+print(time.perf_counter())
+"""
+
+
+def parse_importtime(output):
+    """
+    :param output: stderr of python -X importtime
+    :return: dictionary of module names to (self, cumulative) import times
+    in seconds
+    """
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.split(":", 1)[1].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header
+            continue
+        name = fields[2].strip()
+        modules[name] = (int(fields[0]) / 1e6, int(fields[1]) / 1e6)
+    return modules
+
+
+def run_python(args):
+    """
+    :param args: arguments of the Python interpreter
+    :return: completed process
+    """
+    return subprocess.run(
+        [sys.executable] + args,
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+
+def measure_imports(module="report"):
+    """
+    :param module: module to import
+    :return: dictionary of module names to (self, cumulative) import times
+    """
+    process = run_python(["-X", "importtime", "-c", f"import {module}"])
+    return parse_importtime(process.stderr)
+
+
+def measure_first_pixel():
+    """
+    :return: time in seconds from the start of the interpreter process
+    to the first rendered image
+    """
+    start = time.perf_counter()
+    process = run_python(["-c", FIRST_PIXEL_CODE])
+    end = time.perf_counter()
+    # The child reports when it finished drawing, which excludes the teardown
+    # of the interpreter. perf_counter is system-wide on Linux.
+    finished = float(process.stdout.split()[-1])
+    return (finished if start < finished < end else end) - start
+
+
+def get_loaded_modules(module="report"):
+    """
+    :param module: module to import
+    :return: set of names of the modules loaded by the import
+    """
+    process = run_python(
+        ["-c", f"import sys, {module}; print(' '.join(sorted(sys.modules)))"]
+    )
+    return set(process.stdout.split())
+
+
+def run(repeat, top):
+    """
+    :param repeat: number of measurements
+    :param top: number of the slowest modules to report
+    :return: dictionary with the results
+    """
+    totals = []
+    first_pixel = []
+    modules = {}
+    for _ in range(repeat):
+        modules = measure_imports()
+        totals.append(modules["report"][1])
+        first_pixel.append(measure_first_pixel())
+
+    slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)
+    loaded = get_loaded_modules()
+    results = {
+        "results": {
+            "import_report": statistics.median(totals),
+            "first_pixel": statistics.median(first_pixel),
+        },
+        "slowest": {name: times[0] for name, times in slowest[:top]},
+        "lazy_modules_loaded": [name for name in LAZY_MODULES if name in loaded],
+    }
+
+    print(f"{'import report':>32}: {results['results']['import_report'] * 1e3:8.1f} ms")
+    print(f"{'first pixel':>32}: {results['results']['first_pixel'] * 1e3:8.1f} ms")
+    print("Slowest imports (self time):")
+    for name, self_time in results["slowest"].items():
+        print(f"{name:>32}: {self_time * 1e3:8.1f} ms")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: dictionary produced by run()
+    :param baseline: dictionary produced by run() to compare with
+    :param tolerance: allowed relative slowdown
+    :return: list of (name, baseline time, time) tuples of the regressions
+    """
+    regressions = []
+    for name, current in results["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is not None and current > previous * (1 + tolerance):
+            regressions.append((name, previous, current))
+    return regressions
+
+
+def main():
+    """
+    Measure the startup, store the results and compare them with the baseline.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", help="JSON file to store the results to")
+    parser.add_argument("--baseline", help="JSON file with the results to compare to")
+    parser.add_argument(
+        "--tolerance",
+        help="allowed relative slowdown compared to the baseline",
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument("--repeat", help="number of measurements", type=int, default=5)
+    parser.add_argument(
+        "--top", help="number of the slowest imports to list", type=int, default=15
+    )
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.top)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    failed = False
+    if results["lazy_modules_loaded"]:
+        print(f"Modules loaded eagerly: {results['lazy_modules_loaded']}")
+        failed = True
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, previous, current in regressions:
+            print(
+                f"Regression in {name}: {previous * 1e3:.1f} -> {current * 1e3:.1f} ms"
+            )
+        failed = failed or bool(regressions)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@ import logging
 
 from logutil import LogLevelAction
 
+# Refreshing the display more often will wash it out.
+MIN_TIMEOUT = 180
+
 
 class TimeoutAction(argparse.Action):
     """
@@ -27,11 +30,12 @@ class TimeoutAction(argparse.Action):
         """
         logger = logging.getLogger(__name__)
         logger.debug(f"{namespace}, {values}, {option_string}")
-        if values < 180:
-            raise ValueError("timeout must be bigger than 180")
+        if values < MIN_TIMEOUT:
+            raise ValueError(f"timeout must be bigger than {MIN_TIMEOUT}")
         setattr(namespace, self.dest, values)
 
 
+# pylint: disable=too-many-statements
 def parse_args(args=None):
     """
     Parse command line arguments
@@ -43,9 +47,18 @@ def parse_args(args=None):
     )
     parser.add_argument(
         "--hostname",
-        help="MQTT broker hostname",
+        help="MQTT broker hostname, optionally in the form of hostname:port. "
+        "If more brokers are specified, they are tried in parallel "
+        "and the first one to connect is used",
+        nargs="+",
         required=True,
     )
+    parser.add_argument(
+        "--metrics_config",
+        help="JSON file with the list of metric definitions (name, topic, field "
+        "and optionally label, unit, format, threshold). "
+        "Replaces the --*_sensor_* options",
+    )
     parser.add_argument(
         "-l",
         "--loglevel",
@@ -61,28 +74,183 @@ def parse_args(args=None):
         type=int,
         action=TimeoutAction,
     )
+    parser.add_argument(
+        "--redraw_on_change",
+        help="Redraw the display as soon as some of the values changes significantly "
+        "(subject to the minimum refresh interval), at least every timeout seconds",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min_refresh_interval",
+        help="Minimum time in seconds between display refreshes with --redraw_on_change",
+        default=MIN_TIMEOUT,
+        type=int,
+        action=TimeoutAction,
+    )
+    parser.add_argument(
+        "--change_thresholds",
+        help="Minimum significant change of temperature, CO2 and pressure "
+        "for --redraw_on_change (unless using --metrics_config)",
+        nargs=3,
+        metavar=("TEMP", "CO2", "PRESSURE"),
+        default=[1.0, 100.0, 2.0],
+        type=float,
+    )
     parser.add_argument(
         "--metric_timeout",
         help="Timeout in seconds to consider metrics stale",
         default=1800,
         type=int,
     )
+    parser.add_argument(
+        "--mqtt_thread",
+        help="Run the MQTT client in a background thread",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--asyncio",
+        help="Use asyncio based main loop",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats_file",
+        help="File to write the timings of the update cycle stages to "
+        "after each redraw, in the Prometheus text format "
+        "(e.g. for the node exporter textfile collector)",
+    )
+    parser.add_argument(
+        "--stats_topic",
+        help="MQTT topic to publish the summary of the timings of the update cycle "
+        "stages to after each redraw, as JSON",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Directory to write the profiling results to. With this option "
+        "the main loop is profiled for --profile_iterations iterations and "
+        "the program exits",
+    )
+    parser.add_argument(
+        "--profile_iterations",
+        help="Number of main loop iterations to profile",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--profiler",
+        help="Profiler to use: cProfile (writes report.pstats), sampling of the stacks "
+        "of all threads (writes report.collapsed for flame graph tools) or both",
+        choices=["cprofile", "sampling", "both"],
+        default="both",
+    )
+    parser.add_argument(
+        "--profile_interval",
+        help="Sampling interval of the sampling profiler in seconds",
+        default=0.01,
+        type=float,
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        help="When profiling, trace memory allocations and take snapshot after each "
+        "iteration (writes tracemalloc-<iteration>.snapshot and tracemalloc.txt)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--simulated_display",
+        help="Instead of the e-ink display, use in-memory display that takes "
+        "as long to refresh as the real one. Useful for measuring the performance "
+        "without the hardware",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--display_thread",
+        help="Refresh the display in a background thread, dropping the frames "
+        "drawn while the refresh is in progress except the latest one. "
+        "The asyncio based main loop always does this",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--partial_refresh",
+        help="Maximum number of partial display refreshes (of the regions that changed) "
+        "between full refreshes. 0 disables partial refresh",
+        default=0,
+        type=int,
+    )
     parser.add_argument(
         "-o",
         "--output",
         help="Instead of updating the display, print the image to a JPG file",
     )
+    parser.add_argument(
+        "--image_mode",
+        help="PIL image mode to render in. "
+        'Defaults to "1" (black and white) for the display and "RGB" for the output file',
+        choices=["1", "L", "RGB"],
+    )
+    parser.add_argument(
+        "--trends",
+        help="Draw sparklines of the last hour next to the metrics "
+        "and the minimum and maximum of the last day below the first metric. "
+        "The history is recorded from every message received",
+        action="store_true",
+    )
     parser.add_argument(
         "-m",
         "--medium_font",
         help="Medium font path",
         default="/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
     )
+    parser.add_argument(
+        "--qos",
+        help="QoS of the MQTT subscriptions",
+        choices=[0, 1],
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--persistent_session",
+        help="Ask the MQTT broker for a persistent session so that the QoS 1 messages "
+        "published while disconnected are delivered after reconnect. "
+        "Requires --client_id",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--client_id",
+        help="MQTT client ID",
+    )
+    parser.add_argument(
+        "--timestamp_field",
+        help="Name of the field in the MQTT payloads with the time (seconds since "
+        "the Epoch) the values were published at, to determine the age "
+        "of retained messages (unless using --metrics_config)",
+    )
+    parser.add_argument(
+        "--state_file",
+        help="File to persist the latest metric values to. On start, the values "
+        "that are not older than --metric_timeout are loaded from it so that "
+        "the display can be updated right away",
+    )
+    parser.add_argument(
+        "--metrics_log",
+        help="Directory to record the value of every message to, in compact binary "
+        "format. With --trends, the history of the values is loaded from it on start",
+    )
+    parser.add_argument(
+        "--metrics_log_segments",
+        help="Number of the metrics log segments (of 1 MiB, 65536 values) to keep",
+        default=16,
+        type=int,
+    )
+    parser.add_argument(
+        "--font_cache",
+        help="File to persist the rendered text to, so that it does not have "
+        "to be rendered from the fonts again after restart",
+    )
     parser.add_argument(
         "-p",
         "--port",
-        help="MQTT broker port",
+        help="Default MQTT broker port",
         default=1883,
+        type=int,
     )
     parser.add_argument(
         "-L",
@@ -93,32 +261,45 @@ def parse_args(args=None):
     parser.add_argument(
         "--temp_sensor_topic",
         help="Temperature sensor MQTT topic",
-        required=True,
     )
     parser.add_argument(
         "--temp_sensor_name",
         help="Temperature sensor MQTT name",
-        required=True,
     )
     parser.add_argument(
         "--co2_sensor_topic",
         help="CO2 sensor MQTT topic",
-        required=True,
     )
     parser.add_argument(
         "--co2_sensor_name",
         help="CO2 sensor MQTT name",
-        required=True,
     )
     parser.add_argument(
         "--pressure_sensor_topic",
         help="Barometric pressure sensor MQTT topic",
-        required=True,
     )
     parser.add_argument(
         "--pressure_sensor_name",
         help="Barometric pressure sensor MQTT name",
-        required=True,
     )
 
-    return parser.parse_args(args)
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.persistent_session and not parsed_args.client_id:
+        parser.error("--persistent_session requires --client_id")
+
+    if parsed_args.tracemalloc and not parsed_args.profile:
+        parser.error("--tracemalloc requires --profile")
+
+    if parsed_args.profile_iterations < 1:
+        parser.error("--profile_iterations must be positive")
+
+    if parsed_args.metrics_config is None:
+        for name in ["temp", "co2", "pressure"]:
+            for suffix in ["topic", "name"]:
+                if getattr(parsed_args, f"{name}_sensor_{suffix}") is None:
+                    parser.error(
+                        f"--{name}_sensor_{suffix} is required without --metrics_config"
+                    )
+
+    return parsed_args
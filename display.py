@@ -2,67 +2,713 @@
 display classes
 """
 
+import contextlib
+import hashlib
 import logging
+import threading
+import time
 
-try:
-    import board
-    import busio
-    import digitalio
-except NotImplementedError as exc:
-    print(f"Will only support running with -o: {exc}")
+from PIL import Image, ImageChops
 
-from adafruit_epd.ssd1680 import Adafruit_SSD1680
+from instrumentation import TIMINGS
+
+# Tables to threshold a single 8-bit channel into a mode 1 image the same way
+# the Adafruit driver does, i.e. values below 0x80 are considered dark.
+_LIGHT_TABLE = [0] * 0x80 + [0xFF] * 0x80
+_DARK_TABLE = [0xFF] * 0x80 + [0] * 0x80
+
+# To transpose the image from the display coordinates to the framebuffer
+# coordinates, indexed by the framebuffer rotation.
+_ROTATION_TRANSPOSE = {
+    1: Image.Transpose.ROTATE_270,
+    2: Image.Transpose.ROTATE_180,
+    3: Image.Transpose.ROTATE_90,
+}
+
+_INVERT_TABLE = bytes(~i & 0xFF for i in range(256))
+
+# Timing of the SSD1680 display: the SPI clock the Adafruit driver uses (Hz),
+# the time to reset and initialize the controller before the full refresh,
+# and the time the controller is busy with the full and partial refresh (seconds).
+DEFAULT_TIMING = {
+    "spi_baudrate": 1000000,
+    "power_up": 0.2,
+    "full_refresh": 2.0,
+    "partial_refresh": 0.5,
+}
+
+# SSD1680 commands used for partial refresh, not exported by the driver.
+_SSD1680_DISP_CTRL2 = 0x22
+_SSD1680_MASTER_ACTIVATE = 0x20
+_SSD1680_WRITE_BWRAM = 0x24
+_SSD1680_WRITE_REDRAM = 0x26
+_SSD1680_SET_RAMXPOS = 0x44
+_SSD1680_SET_RAMYPOS = 0x45
+_SSD1680_SET_RAMXCOUNT = 0x4E
+_SSD1680_SET_RAMYCOUNT = 0x4F
+# Display mode 2, i.e. differential update of the pixels that differ
+# between the B/W RAM (new image) and the RED RAM (previous image).
+_SSD1680_PARTIAL_UPDATE = 0xFC
+
+
+def image_digest(image):
+    """
+    :param image: PIL image
+    :return: digest of the image contents, mode and size
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.digest()
+
+
+def pack_image(image, width, height, rotation):
+    """
+    Convert the image into the black and color framebuffer contents
+    of the SSD1680 controller (horizontal, MSB first, rows padded to bytes).
+    The result matches what the Adafruit driver image() function produces
+    pixel by pixel, i.e. dark pixels are black, reddish pixels are color.
+    :param image: PIL image in mode 1, L or RGB, in display coordinates
+    :param width: framebuffer width in pixels (without rotation)
+    :param height: framebuffer height in pixels (without rotation)
+    :param rotation: framebuffer rotation (0-3)
+    :return: tuple of black and color buffer bytes, set bit means white/no color
+    """
+    if image.mode == "1":
+        white = image
+        color = None
+    elif image.mode == "L":
+        white = image.point(_LIGHT_TABLE, "1")
+        color = None
+    elif image.mode == "RGB":
+        red, green, blue = image.split()
+        red_light = red.point(_LIGHT_TABLE, "1")
+        white = ImageChops.logical_or(
+            ImageChops.logical_or(red_light, green.point(_LIGHT_TABLE, "1")),
+            blue.point(_LIGHT_TABLE, "1"),
+        )
+        color = ImageChops.logical_and(
+            ImageChops.logical_and(red_light, green.point(_DARK_TABLE, "1")),
+            blue.point(_DARK_TABLE, "1"),
+        )
+    else:
+        raise ValueError("Image must be in mode 1, L or RGB.")
+
+    transpose = _ROTATION_TRANSPOSE.get(rotation)
+    stride = width + (-width % 8)
+
+    # Paste into a buffer sized image so that the padding bits stay white.
+    black_buffer = Image.new("1", (stride, height), 1)
+    black_buffer.paste(white.transpose(transpose) if transpose else white)
+    color_buffer = Image.new("1", (stride, height), 0)
+    if color is not None:
+        color_buffer.paste(color.transpose(transpose) if transpose else color)
+
+    return black_buffer.tobytes(), color_buffer.tobytes()
+
+
+def native_window(box, width, height, rotation):
+    """
+    Convert box in display coordinates to framebuffer coordinates.
+    :param box: (left, upper, right, lower) tuple in display coordinates
+    :param width: framebuffer width in pixels (without rotation)
+    :param height: framebuffer height in pixels (without rotation)
+    :param rotation: framebuffer rotation (0-3)
+    :return: (left, upper, right, lower) tuple in framebuffer coordinates
+    """
+    left, upper, right, lower = box
+    if rotation == 1:
+        return width - lower, left, width - upper, right
+    if rotation == 2:
+        return width - right, height - lower, width - left, height - upper
+    if rotation == 3:
+        return upper, height - right, lower, height - left
+    return box
+
+
+def ram_window(box, width, height, rotation):
+    """
+    Convert box in display coordinates to the region of the display RAM,
+    which is addressed in bytes horizontally.
+    :param box: (left, upper, right, lower) tuple in display coordinates
+    :param width: framebuffer width in pixels (without rotation)
+    :param height: framebuffer height in pixels (without rotation)
+    :param rotation: framebuffer rotation (0-3)
+    :return: (first byte, last byte, upper row, lower row) tuple with the last byte
+    inclusive and the lower row exclusive, or None if the region is empty
+    """
+    left, upper, right, lower = native_window(box, width, height, rotation)
+    first_byte = max(left, 0) // 8
+    last_byte = (min(right, width) - 1) // 8
+    upper = max(upper, 0)
+    lower = min(lower, height)
+    if first_byte > last_byte or upper >= lower:
+        return None
+    return first_byte, last_byte, upper, lower
 
 
-# pylint: disable=too-few-public-methods
 class Display:
     """
     class to wrap the eInk display
     """
 
-    def __init__(self, display, width, height):
+    def __init__(self, display, width, height, full_refresh_interval=0):
         """
         initialize
+        :param full_refresh_interval: maximum number of partial refreshes
+        between full refreshes, 0 disables partial refresh
         """
         self.display = display
         self.width = width
         self.height = height
+        self.full_refresh_interval = full_refresh_interval
 
-    def update(self, image):
+        # Digest of the last image pushed to the display and the number
+        # of refreshes skipped because the image did not change.
+        self.last_digest = None
+        self.skipped_refreshes = 0
+        # Number of partial refreshes since the last full refresh.
+        self.partial_refreshes = 0
+
+    def update(self, image, windows=None):
         """
-        Display image.
-        :param display: Display object
-        :param image:
-        :return:
+        Display image, unless it is identical to the last displayed image.
+        If windows are specified, only these regions of the display are refreshed,
+        unless a full refresh is due to limit ghosting.
+        :param image: image to display
+        :param windows: list of (left, upper, right, lower) boxes that changed
+        :return: True if the display was refreshed, False otherwise
         """
+        logger = logging.getLogger(__name__)
+
+        digest = image_digest(image)
+        if digest == self.last_digest:
+            self.skipped_refreshes += 1
+            logger.info(
+                f"image unchanged, skipping display refresh "
+                f"(skipped {self.skipped_refreshes} times so far)"
+            )
+            return False
+
+        full_refresh_due = self.partial_refreshes >= self.full_refresh_interval
+        if windows and self.last_digest is not None and not full_refresh_due:
+            logger.debug(f"partial refresh of {windows}")
+            self.refresh_window(image, windows)
+            self.partial_refreshes += 1
+        else:
+            self.refresh(image)
+            self.partial_refreshes = 0
+        self.last_digest = digest
+        return True
+
+    def refresh(self, image):
+        """
+        Push image to the display. To be overridden in subclasses.
+        :param image: image to display
+        """
+
+    # pylint: disable=unused-argument
+    def refresh_window(self, image, windows):
+        """
+        Push the regions of the image to the display. To be overridden in subclasses,
+        by default the whole image is pushed.
+        :param image: image to display
+        :param windows: list of (left, upper, right, lower) boxes to refresh
+        """
+        self.refresh(image)
 
 
-# pylint: disable=too-few-public-methods
 class AdafruitDisplay(Display):
     """
     class to wrap the Adafruit eInk display
     """
 
-    def update(self, image):
+    def __init__(self, display, width, height, full_refresh_interval=0):
+        """
+        initialize
+        :param full_refresh_interval: maximum number of partial refreshes
+        between full refreshes, 0 disables partial refresh
         """
-        Display image.
+        super().__init__(
+            display, width, height, full_refresh_interval=full_refresh_interval
+        )
+        # Time spent waiting for the display to finish the refresh during the push,
+        # to tell it apart from the SPI transfers. The driver calls busy_wait()
+        # from within display() so it is intercepted.
+        self.busy_duration = 0
+        self.driver_busy_wait = display.busy_wait
+        display.busy_wait = self.busy_wait
+
+    def busy_wait(self):
+        """
+        Wait for the display to become idle, measuring the time.
+        """
+        start = time.perf_counter()
+        try:
+            self.driver_busy_wait()
+        finally:
+            self.busy_duration += time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def timed_push(self):
+        """
+        Context manager to observe the time spent with SPI transfers
+        and waiting for the display.
+        """
+        self.busy_duration = 0
+        start = time.perf_counter()
+        yield
+        TIMINGS.observe("busy", self.busy_duration)
+        TIMINGS.observe("spi", time.perf_counter() - start - self.busy_duration)
+
+    def refresh(self, image):
+        """
+        Push image to the display.
         :param image: image to display
-        :return:
         """
         logger = logging.getLogger(__name__)
 
         logger.debug("display in progress")
-        self.display.image(image)
-        self.display.display()
+        with TIMINGS.timed("framebuffer"):
+            self.load_framebuffer(image)
+        with self.timed_push():
+            self.display.display()
+            # Partial refresh compares the B/W RAM with the RED RAM,
+            # so make the latter hold the image that is displayed.
+            if self.full_refresh_interval > 0:
+                self.write_window(
+                    _SSD1680_WRITE_REDRAM, (0, 0, self.width, self.height)
+                )
         logger.debug("display done")
 
+    def refresh_window(self, image, windows):
+        """
+        Push the regions of the image to the display and perform partial refresh.
+        :param image: image to display
+        :param windows: list of (left, upper, right, lower) boxes to refresh
+        """
+        logger = logging.getLogger(__name__)
 
-def get_e_ink_display():
+        logger.debug("partial display in progress")
+        with TIMINGS.timed("framebuffer"):
+            self.load_framebuffer(image)
+        with self.timed_push():
+            for window in windows:
+                self.write_window(_SSD1680_WRITE_BWRAM, window)
+            self.display.command(
+                _SSD1680_DISP_CTRL2, bytearray([_SSD1680_PARTIAL_UPDATE])
+            )
+            self.display.command(_SSD1680_MASTER_ACTIVATE)
+            self.display.busy_wait()
+            for window in windows:
+                self.write_window(_SSD1680_WRITE_REDRAM, window)
+        logger.debug("partial display done")
+
+    # pylint: disable=protected-access
+    def write_window(self, ram_command, box):
+        """
+        Send region of the black framebuffer to the display RAM.
+        :param ram_command: RAM write command
+        :param box: (left, upper, right, lower) tuple in display coordinates
+        """
+        driver = self.display
+        window = ram_window(box, driver._width, driver._height, driver.rotation)
+        if window is None:
+            return
+        first_byte, last_byte, upper, lower = window
+
+        driver.command(_SSD1680_SET_RAMXPOS, bytearray([first_byte, last_byte]))
+        driver.command(
+            _SSD1680_SET_RAMYPOS,
+            bytearray([upper & 0xFF, upper >> 8, (lower - 1) & 0xFF, (lower - 1) >> 8]),
+        )
+        driver.command(_SSD1680_SET_RAMXCOUNT, bytearray([first_byte]))
+        driver.command(_SSD1680_SET_RAMYCOUNT, bytearray([upper & 0xFF, upper >> 8]))
+
+        buffer = driver._blackframebuf.buf
+        row_bytes = driver._blackframebuf.stride // 8
+        data = bytearray()
+        for start in range(upper * row_bytes, lower * row_bytes, row_bytes):
+            begin = start + first_byte
+            end = start + last_byte + 1
+            data += buffer[begin:end]
+        driver.command(ram_command, data)
+
+    def load_framebuffer(self, image):
+        """
+        Store the image into the framebuffers of the display driver.
+        Rather than letting the driver walk the image pixel by pixel,
+        pack it in bulk and copy it straight to the driver buffers
+        the driver sends over SPI.
+        :param image: image to display
+        """
+        driver = self.display
+        if driver.sram or driver._blackframebuf is driver._colorframebuf:
+            # The driver only accepts RGB and L images.
+            if image.mode == "1":
+                image = image.convert("L")
+            driver.image(image)
+            return
+
+        imwidth, imheight = image.size
+        if imwidth != driver.width or imheight != driver.height:
+            raise ValueError(
+                f"Image must be same dimensions as display ({driver.width}x{driver.height})."
+            )
+
+        black, color = pack_image(image, driver._width, driver._height, driver.rotation)
+        if not driver._black_inverted:
+            black = black.translate(_INVERT_TABLE)
+        if driver._color_inverted:
+            color = color.translate(_INVERT_TABLE)
+        driver._blackframebuf.buf[:] = black
+        driver._colorframebuf.buf[:] = color
+
+
+# pylint: disable=too-many-instance-attributes
+class SimulatedDisplay(Display):
     """
-    :return: Display instance
+    In-memory display for testing and benchmarking without hardware. Keeps
+    the displayed image and the contents of the SSD1680 RAM, and models the time
+    the refresh would take: the SPI transfer of the RAM contents and the time
+    the controller is busy updating the panel.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        width,
+        height,
+        full_refresh_interval=0,
+        rotation=1,
+        timing=None,
+        realtime=False,
+        record=True,
+    ):
+        """
+        initialize
+        :param width: display width in pixels
+        :param height: display height in pixels
+        :param full_refresh_interval: maximum number of partial refreshes
+        between full refreshes, 0 disables partial refresh
+        :param rotation: framebuffer rotation (0-3), width and height are swapped
+        in the RAM for odd rotations
+        :param timing: dictionary overriding the values of DEFAULT_TIMING
+        :param realtime: whether to sleep for the modeled time, so that update()
+        blocks like with the real display
+        :param record: whether to keep the list of refreshes and frames
+        """
+        super().__init__(
+            None, width, height, full_refresh_interval=full_refresh_interval
+        )
+        self.rotation = rotation
+        if rotation % 2:
+            self.ram_width, self.ram_height = height, width
+        else:
+            self.ram_width, self.ram_height = width, height
+        self.timing = {**DEFAULT_TIMING, **(timing or {})}
+        self.realtime = realtime
+        self.record = record
+
+        self.panel = None
+        ram_size = (self.ram_width + (-self.ram_width % 8)) // 8 * self.ram_height
+        # Set bit means white in the B/W RAM and no color in the RED RAM.
+        self.black_ram = bytearray(b"\xff" * ram_size)
+        self.red_ram = bytearray(ram_size)
+        # List of (kind, windows) tuples, one for each refresh.
+        self.refreshes = []
+        # List of (image, transfer time, busy time) tuples, one for each refresh.
+        self.frames = []
+        # Total modeled time in seconds.
+        self.transfer_time = 0
+        self.busy_time = 0
+
+    def refresh(self, image):
+        """
+        Store the image as the displayed image.
+        :param image: image to display
+        """
+        with TIMINGS.timed("framebuffer"):
+            black, color = pack_image(
+                image, self.ram_width, self.ram_height, self.rotation
+            )
+        self.black_ram[:] = black
+        self.red_ram[:] = color
+        transferred = len(black) + len(color)
+        # Partial refresh compares the B/W RAM with the RED RAM,
+        # so the latter has to hold the image that is displayed.
+        if self.full_refresh_interval > 0:
+            self.red_ram[:] = black
+            transferred += len(black)
+
+        self.panel = image.copy()
+        if self.record:
+            self.refreshes.append(("full", [(0, 0, self.width, self.height)]))
+        self.account(
+            image, transferred, self.timing["power_up"] + self.timing["full_refresh"]
+        )
+
+    def refresh_window(self, image, windows):
+        """
+        Copy the regions of the image to the displayed image.
+        :param image: image to display
+        :param windows: list of (left, upper, right, lower) boxes to refresh
+        """
+        with TIMINGS.timed("framebuffer"):
+            black, _ = pack_image(image, self.ram_width, self.ram_height, self.rotation)
+        transferred = 0
+        for ram in [self.black_ram, self.red_ram]:
+            for window in windows:
+                transferred += self.write_window(ram, black, window)
+
+        for window in windows:
+            self.panel.paste(image.crop(window), window[:2])
+        if self.record:
+            self.refreshes.append(("partial", list(windows)))
+        self.account(image, transferred, self.timing["partial_refresh"])
+
+    def write_window(self, ram, buffer, box):
+        """
+        Copy region of the framebuffer to the RAM.
+        :param ram: bytearray with the RAM contents
+        :param buffer: framebuffer contents
+        :param box: (left, upper, right, lower) tuple in display coordinates
+        :return: number of bytes transferred
+        """
+        window = ram_window(box, self.ram_width, self.ram_height, self.rotation)
+        if window is None:
+            return 0
+        first_byte, last_byte, upper, lower = window
+
+        row_bytes = len(ram) // self.ram_height
+        for start in range(upper * row_bytes, lower * row_bytes, row_bytes):
+            begin = start + first_byte
+            end = start + last_byte + 1
+            ram[begin:end] = buffer[begin:end]
+        return (last_byte + 1 - first_byte) * (lower - upper)
+
+    def account(self, image, transferred, busy_time):
+        """
+        Record the frame and the time it would take to display it.
+        :param image: image displayed
+        :param transferred: number of bytes sent over SPI
+        :param busy_time: time in seconds the controller is busy
+        """
+        transfer_time = transferred * 8 / self.timing["spi_baudrate"]
+        if self.record:
+            self.frames.append((image.copy(), transfer_time, busy_time))
+        self.transfer_time += transfer_time
+        self.busy_time += busy_time
+        TIMINGS.observe("spi", transfer_time)
+        TIMINGS.observe("busy", busy_time)
+        if self.realtime:
+            time.sleep(transfer_time + busy_time)
+
+
+# pylint: disable=too-many-instance-attributes
+class DisplayWorker:
+    """
+    Performs the display refresh in a background thread so that update() returns
+    right away. Holds only the latest frame not yet displayed: if the frames come
+    faster than the display can refresh, the intermediate ones are dropped.
+    """
+
+    def __init__(self, e_display):
+        """
+        :param e_display: Display object
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.e_display = e_display
+        # Protects the mailbox and the statistics,
+        # notified when a frame is submitted or displayed.
+        self.lock = threading.Condition()
+        # Tuple of (image, windows, submission time) or None.
+        self.pending = None
+        self.busy = False
+        self.stopping = False
+        self.error = None
+
+        self.submitted = 0
+        self.dropped = 0
+        self.displayed = 0
+        # Time in seconds the frame spent in the mailbox before its refresh started.
+        self.last_queue_age = None
+        self.max_queue_age = 0
+        # Duration of the display refresh in seconds.
+        self.last_refresh_duration = None
+        self.max_refresh_duration = 0
+        self.total_refresh_duration = 0
+
+        self.thread = threading.Thread(
+            target=self.run, name="display refresh", daemon=True
+        )
+        self.thread.start()
+
+    @property
+    def display(self):
+        """
+        :return: the underlying display driver
+        """
+        return self.e_display.display
+
+    @property
+    def width(self):
+        """
+        :return: width of the display
+        """
+        return self.e_display.width
+
+    @property
+    def height(self):
+        """
+        :return: height of the display
+        """
+        return self.e_display.height
+
+    def update(self, image, windows=None):
+        """
+        Submit image to be displayed, replacing the frame not yet displayed.
+        The windows of the replaced frame are merged so that no change is lost.
+        :param image: image to display, copied so that the caller can reuse it
+        :param windows: list of (left, upper, right, lower) boxes that changed,
+        or None for full refresh
+        :return: True
+        """
+        with self.lock:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            if self.pending is not None:
+                self.dropped += 1
+                self.logger.info(
+                    f"Display refresh in progress, dropping previous frame "
+                    f"(dropped {self.dropped} so far)"
+                )
+                previous_windows = self.pending[1]
+                if windows is not None and previous_windows is not None:
+                    windows = previous_windows + list(windows)
+                else:
+                    windows = None
+            elif windows is not None:
+                windows = list(windows)
+            self.pending = (image.copy(), windows, time.monotonic())
+            self.submitted += 1
+            self.lock.notify_all()
+        return True
+
+    def run(self):
+        """
+        Push the submitted frames to the display until stopped.
+        """
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.pending is not None or self.stopping)
+                if self.pending is None:
+                    return
+                image, windows, submitted = self.pending
+                self.pending = None
+                self.busy = True
+
+            start = time.monotonic()
+            try:
+                if windows is None:
+                    self.e_display.update(image)
+                else:
+                    self.e_display.update(image, windows)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self.logger.error(f"Display refresh failed: {e}")
+                with self.lock:
+                    self.error = e
+            end = time.monotonic()
+
+            with self.lock:
+                self.busy = False
+                self.record(start - submitted, end - start)
+                self.lock.notify_all()
+
+    def record(self, queue_age, refresh_duration):
+        """
+        Update the statistics with displayed frame. Has to be called with the lock held.
+        :param queue_age: time in seconds the frame waited for the refresh
+        :param refresh_duration: duration of the refresh in seconds
+        """
+        TIMINGS.observe("display_queue", queue_age)
+        TIMINGS.observe("display_refresh", refresh_duration)
+        self.displayed += 1
+        self.last_queue_age = queue_age
+        self.max_queue_age = max(self.max_queue_age, queue_age)
+        self.last_refresh_duration = refresh_duration
+        self.max_refresh_duration = max(self.max_refresh_duration, refresh_duration)
+        self.total_refresh_duration += refresh_duration
+        self.logger.debug(
+            f"Display refresh took {refresh_duration:.3f} seconds, "
+            f"frame waited {queue_age:.3f} seconds"
+        )
+
+    def get_stats(self):
+        """
+        :return: dictionary with the frame counts, queue age and refresh duration
+        """
+        with self.lock:
+            return {
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "displayed": self.displayed,
+                "last_queue_age": self.last_queue_age,
+                "max_queue_age": self.max_queue_age,
+                "last_refresh_duration": self.last_refresh_duration,
+                "max_refresh_duration": self.max_refresh_duration,
+                "total_refresh_duration": self.total_refresh_duration,
+            }
+
+    def flush(self, timeout=None):
+        """
+        Wait until the submitted frames are displayed.
+        :param timeout: timeout in seconds, None to wait indefinitely
+        :return: True if all frames were displayed, False on timeout
+        """
+        with self.lock:
+            return self.lock.wait_for(
+                lambda: self.pending is None and not self.busy, timeout
+            )
+
+    def stop(self, timeout=None):
+        """
+        Display the pending frame, if any, and stop the thread.
+        The exception from a refresh not yet raised by update() is raised here.
+        :param timeout: timeout in seconds, None to wait indefinitely
+        """
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+        self.thread.join(timeout)
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+
+def get_e_ink_display(full_refresh_interval=0):
+    """
+    :param full_refresh_interval: maximum number of partial refreshes
+    between full refreshes, 0 disables partial refresh
+    :return: Display instance or None if the hardware is not supported
     """
     logger = logging.getLogger(__name__)
 
+    # The hardware modules are slow to import and fail on unsupported platforms,
+    # so import them only when the display is actually needed.
+    # pylint: disable=import-outside-toplevel
+    try:
+        import board
+        import busio
+        import digitalio
+    except NotImplementedError as e:
+        logger.error(f"Unsupported hardware: {e}")
+        return None
+    from adafruit_epd.ssd1680 import Adafruit_SSD1680
+
     # Create the SPI device and pins we will need.
     spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
     ecs = digitalio.DigitalInOut(board.CE0)
@@ -88,4 +734,9 @@ def get_e_ink_display():
 
     display.rotation = 1
     logger.info("Detected Adafruit SSD1680 display")
-    return AdafruitDisplay(display, display_width, display_height)
+    return AdafruitDisplay(
+        display,
+        display_width,
+        display_height,
+        full_refresh_interval=full_refresh_interval,
+    )
@@ -0,0 +1,89 @@
+"""
+Tracking of deadlines, e.g. for expiry of stale values.
+"""
+
+import heapq
+
+
+class ExpiryHeap:
+    """
+    Min-heap of per-name deadlines. Scheduling a deadline for a name
+    supersedes its previous deadline. The superseded entries are left in the heap
+    and skipped when they get to the top, the heap is compacted once they
+    outnumber the current entries.
+    """
+
+    def __init__(self):
+        """
+        initialize
+        """
+        self.heap = []
+        # Current deadline for each name.
+        self.deadlines = {}
+
+    def __len__(self):
+        """
+        :return: number of scheduled deadlines
+        """
+        return len(self.deadlines)
+
+    def schedule(self, name, deadline):
+        """
+        Set deadline for the name, in O(log n) amortized time.
+        :param name: name
+        :param deadline: deadline (e.g. monotonic time)
+        """
+        self.deadlines[name] = deadline
+        heapq.heappush(self.heap, (deadline, name))
+        if len(self.heap) > 2 * len(self.deadlines) + 16:
+            self.compact()
+
+    def cancel(self, name):
+        """
+        Remove the deadline for the name, if any.
+        :param name: name
+        """
+        self.deadlines.pop(name, None)
+
+    def compact(self):
+        """
+        Rebuild the heap without the superseded entries.
+        """
+        self.heap = [(deadline, name) for name, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def prune(self):
+        """
+        Remove superseded entries from the top of the heap.
+        """
+        while self.heap:
+            deadline, name = self.heap[0]
+            if self.deadlines.get(name) == deadline:
+                break
+            heapq.heappop(self.heap)
+
+    def next_expiry(self):
+        """
+        :return: the earliest deadline or None
+        """
+        self.prune()
+        if not self.heap:
+            return None
+
+        return self.heap[0][0]
+
+    def pop_expired(self, now):
+        """
+        Remove and return the names with deadline before the time.
+        :param now: current time
+        :return: list of names
+        """
+        expired = []
+        self.prune()
+        while self.heap and self.heap[0][0] < now:
+            _, name = heapq.heappop(self.heap)
+            del self.deadlines[name]
+            expired.append(name)
+            self.prune()
+
+        return expired
@@ -0,0 +1,20 @@
+"""
+file utilities
+"""
+
+import os
+
+
+def write_atomically(path, content):
+    """
+    Write the content to the file so that readers (even after power loss)
+    see either the old or the new content, never a partially written file.
+    :param path: file path
+    :param content: string to write
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,355 @@
+"""
+Compact history of the metric values: the recent samples in fixed capacity
+ring buffers and their minimum, maximum and mean over sliding time windows.
+The memory use does not depend on how often the values are updated.
+"""
+
+import math
+from array import array
+from collections import deque
+
+# Window name to (duration, resolution) in seconds. Each window keeps
+# duration / resolution slots of aggregated samples.
+DEFAULT_WINDOWS = {"hour": (3600, 60), "day": (86400, 900)}
+
+# Number of the latest samples kept for each metric.
+DEFAULT_CAPACITY = 256
+
+
+def is_number(value):
+    """
+    :param value: metric value
+    :return: True if the value is a number that can be stored in the history
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    return math.isfinite(value)
+
+
+class RingBuffer:
+    """
+    Fixed capacity buffer of numbers backed by array. Appending overwrites
+    the oldest item once the buffer is full, in O(1) time.
+    """
+
+    def __init__(self, capacity, typecode="d"):
+        """
+        :param capacity: maximum number of items
+        :param typecode: array type code, e.g. "f" for single precision floats
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity must be positive: {capacity}")
+
+        self.items = array(typecode, [0]) * capacity
+        self.capacity = capacity
+        # Index of the next item to write.
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        """
+        :param index: index of the item, 0 is the oldest, -1 the newest
+        :return: the item
+        """
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("ring buffer index out of range")
+        return self.items[(self.head - self.size + index) % self.capacity]
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+    def append(self, value):
+        """
+        :param value: item to append
+        """
+        self.items[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def to_array(self):
+        """
+        :return: array with the items, oldest first
+        """
+        start = (self.head - self.size) % self.capacity
+        if start + self.size <= self.capacity:
+            end = start + self.size
+            return self.items[start:end]
+        return self.items[start:] + self.items[: self.head]
+
+    @property
+    def nbytes(self):
+        """
+        :return: size of the item storage in bytes
+        """
+        return self.capacity * self.items.itemsize
+
+
+# pylint: disable=too-many-instance-attributes
+class SlidingWindow:
+    """
+    Minimum, maximum and mean of the values over the last duration seconds.
+    The values are aggregated into slots of resolution seconds kept in a ring,
+    so the window covers the current slot and the slots before it.
+
+    The minimum and the maximum of the completed slots are tracked by monotonic
+    deques and the mean by running sums, so that both adding value
+    and the queries take O(1) amortized time.
+
+    Values older than the latest one are counted as if they came with it.
+    """
+
+    def __init__(self, duration, resolution):
+        """
+        :param duration: length of the window in seconds
+        :param resolution: length of the slot in seconds
+        """
+        if duration <= 0 or resolution <= 0:
+            raise ValueError(f"invalid window: {duration} / {resolution} seconds")
+
+        self.duration = duration
+        self.resolution = resolution
+        self.capacity = max(math.ceil(duration / resolution), 1)
+
+        self.mins = array("f", [0]) * self.capacity
+        self.maxs = array("f", [0]) * self.capacity
+        self.sums = array("d", [0]) * self.capacity
+        self.counts = array("L", [0]) * self.capacity
+
+        # Serial number (time divided by the resolution) of the current slot.
+        self.serial = None
+        # Minimum and maximum of the current slot, at full precision.
+        self.slot_min = None
+        self.slot_max = None
+        # (serial, value) of the completed slots in the window, with increasing
+        # minima and decreasing maxima respectively.
+        self.min_queue = deque()
+        self.max_queue = deque()
+        # Sum and number of the values in the window.
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, timestamp, value):
+        """
+        :param timestamp: time of the value in seconds
+        :param value: number
+        """
+        self.advance(timestamp)
+        if self.serial is None:
+            self.serial = int(timestamp // self.resolution)
+
+        index = self.serial % self.capacity
+        if self.counts[index]:
+            self.slot_min = min(self.slot_min, value)
+            self.slot_max = max(self.slot_max, value)
+        else:
+            self.slot_min = self.slot_max = value
+        self.mins[index] = self.slot_min
+        self.maxs[index] = self.slot_max
+        self.sums[index] += value
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def advance(self, timestamp):
+        """
+        Move the window so that it ends at the time, dropping the slots
+        that fell out of it.
+        :param timestamp: time in seconds
+        """
+        serial = int(timestamp // self.resolution)
+        if self.serial is None or serial <= self.serial:
+            return
+
+        if self.counts[self.serial % self.capacity]:
+            self.complete_slot()
+
+        # Clear the slots skipped and reused, at most the whole ring.
+        first = max(self.serial + 1, serial - self.capacity + 1)
+        for skipped in range(first, serial + 1):
+            index = skipped % self.capacity
+            self.sum -= self.sums[index]
+            self.count -= self.counts[index]
+            self.sums[index] = 0
+            self.counts[index] = 0
+            if index == 0:
+                # Once per revolution of the ring, so that the rounding errors
+                # of the running sum do not accumulate.
+                self.sum = math.fsum(self.sums)
+        self.serial = serial
+        self.slot_min = self.slot_max = None
+
+        oldest = serial - self.capacity + 1
+        for slot_queue in (self.min_queue, self.max_queue):
+            while slot_queue and slot_queue[0][0] < oldest:
+                slot_queue.popleft()
+
+    def complete_slot(self):
+        """
+        Add the minimum and the maximum of the current slot to the deques.
+        """
+        while self.min_queue and self.min_queue[-1][1] >= self.slot_min:
+            self.min_queue.pop()
+        self.min_queue.append((self.serial, self.slot_min))
+        while self.max_queue and self.max_queue[-1][1] <= self.slot_max:
+            self.max_queue.pop()
+        self.max_queue.append((self.serial, self.slot_max))
+
+    def min(self, now=None):
+        """
+        :param now: current time in seconds, or None for the time of the last value
+        :return: minimum of the values in the window or None if there are none
+        """
+        if now is not None:
+            self.advance(now)
+        candidates = [self.slot_min] if self.slot_min is not None else []
+        if self.min_queue:
+            candidates.append(self.min_queue[0][1])
+        return min(candidates, default=None)
+
+    def max(self, now=None):
+        """
+        :param now: current time in seconds, or None for the time of the last value
+        :return: maximum of the values in the window or None if there are none
+        """
+        if now is not None:
+            self.advance(now)
+        candidates = [self.slot_max] if self.slot_max is not None else []
+        if self.max_queue:
+            candidates.append(self.max_queue[0][1])
+        return max(candidates, default=None)
+
+    def mean(self, now=None):
+        """
+        :param now: current time in seconds, or None for the time of the last value
+        :return: mean of the values in the window or None if there are none
+        """
+        if now is not None:
+            self.advance(now)
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def series(self, now=None):
+        """
+        :param now: current time in seconds, or None for the time of the last value
+        :return: list of (start time, minimum, maximum, mean) tuples
+        of the non-empty slots in the window, oldest first. The minimum
+        and the maximum are stored in single precision.
+        """
+        if now is not None:
+            self.advance(now)
+        if self.serial is None:
+            return []
+
+        result = []
+        for serial in range(self.serial - self.capacity + 1, self.serial + 1):
+            index = serial % self.capacity
+            count = self.counts[index]
+            if count:
+                result.append(
+                    (
+                        serial * self.resolution,
+                        self.mins[index],
+                        self.maxs[index],
+                        self.sums[index] / count,
+                    )
+                )
+        return result
+
+    def ranges(self, now=None):
+        """
+        :param now: current time in seconds, or None for the time of the last value
+        :return: list of (minimum, maximum) tuples of all the slots in the window
+        (None for the slots without values), oldest first. The minimum
+        and the maximum are stored in single precision.
+        """
+        if now is not None:
+            self.advance(now)
+        if self.serial is None:
+            return [None] * self.capacity
+
+        result = []
+        for serial in range(self.serial - self.capacity + 1, self.serial + 1):
+            index = serial % self.capacity
+            if self.counts[index]:
+                result.append((self.mins[index], self.maxs[index]))
+            else:
+                result.append(None)
+        return result
+
+    @property
+    def nbytes(self):
+        """
+        :return: size of the slot storage in bytes
+        """
+        slots = (self.mins, self.maxs, self.sums, self.counts)
+        return self.capacity * sum(item.itemsize for item in slots)
+
+
+class MetricHistory:
+    """
+    History of single metric: the latest samples and their statistics
+    over sliding windows.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, windows=None):
+        """
+        :param capacity: number of the latest samples to keep
+        :param windows: dictionary of window names to (duration, resolution)
+        tuples in seconds, DEFAULT_WINDOWS if None
+        """
+        self.times = RingBuffer(capacity, "d")
+        self.values = RingBuffer(capacity, "f")
+        if windows is None:
+            windows = DEFAULT_WINDOWS
+        self.windows = {
+            name: SlidingWindow(duration, resolution)
+            for name, (duration, resolution) in windows.items()
+        }
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, timestamp, value):
+        """
+        :param timestamp: time of the value in seconds
+        :param value: number
+        """
+        if self.times and timestamp < self.times[-1]:
+            timestamp = self.times[-1]
+        self.times.append(timestamp)
+        self.values.append(value)
+        for window in self.windows.values():
+            window.add(timestamp, value)
+
+    def samples(self):
+        """
+        :return: tuple of arrays with the times and the values of the samples,
+        oldest first. The values are stored in single precision.
+        """
+        return self.times.to_array(), self.values.to_array()
+
+    def stats(self, window, now=None):
+        """
+        :param window: name of the window
+        :param now: current time in seconds, or None for the time of the last value
+        :return: tuple of the minimum, the maximum and the mean of the values
+        in the window, None if there are no values
+        """
+        sliding_window = self.windows[window]
+        if sliding_window.mean(now) is None:
+            return None
+        return sliding_window.min(), sliding_window.max(), sliding_window.mean()
+
+    @property
+    def nbytes(self):
+        """
+        :return: size of the sample and slot storage in bytes
+        """
+        windows = sum(window.nbytes for window in self.windows.values())
+        return self.times.nbytes + self.values.nbytes + windows
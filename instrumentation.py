@@ -0,0 +1,258 @@
+"""
+Timing of the stages of the update cycle (MQTT processing, rendering,
+display refresh), collected into histograms that can be exported
+as Prometheus text format file or published as JSON via MQTT.
+"""
+
+import contextlib
+import json
+import logging
+import resource
+import threading
+import time
+from bisect import bisect_left
+
+from fileutil import write_atomically
+
+# Upper bounds of the histogram buckets in seconds, spanning the message handling
+# (microseconds) up to the full refresh of the display (seconds).
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+PREFIX = "zerodisplay"
+
+
+class Histogram:
+    """
+    Histogram of values with fixed buckets, like the Prometheus histogram.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: sorted upper bounds of the buckets
+        """
+        self.buckets = tuple(buckets)
+        # The last count is for the values above the last bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        :param value: value to add to the histogram
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        :return: list of (upper bound, number of values less or equal) tuples,
+        ending with infinity
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        Estimate quantile, assuming the values are evenly distributed in the buckets.
+        :param q: quantile between 0 and 1
+        :return: the estimate or None if there are no values
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        lower = 0
+        below = 0
+        for bound, total in self.cumulative_counts():
+            if total >= rank and total > below:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - below) / (total - below)
+            lower = bound
+            below = total
+        return lower
+
+
+class Timings:
+    """
+    Histograms of the durations of named stages. Thread safe.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: sorted upper bounds of the histogram buckets in seconds
+        """
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, stage, duration):
+        """
+        :param stage: name of the stage
+        :param duration: duration in seconds
+        """
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(duration)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """
+        Context manager to observe the duration of the block.
+        :param stage: name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def reset(self):
+        """
+        Discard the observations.
+        """
+        with self.lock:
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        :return: dictionary of stage names to copies of the histograms
+        """
+        with self.lock:
+            result = {}
+            for stage, histogram in self.histograms.items():
+                copy = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.count = histogram.count
+                copy.sum = histogram.sum
+                result[stage] = copy
+            return result
+
+
+# Timings of the stages of the update cycle, filled by the timing hooks.
+TIMINGS = Timings()
+
+
+def get_process_stats():
+    """
+    :return: dictionary with the CPU time in seconds and maximum resident set size
+    in bytes of the process
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        # Linux reports the size in kilobytes.
+        "max_rss_bytes": usage.ru_maxrss * 1024,
+    }
+
+
+def format_prometheus(histograms, process_stats):
+    """
+    :param histograms: dictionary of stage names to Histogram objects
+    :param process_stats: dictionary produced by get_process_stats()
+    :return: string with the metrics in the Prometheus text format
+    """
+    name = f"{PREFIX}_stage_duration_seconds"
+    lines = [
+        f"# HELP {name} Duration of the update cycle stages.",
+        f"# TYPE {name} histogram",
+    ]
+    for stage, histogram in sorted(histograms.items()):
+        for bound, total in histogram.cumulative_counts():
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {total}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum!r}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+    lines += [
+        f"# HELP {PREFIX}_cpu_seconds_total CPU time consumed by the process.",
+        f"# TYPE {PREFIX}_cpu_seconds_total counter",
+        f"{PREFIX}_cpu_seconds_total {process_stats['cpu_seconds']!r}",
+        f"# HELP {PREFIX}_max_rss_bytes Maximum resident set size of the process.",
+        f"# TYPE {PREFIX}_max_rss_bytes gauge",
+        f"{PREFIX}_max_rss_bytes {process_stats['max_rss_bytes']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def format_summary(histograms, process_stats):
+    """
+    :param histograms: dictionary of stage names to Histogram objects
+    :param process_stats: dictionary produced by get_process_stats()
+    :return: JSON string with the count, sum and estimated median and 95th
+    percentile of each stage
+    """
+    stages = {}
+    for stage, histogram in sorted(histograms.items()):
+        stages[stage] = {
+            "count": histogram.count,
+            "sum": histogram.sum,
+            "p50": histogram.quantile(0.5),
+            "p95": histogram.quantile(0.95),
+        }
+    return json.dumps({"stages": stages, **process_stats})
+
+
+# pylint: disable=too-few-public-methods
+class StatsExporter:
+    """
+    Export the stage timings to Prometheus textfile (e.g. for the node exporter
+    textfile collector) and/or to MQTT topic.
+    """
+
+    def __init__(self, path=None, metrics=None, topic=None, timings=TIMINGS):
+        """
+        :param path: path to the file to write, or None
+        :param metrics: Metrics object to publish the summary with, or None
+        :param topic: MQTT topic to publish the summary to, or None
+        :param timings: Timings object
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.path = path
+        self.metrics = metrics
+        self.topic = topic
+        self.timings = timings
+
+    def export(self):
+        """
+        Write the file and publish the summary.
+        """
+        histograms = self.timings.snapshot()
+        process_stats = get_process_stats()
+
+        if self.path:
+            try:
+                write_atomically(
+                    self.path, format_prometheus(histograms, process_stats)
+                )
+            except OSError as e:
+                self.logger.warning(f"Cannot write stats file {self.path}: {e}")
+
+        if self.metrics is not None and self.topic:
+            self.metrics.publish(self.topic, format_summary(histograms, process_stats))
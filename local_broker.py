@@ -0,0 +1,391 @@
+"""
+Minimal MQTT 3.1.1 broker running in a thread, to be used as a local stand-in
+for a real broker in tests and benchmarks.
+
+Supports QoS 0 and 1, retained messages and persistent sessions (QoS 1 messages
+are queued for disconnected clients). Wildcard subscriptions, will messages,
+authentication and redelivery of unacknowledged messages are not supported.
+"""
+
+import logging
+import socket
+import struct
+import threading
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length):
+    """
+    :param length: remaining length of MQTT packet
+    :return: bytes with the variable length encoding of the length
+    """
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(text):
+    """
+    :param text: string or bytes
+    :return: bytes with the length prefixed UTF-8 encoding of the string
+    """
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    return struct.pack("!H", len(text)) + text
+
+
+def decode_string(data, offset):
+    """
+    :param data: packet data
+    :param offset: offset of the length prefixed string
+    :return: tuple of the decoded string and the offset after it
+    """
+    (length,) = struct.unpack_from("!H", data, offset)
+    begin = offset + 2
+    end = begin + length
+    return data[begin:end].decode("utf-8"), end
+
+
+def encode_packet(packet_type, flags, body):
+    """
+    :param packet_type: MQTT control packet type
+    :param flags: flags of the fixed header
+    :param body: variable header and payload
+    :return: the whole packet
+    """
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def encode_publish(topic, payload, qos=0, retain=False, packet_id=0):
+    """
+    :return: PUBLISH packet
+    """
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return encode_packet(PUBLISH, qos << 1 | int(retain), body + payload)
+
+
+# pylint: disable=too-few-public-methods
+class Session:
+    """
+    State of a client session that outlives the connection unless the session is clean.
+    """
+
+    def __init__(self, client_id, clean):
+        """
+        :param client_id: MQTT client ID
+        :param clean: whether the session ends with the connection
+        """
+        self.client_id = client_id
+        self.clean = clean
+        # Topic to the maximum QoS of the subscription.
+        self.subscriptions = {}
+        # Messages (topic, payload, QoS) queued while the client is disconnected.
+        self.queue = []
+        self.connection = None
+        self.packet_id = 0
+
+    def next_packet_id(self):
+        """
+        :return: packet identifier for outgoing QoS 1 message
+        """
+        self.packet_id = self.packet_id % 0xFFFF + 1
+        return self.packet_id
+
+
+# pylint: disable=too-many-instance-attributes
+class LocalBroker:
+    """
+    MQTT broker listening on the loopback interface.
+    """
+
+    def __init__(self, port=0):
+        """
+        :param port: TCP port to listen on, 0 to pick a free one
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen()
+        # Wake up periodically to check whether to stop.
+        self.server.settimeout(0.1)
+        self.port = self.server.getsockname()[1]
+
+        # Protects the sessions and the retained messages,
+        # notified when a client disconnects.
+        self.lock = threading.Condition()
+        self.sessions = {}
+        # Topic to the retained payload.
+        self.retained = {}
+        self.published = 0
+
+        self.connections = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start accepting connections.
+        """
+        self.thread = threading.Thread(target=self.accept, name="broker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop accepting connections and close the existing ones.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.server.close()
+        self.disconnect_clients()
+
+    def disconnect_clients(self):
+        """
+        Close the client connections, as if the network failed.
+        The sessions are kept (unless clean) and the clients can reconnect.
+        """
+        for connection in list(self.connections):
+            self.close(connection)
+
+    def accept(self):
+        """
+        Accept connections and serve each in a thread.
+        """
+        while not self.stop_event.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            self.connections.add(connection)
+            threading.Thread(
+                target=self.serve, args=(connection,), name="broker client", daemon=True
+            ).start()
+
+    def close(self, connection):
+        """
+        Close client connection.
+        """
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+        self.connections.discard(connection)
+
+    @staticmethod
+    def receive(connection, size):
+        """
+        :return: exactly size bytes received from the connection
+        """
+        data = b""
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data += chunk
+        return data
+
+    def receive_packet(self, connection):
+        """
+        :return: tuple of packet type, flags and the rest of the packet
+        """
+        header = self.receive(connection, 1)[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = self.receive(connection, 1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, self.receive(connection, length)
+
+    def serve(self, connection):
+        """
+        Process packets from client connection until it is closed.
+        """
+        session = None
+        try:
+            while True:
+                packet_type, flags, body = self.receive_packet(connection)
+                if packet_type == CONNECT:
+                    session = self.handle_connect(connection, body)
+                elif packet_type == PUBLISH:
+                    self.handle_publish(connection, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(connection, session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.handle_unsubscribe(connection, session, body)
+                elif packet_type == PINGREQ:
+                    connection.sendall(encode_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+        except (ConnectionError, OSError) as e:
+            self.logger.debug(f"Connection closed: {e}")
+        finally:
+            with self.lock:
+                if session is not None and session.connection is connection:
+                    session.connection = None
+                    if session.clean:
+                        del self.sessions[session.client_id]
+                    self.lock.notify_all()
+            self.close(connection)
+
+    def handle_connect(self, connection, body):
+        """
+        :return: the session of the client
+        """
+        # protocol name, level, flags, keep alive
+        _, offset = decode_string(body, 0)
+        clean = bool(body[offset + 1] & 0x02)
+        client_id, _ = decode_string(body, offset + 4)
+
+        with self.lock:
+            session = self.sessions.get(client_id)
+            session_present = session is not None and not clean
+            if not session_present:
+                session = Session(client_id, clean)
+                self.sessions[client_id] = session
+            session.clean = clean
+            session.connection = connection
+            queue = session.queue
+            session.queue = []
+            connection.sendall(encode_packet(CONNACK, 0, bytes([session_present, 0])))
+            for topic, payload, qos in queue:
+                self.send(session, topic, payload, qos)
+
+        return session
+
+    def handle_publish(self, connection, flags, body):
+        """
+        Acknowledge the message if needed and dispatch it.
+        """
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic, offset = decode_string(body, 0)
+        if qos:
+            (packet_id,) = struct.unpack_from("!H", body, offset)
+            connection.sendall(encode_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+            offset += 2
+        self.publish(topic, body[offset:], qos=qos, retain=retain)
+
+    def handle_subscribe(self, connection, session, body):
+        """
+        Acknowledge the subscription and send the retained messages.
+        """
+        packet_id = body[:2]
+        granted = []
+        topics = []
+        offset = 2
+        while offset < len(body):
+            topic, offset = decode_string(body, offset)
+            qos = min(body[offset], 1)
+            offset += 1
+            topics.append((topic, qos))
+            granted.append(qos)
+
+        with self.lock:
+            session.subscriptions.update(topics)
+            connection.sendall(encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+            for topic, qos in topics:
+                if topic in self.retained:
+                    self.send(session, topic, self.retained[topic], qos, retain=True)
+
+    def handle_unsubscribe(self, connection, session, body):
+        """
+        Remove the subscriptions.
+        """
+        offset = 2
+        with self.lock:
+            while offset < len(body):
+                topic, offset = decode_string(body, offset)
+                session.subscriptions.pop(topic, None)
+            connection.sendall(encode_packet(UNSUBACK, 0, body[:2]))
+
+    def send(self, session, topic, payload, qos, retain=False):
+        """
+        Send message to the client of the session, or queue it if the client
+        is disconnected. Has to be called with the lock held.
+        """
+        if session.connection is None:
+            if qos:
+                session.queue.append((topic, payload, qos))
+            return
+
+        packet_id = session.next_packet_id() if qos else 0
+        try:
+            session.connection.sendall(
+                encode_publish(topic, payload, qos, retain, packet_id)
+            )
+        except OSError as e:
+            self.logger.debug(f"Cannot send to {session.client_id}: {e}")
+
+    def wait_disconnected(self, client_id, timeout=5):
+        """
+        Wait for the client to disconnect.
+        :param client_id: MQTT client ID
+        :param timeout: timeout in seconds
+        :return: True if the client is disconnected, False on timeout
+        """
+
+        def disconnected():
+            session = self.sessions.get(client_id)
+            return session is None or session.connection is None
+
+        with self.lock:
+            return self.lock.wait_for(disconnected, timeout)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """
+        Dispatch message to the subscribers, as if it was published by a client.
+        :param topic: topic
+        :param payload: message payload (string or bytes)
+        :param qos: QoS of the message
+        :param retain: whether the broker should retain the message
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        with self.lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            for session in self.sessions.values():
+                if topic in session.subscriptions:
+                    self.send(
+                        session, topic, payload, min(qos, session.subscriptions[topic])
+                    )
@@ -0,0 +1,228 @@
+"""
+Profiling of the main loop for a bounded number of iterations: deterministic
+profiling with cProfile, statistical profiling by sampling the stacks of all threads
+and tracing of the memory allocations between the iterations.
+"""
+
+import cProfile
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+from loop_cond import FormalCondInterface
+
+
+def collapse_stack(frame):
+    """
+    :param frame: the innermost frame of the stack
+    :return: string with the frames from the outermost separated with semicolons,
+    as in the collapsed stack format used by flame graph tools
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class SamplingProfiler:
+    """
+    Periodically record the stacks of all threads (except its own)
+    in a background thread.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        :param interval: sampling interval in seconds
+        """
+        self.interval = interval
+        # Collapsed stack prefixed with the thread name to the number of samples.
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """
+        Sample until stopped.
+        """
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            self.sample(own_id)
+
+    def sample(self, own_id=None):
+        """
+        Record the current stacks.
+        :param own_id: identifier of the thread to skip
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        # pylint: disable=protected-access
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            name = names.get(thread_id, str(thread_id))
+            self.stacks[f"{name};{collapse_stack(frame)}"] += 1
+        self.samples += 1
+
+    def write_collapsed(self, path):
+        """
+        Write the stacks in the collapsed format, one stack with the number
+        of its samples per line, e.g. for flamegraph.pl or speedscope.
+        :param path: file path
+        """
+        with open(path, "w", encoding="utf-8") as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write(f"{stack} {count}\n")
+
+
+# pylint: disable=too-few-public-methods
+class CondCallback(FormalCondInterface):
+    """
+    Wraps condition to call a function between the iterations.
+    """
+
+    def __init__(self, cond, callback):
+        """
+        :param cond: object implementing FormalCondInterface
+        :param callback: function called with the number of the completed iteration
+        """
+        self.wrapped = cond
+        self.callback = callback
+        self.iterations = 0
+
+    def cond(self):
+        """
+        :return: whether to continue
+        """
+        if self.iterations > 0:
+            self.callback(self.iterations)
+        self.iterations += 1
+        return self.wrapped.cond()
+
+
+# pylint: disable=too-many-instance-attributes
+class Profiler:
+    """
+    Run function under the selected profilers and write the results to directory.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        directory,
+        deterministic=True,
+        sampling=True,
+        interval=0.01,
+        memory=False,
+        memory_frames=10,
+    ):
+        """
+        :param directory: directory to write the results to
+        :param deterministic: whether to profile with cProfile,
+        writes the report.pstats file
+        :param sampling: whether to sample the stacks of all threads,
+        writes the report.collapsed file
+        :param interval: sampling interval in seconds
+        :param memory: whether to trace the memory allocations and take snapshot
+        after each iteration, writes the tracemalloc-<iteration>.snapshot files
+        and the tracemalloc.txt file with the allocations that grew the most
+        since the first iteration
+        :param memory_frames: number of frames to store for each allocation
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.directory = directory
+        self.deterministic = deterministic
+        self.sampling = sampling
+        self.interval = interval
+        self.memory = memory
+        self.memory_frames = memory_frames
+        self.first_snapshot = None
+        self.memory_report = []
+
+    def wrap_cond(self, cond):
+        """
+        :param cond: object implementing FormalCondInterface
+        :return: condition to use for the profiled loop, taking the memory
+        snapshots between the iterations
+        """
+        if not self.memory:
+            return cond
+        return CondCallback(cond, self.take_snapshot)
+
+    def take_snapshot(self, iteration):
+        """
+        Take memory snapshot and compare it with the first one.
+        :param iteration: number of the completed iteration
+        """
+        if not tracemalloc.is_tracing():
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(os.path.join(self.directory, f"tracemalloc-{iteration}.snapshot"))
+        current, peak = tracemalloc.get_traced_memory()
+        self.memory_report.append(
+            f"iteration {iteration}: {current} bytes traced, peak {peak} bytes"
+        )
+        self.logger.info(self.memory_report[-1])
+        if self.first_snapshot is None:
+            self.first_snapshot = snapshot
+            return
+
+        for stat in snapshot.compare_to(self.first_snapshot, "lineno")[:10]:
+            self.memory_report.append(f"    {stat}")
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call the function under the profilers and write the results.
+        :return: the function return value
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        sampler = SamplingProfiler(self.interval) if self.sampling else None
+        profile = cProfile.Profile() if self.deterministic else None
+        if self.memory:
+            tracemalloc.start(self.memory_frames)
+        if sampler is not None:
+            sampler.start()
+        try:
+            if profile is not None:
+                return profile.runcall(function, *args, **kwargs)
+            return function(*args, **kwargs)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                path = os.path.join(self.directory, "report.collapsed")
+                sampler.write_collapsed(path)
+                self.logger.info(f"Wrote {sampler.samples} samples to {path}")
+            if profile is not None:
+                path = os.path.join(self.directory, "report.pstats")
+                profile.dump_stats(path)
+                self.logger.info(f"Wrote profile to {path}")
+            if self.memory:
+                tracemalloc.stop()
+                path = os.path.join(self.directory, "tracemalloc.txt")
+                with open(path, "w", encoding="utf-8") as report_file:
+                    report_file.write("\n".join(self.memory_report) + "\n")
+                self.logger.info(f"Wrote memory report to {path}")
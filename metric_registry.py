@@ -0,0 +1,186 @@
+"""
+Metric definitions and their registry
+"""
+
+import json
+
+
+def truncate(value):
+    """
+    Default metric value formatter.
+    :param value: metric value (number or string)
+    :return: value truncated to integer, as string
+    """
+    return str(int(float(value)))
+
+
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+class MetricDefinition:
+    """
+    Describes a metric: where it comes from and how it should be displayed.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        name,
+        topic,
+        field,
+        label="",
+        unit="",
+        formatter=truncate,
+        threshold=1,
+        timestamp_field=None,
+    ):
+        """
+        :param name: unique name of the metric
+        :param topic: MQTT topic with JSON payload carrying the metric
+        :param field: name of the field in the JSON payload
+        :param label: text displayed before the value
+        :param unit: text displayed after the value
+        :param formatter: function to convert the value to string
+        :param threshold: minimum significant change of the value
+        :param timestamp_field: name of the field in the JSON payload with the time
+        (seconds since the Epoch) the value was published at, to determine
+        the age of retained messages
+        """
+        self.name = name
+        self.topic = topic
+        self.field = field
+        self.label = label
+        self.unit = unit
+        self.formatter = formatter
+        self.threshold = threshold
+        self.timestamp_field = timestamp_field
+
+    def __repr__(self):
+        return f"MetricDefinition({self.name!r}, {self.topic!r}, {self.field!r})"
+
+    def format(self, value):
+        """
+        :param value: metric value or None
+        :return: text to display
+        """
+        if value is None:
+            return f"{self.label}N/A"
+
+        return f"{self.label}{self.formatter(value)}{self.unit}"
+
+
+class MetricRegistry:
+    """
+    Ordered collection of metric definitions, indexed by name and by topic.
+    """
+
+    def __init__(self, definitions=()):
+        """
+        :param definitions: iterable of MetricDefinition objects
+        """
+        self.definitions = []
+        self.by_name = {}
+        # Topic to the list of definitions of the metrics carried by the topic.
+        self.by_topic = {}
+
+        for definition in definitions:
+            self.add(definition)
+
+    def __iter__(self):
+        return iter(self.definitions)
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def add(self, definition):
+        """
+        Add metric definition.
+        :param definition: MetricDefinition object
+        """
+        if definition.name in self.by_name:
+            raise ValueError(f"duplicate metric name: {definition.name}")
+
+        self.definitions.append(definition)
+        self.by_name[definition.name] = definition
+        self.by_topic.setdefault(definition.topic, []).append(definition)
+
+    @property
+    def topics(self):
+        """
+        :return: list of unique topics, in the order of the definitions
+        """
+        return list(self.by_topic)
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def get_default_registry(
+    temp_topic,
+    temp_name,
+    co2_topic,
+    co2_name,
+    pressure_topic,
+    pressure_name,
+    thresholds=(1, 100, 2),
+    timestamp_field=None,
+):
+    """
+    :return: MetricRegistry with outside temperature, CO2 and barometric pressure
+    """
+    temp_threshold, co2_threshold, pressure_threshold = thresholds
+    return MetricRegistry(
+        [
+            MetricDefinition(
+                "temp",
+                temp_topic,
+                temp_name,
+                unit="°C",
+                threshold=temp_threshold,
+                timestamp_field=timestamp_field,
+            ),
+            MetricDefinition(
+                "co2",
+                co2_topic,
+                co2_name,
+                label="CO₂ : ",
+                unit=" ppm",
+                threshold=co2_threshold,
+                timestamp_field=timestamp_field,
+            ),
+            MetricDefinition(
+                "pressure",
+                pressure_topic,
+                pressure_name,
+                label="Pressure: ",
+                unit=" hPa",
+                threshold=pressure_threshold,
+                timestamp_field=timestamp_field,
+            ),
+        ]
+    )
+
+
+def load_registry(path):
+    """
+    Load metric definitions from JSON file. The file should contain a list of objects
+    with the "name", "topic" and "field" keys and optionally "label", "unit",
+    "format" (Python format string applied to the value converted to float, e.g. "{:.1f}"),
+    "threshold" and "timestamp_field".
+    :param path: path to the JSON file
+    :return: MetricRegistry object
+    """
+    with open(path, encoding="utf-8") as config_file:
+        config = json.load(config_file)
+
+    registry = MetricRegistry()
+    for item in config:
+        kwargs = {}
+        for key in ["label", "unit", "threshold", "timestamp_field"]:
+            if key in item:
+                kwargs[key] = item[key]
+        if "format" in item:
+            kwargs["formatter"] = lambda value, spec=item["format"]: spec.format(
+                float(value)
+            )
+        registry.add(
+            MetricDefinition(item["name"], item["topic"], item["field"], **kwargs)
+        )
+
+    return registry
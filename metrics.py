@@ -2,43 +2,157 @@
 Metrics class abstracts acquiring metrics (to a degree)
 """
 
+import functools
 import json
 import logging
+import queue
+import random
 import socket
-import ssl
+import threading
 import time
 
 import adafruit_minimqtt.adafruit_minimqtt as MQTT
 from adafruit_minimqtt.adafruit_minimqtt import MMQTTException
 
+from expiry import ExpiryHeap
+from fileutil import write_atomically
+from history import DEFAULT_WINDOWS, MetricHistory, is_number
+from instrumentation import TIMINGS
+from metrics_log import iter_log
+
+# Port of MQTT over TLS.
+TLS_PORT = 8883
+
+
+# pylint: disable=too-few-public-methods
+class ClosingMixin:
+    """
+    Makes the socket raise ConnectionError once the peer closed the connection.
+    The MQTT client treats receiving no data as if there was nothing to receive yet
+    and keeps calling recv_into() until its receive timeout elapses,
+    spinning the CPU for 10 seconds before the connection loss is detected.
+    """
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        """
+        :param buffer: writable buffer to receive the data into
+        :param nbytes: maximum number of bytes to receive, 0 for the buffer size
+        :param flags: socket flags
+        :return: number of bytes received, never 0 unless nothing was requested
+        """
+        received = super().recv_into(buffer, nbytes, flags)
+        if received == 0 and (nbytes or len(buffer)):
+            raise ConnectionError("connection closed by the broker")
+        return received
+
+
+class ClosingSocket(ClosingMixin, socket.socket):
+    """
+    Plain socket raising ConnectionError once the peer closed the connection.
+    """
+
+
+# pylint: disable=too-few-public-methods
+class SocketPool:
+    """
+    The socket module for the MQTT client, creating ClosingSocket objects.
+    The TLS connections get ClosingSSLSocket objects from get_ssl_context().
+    """
+
+    socket = ClosingSocket
+
+    def __getattr__(self, name):
+        return getattr(socket, name)
+
+
+SOCKET_POOL = SocketPool()
+
+
+@functools.lru_cache(maxsize=1)
+def get_ssl_context():
+    """
+    Creating the context loads the CA certificates which is slow,
+    so it is created only once and only if TLS is used.
+    :return: SSL context for TLS connections to the brokers
+    """
+    # pylint: disable=import-outside-toplevel
+    import ssl
+
+    # pylint: disable=abstract-method
+    class ClosingSSLSocket(ClosingMixin, ssl.SSLSocket):
+        """
+        TLS variant of ClosingSocket. The context wraps the socket created
+        by the pool in a new SSLSocket object, so the class has to be set
+        on the context for the TLS connections to detect the close too.
+        """
+
+    context = ssl.create_default_context()
+    context.sslsocket_class = ClosingSSLSocket
+    return context
+
 
 def message_handler(client, topic, message):
     """
-    process MQTT message and store the data in the Metrics object passed
-    as a user data inside the MQTT client object.
+    process MQTT message and store the payload in the Metrics object passed
+    as a user data inside the MQTT client object. The payload is decoded
+    only once the values are read and only the latest payload for given topic
+    is kept so that bursts of messages are cheap to process.
     """
     metrics = client.user_data
     assert metrics
 
-    logger = logging.getLogger(__name__)
-    logger.debug(f"got {message} on {topic}")
+    if metrics.logger.isEnabledFor(logging.DEBUG):
+        metrics.logger.debug(f"got {message} on {topic}")
 
-    if topic not in [metrics.temp_topic, metrics.co2_topic, metrics.pressure_topic]:
+    if topic not in metrics.registry.by_topic:
         return
 
-    payload_dict = json.loads(message)
-    if topic == metrics.temp_topic:
-        metrics.temp_value = payload_dict.get(metrics.temp_name)
-        metrics.temp_ts = time.monotonic()
-    if topic == metrics.co2_topic:
-        metrics.co2_value = payload_dict.get(metrics.co2_name)
-        metrics.co2_ts = time.monotonic()
-    if topic == metrics.pressure_topic:
-        metrics.pressure_value = payload_dict.get(metrics.pressure_name)
-        metrics.pressure_ts = time.monotonic()
+    start = time.perf_counter()
+    arrival = time.monotonic()
+    with metrics.lock:
+        metrics.payloads[topic] = (message, arrival)
+        metrics.updates += 1
+    metrics.update_event.set()
+    metrics.record_payload(topic, message, arrival)
+    TIMINGS.observe("message", time.perf_counter() - start)
 
 
-# pylint: disable=too-few-public-methods
+def get_brokers(hostname, port):
+    """
+    :param hostname: broker hostname or list of hostnames, each optionally
+    with port in the form of hostname:port (or [address]:port for IPv6)
+    :param port: default port
+    :return: list of (hostname, port) tuples
+    """
+    if isinstance(hostname, str):
+        hostname = [hostname]
+
+    brokers = []
+    for address in hostname:
+        if address.startswith("["):
+            host, _, broker_port = address[1:].partition("]")
+            broker_port = broker_port.removeprefix(":")
+        elif address.count(":") == 1:
+            host, broker_port = address.split(":")
+        else:
+            host, broker_port = address, ""
+        brokers.append((host, int(broker_port) if broker_port else int(port)))
+    return brokers
+
+
+def get_backoff(attempt, base=1, maximum=60):
+    """
+    :param attempt: number of failed attempts so far
+    :param base: delay after the first failure in seconds
+    :param maximum: maximum delay in seconds
+    :return: exponentially growing delay in seconds, with random jitter
+    so that multiple clients do not reconnect all at once
+    """
+    delay = min(maximum, base * 2 ** min(attempt, 32))
+    return random.uniform(delay / 2, delay)
+
+
+# pylint: disable=too-few-public-methods,too-many-public-methods
 class Metrics:
     """
     class to retrieve metrics
@@ -50,85 +164,578 @@ class Metrics:
         hostname,
         port,
         metric_timeout,
-        temp_topic,
-        temp_name,
-        co2_topic,
-        co2_name,
-        pressure_topic,
-        pressure_name,
+        registry,
+        background=False,
+        state_file=None,
+        qos=0,
+        clean_session=True,
+        client_id=None,
+        metrics_log=None,
+        history=False,
     ):
         """
         Connect to the MQTT broker and subcribe to the topics.
+        If the connection fails, keep reconnecting in the background.
+        :param hostname: MQTT broker hostname or list of hostnames, optionally
+        in the form of hostname:port. Multiple brokers are tried in parallel
+        and the first one to connect is used.
+        :param port: default MQTT broker port
+        :param registry: MetricRegistry object with the metrics to retrieve
+        :param background: if True, run the MQTT client in a background thread
+        so that get_metrics() does not perform any network I/O
+        :param state_file: path to the file to persist the latest values to.
+        The values that are not stale yet are loaded from it on start.
+        :param qos: QoS of the subscriptions
+        :param clean_session: if False, ask the broker for a persistent session
+        so that the QoS 1 messages published while disconnected are delivered
+        after reconnect. Requires stable client_id.
+        :param client_id: MQTT client ID, random if None
+        :param metrics_log: MetricsLog object to record the value of every message
+        to, or None. The history of the values is loaded from it on start.
+        :param history: whether to keep the history of the numeric values.
+        The payloads are then decoded also on arrival so that the history
+        holds the value of every message, not only of the ones read.
         """
 
         self.logger = logging.getLogger(__name__)
 
-        self.mqtt = MQTT.MQTT(
+        # Protects the stored values and timestamps.
+        self.lock = threading.Lock()
+        # Number of processed messages, to detect updates.
+        self.updates = 0
+        self.update_event = threading.Event()
+
+        self.brokers = get_brokers(hostname, port)
+        self.client_id = client_id
+        self.qos = qos
+        self.clean_session = clean_session
+        self.mqtt = None
+        # Set while connected to a broker.
+        self.connected = threading.Event()
+        self.reconnect_thread = None
+
+        self.metric_timeout = metric_timeout
+
+        self.registry = registry
+
+        # The stored values and timestamps of their last update, indexed by name.
+        self.values = {definition.name: None for definition in registry}
+        self.timestamps = {definition.name: None for definition in registry}
+        # History of the numeric values, indexed by name. Empty if not kept.
+        self.history = {}
+        if history:
+            self.history = {definition.name: MetricHistory() for definition in registry}
+        # Deadlines of the values to become stale.
+        self.expiry = ExpiryHeap()
+        # The latest payload not decoded yet and its arrival time, indexed by topic.
+        self.payloads = {}
+        self.decoded_payloads = 0
+        # Messages (topic to payload) to be published by the MQTT client.
+        self.outgoing = {}
+
+        self.state_file = state_file
+        # Whether the values changed since they were last persisted and when
+        # they were persisted. Unchanged values are persisted periodically
+        # so that their timestamps do not go stale.
+        self.state_dirty = False
+        self.state_saved = time.monotonic()
+        if self.state_file:
+            self.load_state()
+
+        self.metrics_log = metrics_log
+        if self.metrics_log is not None and self.history:
+            self.load_history()
+
+        self.stop_event = threading.Event()
+        self.mqtt = self.connect()
+        if self.mqtt is not None:
+            self.connected.set()
+        else:
+            self.start_reconnect()
+
+        self.thread = None
+        if background:
+            self.logger.info("Starting MQTT thread")
+            self.thread = threading.Thread(target=self.run, name="mqtt", daemon=True)
+            self.thread.start()
+
+    def poll(self):
+        """
+        Process the MQTT traffic for a while and write the values buffered
+        by the metrics log if due.
+        Make sure to stay connected to the broker e.g. in case of keep alive.
+        If the connection is lost, reconnect in the background.
+        """
+        if not self.connected.wait(1):
+            return
+
+        client = self.mqtt
+        with self.lock:
+            outgoing = self.outgoing
+            self.outgoing = {}
+        try:
+            for topic, payload in outgoing.items():
+                client.publish(topic, payload)
+            with TIMINGS.timed("mqtt_loop"):
+                client.loop(1)
+        except (MMQTTException, OSError) as e:
+            self.logger.warning(f"Got MQTT exception: {e}")
+            self.connected.clear()
+            try:
+                client.disconnect()
+            except (MMQTTException, OSError):
+                pass
+            self.start_reconnect()
+        # The values are logged on arrival, write them even if they are not read.
+        self.save_log()
+
+    def publish(self, topic, payload):
+        """
+        Publish message from the thread processing the MQTT traffic,
+        as the MQTT client is not thread safe. Only the latest message
+        for given topic is published.
+        :param topic: MQTT topic
+        :param payload: message payload
+        """
+        with self.lock:
+            self.outgoing[topic] = payload
+
+    def is_connected(self):
+        """
+        :return: True if connected to a broker
+        """
+        return self.connected.is_set()
+
+    def create_client(self, hostname, port):
+        """
+        :return: MQTT client object for the broker
+        """
+        is_ssl = port == TLS_PORT
+        client = MQTT.MQTT(
             broker=hostname,
             port=port,
-            socket_pool=socket,
-            ssl_context=ssl.create_default_context(),
+            client_id=self.client_id,
+            socket_pool=SOCKET_POOL,
+            is_ssl=is_ssl,
+            ssl_context=get_ssl_context() if is_ssl else None,
             user_data=self,
+            connect_retries=1,
         )
-        self.logger.info(f"Connecting to MQTT broker {hostname} on port {port}")
-        self.mqtt.connect()
+        client.on_message = message_handler
+        return client
 
-        self.metric_timeout = metric_timeout
+    def connect_client(self, client):
+        """
+        Connect to the MQTT broker and subscribe to the topics.
+        The broker sends the retained messages of the topics right away.
+        :param client: MQTT client object
+        """
+        self.logger.info(
+            f"Connecting to MQTT broker {client.broker} on port {client.port}"
+        )
+        session_present = client.connect(clean_session=self.clean_session)
+        if not self.clean_session and session_present:
+            self.logger.info(f"Resuming persistent session on {client.broker}")
 
-        self.temp_topic = temp_topic
-        self.temp_name = temp_name
-        self.co2_topic = co2_topic
-        self.co2_name = co2_name
-        self.pressure_topic = pressure_topic
-        self.pressure_name = pressure_name
-
-        # The stored values and timestamps of their last update.
-        self.temp_value = None
-        self.temp_ts = None
-        self.co2_value = None
-        self.co2_ts = None
-        self.pressure_value = None
-        self.pressure_ts = None
-
-        self.mqtt.on_message = message_handler
-        topics = [(temp_topic, 0), (co2_topic, 0), (pressure_topic, 0)]
+        topics = [(topic, self.qos) for topic in self.registry.topics]
         self.logger.info(f"subscribing to {topics}")
-        self.mqtt.subscribe(topics)
+        client.subscribe(topics)
+
+    def connect(self):
+        """
+        Try to connect to all the brokers in parallel. The first one to connect
+        wins, the connections that succeed later are closed.
+        :return: connected MQTT client object or None if all the attempts failed
+        """
+        results = queue.Queue()
+        lock = threading.Lock()
+        winner = []
+
+        def attempt(client):
+            try:
+                self.connect_client(client)
+            except (MMQTTException, OSError) as e:
+                self.logger.warning(f"Cannot connect to {client.broker}: {e}")
+                results.put(None)
+                return
+            with lock:
+                lost = bool(winner)
+                winner.append(client)
+            if lost:
+                self.logger.debug(f"Disconnecting from {client.broker}")
+                client.disconnect()
+                client = None
+            results.put(client)
+
+        clients = [self.create_client(host, port) for host, port in self.brokers]
+        for client in clients:
+            threading.Thread(
+                target=attempt, args=(client,), name="mqtt connect", daemon=True
+            ).start()
+
+        for _ in clients:
+            client = results.get()
+            if client is not None:
+                self.logger.info(f"Connected to {client.broker}")
+                return client
+
+        return None
+
+    def start_reconnect(self):
+        """
+        Start reconnecting in the background, unless already reconnecting.
+        """
+        if self.reconnect_thread is not None and self.reconnect_thread.is_alive():
+            return
+
+        self.reconnect_thread = threading.Thread(
+            target=self.reconnect, name="mqtt reconnect", daemon=True
+        )
+        self.reconnect_thread.start()
+
+    def reconnect(self):
+        """
+        Keep trying to connect to the brokers with exponential backoff.
+        """
+        attempt = 0
+        while not self.stop_event.is_set():
+            delay = get_backoff(attempt)
+            self.logger.info(f"Reconnecting in {delay:.1f} seconds")
+            if self.stop_event.wait(delay):
+                return
+
+            client = self.connect()
+            if client is not None:
+                self.mqtt = client
+                self.connected.set()
+                return
+            attempt += 1
+
+    def run(self):
+        """
+        Body of the MQTT thread. Process the MQTT traffic until stopped.
+        """
+        while not self.stop_event.is_set():
+            self.poll()
+            with self.lock:
+                expired = self.expire(time.monotonic())
+            if expired:
+                self.update_event.set()
+
+    def stop(self):
+        """
+        Stop the MQTT thread, if running, and write the buffered values
+        to the metrics log.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.metrics_log is not None:
+            self.metrics_log.close()
+
+    def sleep(self, timeout):
+        """
+        Sleep for up to timeout seconds while processing the MQTT traffic,
+        return early once the metrics are updated.
+        :param timeout: timeout in seconds
+        :return: True if the metrics were updated, False on timeout
+        """
+        if self.thread is not None:
+            updated = self.update_event.wait(timeout)
+            self.update_event.clear()
+            return updated
+
+        updates = self.updates
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.poll()
+            if self.updates != updates:
+                return True
+
+        return False
 
     def get_metrics(self):
         """
         Retrieve metrics from MQTT return them as a tuple.
-        Should be called periodically w.r.t. MQTT timeout.
+        Should be called periodically w.r.t. MQTT timeout, unless running
+        the MQTT thread in which case the latest values are returned right away.
         If a metric cannot be retrieved, None is used instead.
-        :return: tuple of temperature, CO2, atmospheric pressure
+        :return: tuple of metric values, in the order of the registry
+        """
+
+        if self.thread is None:
+            self.poll()
+
+        return self.read_metrics()
+
+    def read_metrics(self):
         """
+        Read the latest values and persist them.
+        :return: tuple of metric values, in the order of the registry
+        """
+        with self.lock:
+            values = self.get_values()
+        self.save_state()
+        self.save_log()
+
+        return values
+
+    def next_expiry(self):
+        """
+        :return: monotonic time when the next value becomes stale or None
+        """
+        with self.lock:
+            self.decode_payloads()
+            return self.expiry.next_expiry()
+
+    def decode_payloads(self):
+        """
+        Decode the pending payloads and store the values of the metrics carried
+        by them. Has to be called with the lock held.
+        """
+        if not self.payloads:
+            return
+
+        start = time.perf_counter()
+        wall_offset = time.time() - time.monotonic()
+        for topic, (message, timestamp) in self.payloads.items():
+            self.decoded_payloads += 1
+            try:
+                payload_dict = json.loads(message)
+            except ValueError as e:
+                self.logger.warning(f"Cannot decode payload on {topic}: {e}")
+                continue
+            if not isinstance(payload_dict, dict):
+                self.logger.warning(f"Unexpected payload on {topic}: {message}")
+                continue
+
+            for definition in self.registry.by_topic[topic]:
+                value = payload_dict.get(definition.field)
+                if value != self.values[definition.name]:
+                    self.state_dirty = True
+                self.values[definition.name] = value
+                value_timestamp = self.get_value_timestamp(
+                    definition, payload_dict, timestamp, wall_offset
+                )
+                self.timestamps[definition.name] = value_timestamp
+                self.expiry.schedule(
+                    definition.name, value_timestamp + self.metric_timeout
+                )
+
+        self.payloads.clear()
+        TIMINGS.observe("decode", time.perf_counter() - start)
+
+    def record_payload(self, topic, message, timestamp):
+        """
+        Add the numeric values carried by the message to the history
+        and to the metrics log right away, as the payloads waiting to be decoded
+        are replaced by the newer ones. Does nothing unless the history is kept
+        or the values logged.
+        :param topic: MQTT topic
+        :param message: payload
+        :param timestamp: monotonic time of the message arrival
+        """
+        if not self.history and self.metrics_log is None:
+            return
 
-        # Make sure to stay connected to the broker e.g. in case of keep alive.
         try:
-            self.mqtt.loop(1)
-        except MMQTTException as e:
-            self.logger.warning(f"Got MQTT exception: {e}")
-            self.mqtt.reconnect()
+            payload_dict = json.loads(message)
+        except ValueError:
+            # Reported once the payload is decoded for the display.
+            return
+        if not isinstance(payload_dict, dict):
+            return
+
+        wall_offset = time.time() - time.monotonic()
+        with self.lock:
+            for definition in self.registry.by_topic[topic]:
+                value = payload_dict.get(definition.field)
+                if not is_number(value):
+                    continue
+                value_timestamp = self.get_value_timestamp(
+                    definition, payload_dict, timestamp, wall_offset
+                )
+                if self.history:
+                    self.history[definition.name].add(value_timestamp, value)
+                if self.metrics_log is not None:
+                    self.metrics_log.append(
+                        value_timestamp + wall_offset, definition.name, value
+                    )
+
+    def expire(self, now):
+        """
+        If some of the metrics has not been updated for certain time,
+        consider it not available to avoid presenting stale values.
+        Has to be called with the lock held.
+        :param now: monotonic time
+        :return: list of names of the expired metrics
+        """
+        expired = self.expiry.pop_expired(now)
+        for name in expired:
+            self.logger.warning(f"{name} updated before time threshold")
+            self.values[name] = None
+
+        return expired
+
+    def get_value_timestamp(self, definition, payload_dict, timestamp, wall_offset):
+        """
+        Messages (retained ones in particular) can be older than their arrival.
+        If the metric has timestamp field, use it to determine the age of the value.
+        :param definition: MetricDefinition object
+        :param payload_dict: decoded payload
+        :param timestamp: monotonic time of the message arrival
+        :param wall_offset: difference between wall clock and monotonic time
+        :return: monotonic time of the value
+        """
+        if not definition.timestamp_field:
+            return timestamp
+
+        published = payload_dict.get(definition.timestamp_field)
+        if not isinstance(published, (int, float)):
+            self.logger.warning(
+                f"Missing or invalid {definition.timestamp_field} for {definition.name}"
+            )
+            return timestamp
+
+        age = timestamp + wall_offset - published
+        self.logger.debug(f"{definition.name} is {age:.0f} seconds old")
+        return min(timestamp, published - wall_offset)
+
+    def load_state(self):
+        """
+        Load the values persisted by save_state(), unless they are stale.
+        The wall clock timestamps of the values are converted to monotonic time.
+        """
+        try:
+            with open(self.state_file, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Cannot load state from {self.state_file}: {e}")
+            return
 
-        #
-        # If some of the metrics has not been updated for certain time,
-        # consider it not available to avoid presenting stale values.
-        #
         now = time.monotonic()
-        if now > self.metric_timeout:
-            time_threshold = now - self.metric_timeout
-            if self.temp_ts is not None and self.temp_ts < time_threshold:
-                self.logger.warning("temp updated before time threshold")
-                self.temp_value = None
-            if self.co2_ts is not None and self.co2_ts < time_threshold:
-                self.logger.warning("co2 updated before time threshold")
-                self.co2_value = None
-            if self.pressure_ts is not None and self.pressure_ts < time_threshold:
-                self.logger.warning("pressure updated before time threshold")
-                self.pressure_value = None
-
-        self.logger.debug(f"temp = {self.temp_value}")
-        self.logger.debug(f"co2 = {self.co2_value}")
-        self.logger.debug(f"pressure = {self.pressure_value}")
-
-        return self.temp_value, self.co2_value, self.pressure_value
+        wall_now = time.time()
+        with self.lock:
+            for name, item in state.get("values", {}).items():
+                try:
+                    value, wall_timestamp = item
+                    age = wall_now - wall_timestamp
+                except (TypeError, ValueError):
+                    self.logger.warning(f"Invalid state of {name}: {item}")
+                    continue
+                if name not in self.values or not 0 <= age < self.metric_timeout:
+                    continue
+                self.logger.info(f"Loaded {name} = {value} ({age:.0f} seconds old)")
+                self.values[name] = value
+                self.timestamps[name] = now - age
+                self.expiry.schedule(name, now - age + self.metric_timeout)
+
+    def save_state(self):
+        """
+        Persist the values and their wall clock timestamps, if they changed
+        or were persisted long time ago.
+        """
+        if not self.state_file:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            recently_saved = now - self.state_saved < self.metric_timeout / 2
+            if not self.state_dirty and recently_saved:
+                return
+            offset = time.time() - now
+            values = {
+                name: [value, self.timestamps[name] + offset]
+                for name, value in self.values.items()
+                if value is not None
+            }
+            self.state_dirty = False
+            self.state_saved = now
+
+        try:
+            write_atomically(self.state_file, json.dumps({"values": values}))
+        except OSError as e:
+            self.logger.warning(f"Cannot save state to {self.state_file}: {e}")
+
+    def save_log(self):
+        """
+        Write the values buffered by the metrics log, if the batch is complete
+        or they have been buffered for long.
+        """
+        if self.metrics_log is not None:
+            self.metrics_log.flush(force=False)
+
+    def load_history(self):
+        """
+        Load the history of the values from the metrics log. The wall clock
+        timestamps of the values are converted to monotonic time.
+        """
+        now = time.monotonic()
+        wall_now = time.time()
+        duration = max(duration for duration, _ in DEFAULT_WINDOWS.values())
+        # The records from the future were logged while the clock was wrong.
+        records = iter_log(
+            self.metrics_log.directory,
+            start=wall_now - duration,
+            end=wall_now,
+            names=self.history,
+        )
+        # The records are decoded one at a time so that the whole log
+        # is never held in memory.
+        count = 0
+        for wall_timestamp, name, value in records:
+            with self.lock:
+                self.history[name].add(now - (wall_now - wall_timestamp), value)
+            count += 1
+        self.logger.info(f"Loaded {count} values from the metrics log")
+
+    def get_values(self):
+        """
+        Decode the pending payloads and expire stale values.
+        Has to be called with the lock held.
+        :return: tuple of metric values, in the order of the registry
+        """
+        self.decode_payloads()
+        self.expire(time.monotonic())
+
+        for name, value in self.values.items():
+            self.logger.debug(f"{name} = {value}")
+
+        return tuple(self.values[definition.name] for definition in self.registry)
+
+    def get_history_stats(self, window):
+        """
+        :param window: name of the history window, e.g. "hour" or "day"
+        :return: tuple of (minimum, maximum, mean) tuples of the values
+        over the window, or None for the metrics without values in the window
+        (all of them if the history is not kept), in the order of the registry
+        """
+        now = time.monotonic()
+        with self.lock:
+            return tuple(
+                history.stats(window, now) if history is not None else None
+                for history in self.get_histories()
+            )
+
+    def get_history_ranges(self, window):
+        """
+        :param window: name of the history window, e.g. "hour" or "day"
+        :return: tuple of lists of (minimum, maximum) tuples (None if there are
+        no values) of the slots of the window, oldest first, in the order
+        of the registry. None instead of the lists if the history is not kept.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return tuple(
+                history.windows[window].ranges(now) if history is not None else None
+                for history in self.get_histories()
+            )
+
+    def get_histories(self):
+        """
+        :return: list of MetricHistory objects or None if the history is not kept,
+        in the order of the registry
+        """
+        return [self.history.get(definition.name) for definition in self.registry]
@@ -4,11 +4,124 @@ MetricsDrawer class
 Not dependent on the output type.
 """
 
+import functools
 import logging
+import math
+import os
+import time
 from datetime import datetime
 
 from PIL import Image, ImageDraw, ImageFont
 
+from instrumentation import TIMINGS
+from metric_registry import get_default_registry
+from text_cache import TextCache
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(path, size):
+    """
+    Load TrueType font. The fonts are loaded only once per process.
+    :param path: path to the font file
+    :param size: font size
+    :return: FreeTypeFont object
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug(f"Loading font {path} size {size}")
+    return ImageFont.truetype(path, size)
+
+
+def get_font_signature(paths):
+    """
+    :param paths: font file paths
+    :return: dictionary with the modification time and size of the font files
+    """
+    signature = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature[path] = None
+            continue
+        signature[path] = [stat.st_mtime_ns, stat.st_size]
+    return signature
+
+
+def downsample(ranges, columns):
+    """
+    Reduce the ranges to at most the number of columns, keeping the extremes
+    of the ranges falling into each column. Takes time proportional to the number
+    of the ranges, not to the number of the values aggregated into them.
+    :param ranges: sequence of (minimum, maximum) tuples or None for gaps, oldest first
+    :param columns: maximum number of columns
+    :return: list of (minimum, maximum) tuples or None for the columns without values
+    """
+    count = len(ranges)
+    columns = min(columns, count)
+    result = []
+    for column in range(columns):
+        start = column * count // columns
+        end = (column + 1) * count // columns
+        chunk = [item for item in ranges[start:end] if item is not None]
+        if chunk:
+            result.append(
+                (min(low for low, _ in chunk), max(high for _, high in chunk))
+            )
+        else:
+            result.append(None)
+    return result
+
+
+def get_scale(columns, threshold, height):
+    """
+    :param columns: list of (minimum, maximum) tuples or None for gaps,
+    with at least one tuple
+    :param threshold: minimum significant change of the values
+    :param height: height in pixels
+    :return: tuple of the value at the bottom and pixels per unit of the value.
+    The scale spans at least the threshold, so that insignificant changes stay flat.
+    """
+    values = [column for column in columns if column is not None]
+    low = min(column_low for column_low, _ in values)
+    high = max(column_high for _, column_high in values)
+    span = max(high - low, threshold) or 1
+    # Center the values if they span less than the threshold.
+    return low - (span - (high - low)) / 2, height / span
+
+
+def get_sparkline(columns, threshold, box):
+    """
+    Lay out sparkline as vertical lines spanning the range of each column,
+    connected to the neighboring columns.
+    :param columns: list of (minimum, maximum) tuples or None for gaps,
+    one for each pixel column, with at least one tuple
+    :param threshold: minimum significant change of the values
+    :param box: (left, upper, right, lower) box to draw in
+    :return: list of ((x, upper), (x, lower)) line segments
+    """
+    left, top = box[:2]
+    bottom = box[3] - 1
+    low, scale = get_scale(columns, threshold, bottom - top)
+
+    segments = []
+    previous = None
+    for x, column in enumerate(columns, start=left):
+        if column is None:
+            previous = None
+            continue
+        current = (
+            bottom - round((column[1] - low) * scale),
+            bottom - round((column[0] - low) * scale),
+        )
+        upper, lower = current
+        if previous is not None:
+            # Connect to the previous column.
+            upper = min(upper, previous[1])
+            lower = max(lower, previous[0])
+        segments.append(((x, upper), (x, lower)))
+        previous = current
+    return segments
+
 
 # pylint: disable=too-many-instance-attributes
 class MetricsDrawer:
@@ -16,14 +129,23 @@ class MetricsDrawer:
     Class to wrap fetching and drawing of the metrics.
     """
 
-    # First define some color constants
+    # Color constants for the RGB mode
     WHITE = (0xFF, 0xFF, 0xFF)
     BLACK = (0x00, 0x00, 0x00)
 
-    # Next define some constants to allow easy resizing of shapes and colors
-    BACKGROUND_COLOR = WHITE
-    FOREGROUND_COLOR = WHITE
-    TEXT_COLOR = BLACK
+    # Number of metrics drawn with the medium font below the first (large) metric.
+    # The rest is drawn with the small font below the date.
+    MEDIUM_LINES = 2
+
+    # Minimum width of a sparkline in pixels, narrower ones are not drawn.
+    MIN_SPARKLINE_WIDTH = 16
+
+    # White and black color values for the supported image modes.
+    MODE_COLORS = {
+        "1": (1, 0),
+        "L": (0xFF, 0x00),
+        "RGB": (WHITE, BLACK),
+    }
 
     # pylint: disable=too-many-arguments,too-many-positional-arguments
     def __init__(
@@ -32,137 +154,454 @@ class MetricsDrawer:
         display_height,
         medium_font_path,
         large_font_path,
+        mode="RGB",
+        definitions=None,
+        cache_size=512,
+        cache_path=None,
+        cache_save_interval=600,
     ):
         """
         :param display_height: display width in pixels
         :param display_width: display height in pixels
         :param large_font_path: path to font used for large letters
         :param medium_font_path: path to font used for medium letters
+        :param mode: PIL image mode to draw in ("1", "L" or "RGB")
+        :param definitions: sequence of MetricDefinition objects describing the values
+        passed to draw_image(). Defaults to temperature, CO2 and barometric pressure.
+        :param cache_size: maximum number of cached text renderings and measurements
+        :param cache_path: path to the file to persist the cached text renderings to,
+        so that the text seen before can be drawn after restart without loading the fonts
+        :param cache_save_interval: minimum time in seconds between the saves
+        of the cache while drawing, the cache is saved also by save_cache()
         """
+        if mode not in MetricsDrawer.MODE_COLORS:
+            raise ValueError(f"unsupported image mode: {mode}")
+
         self.display_width = display_width
         self.display_height = display_height
 
-        self.small_font = ImageFont.truetype(large_font_path, 12)
-        self.medium_font = ImageFont.truetype(medium_font_path, 24)
-        self.large_font = ImageFont.truetype(large_font_path, 64)
+        self.mode = mode
+        self.background_color, self.text_color = MetricsDrawer.MODE_COLORS[mode]
+
+        if definitions is None:
+            definitions = get_default_registry(None, None, None, None, None, None)
+        self.definitions = list(definitions)
+        self.definitions_by_name = {
+            definition.name: definition for definition in self.definitions
+        }
 
-        self.image = Image.new("RGB", (self.display_width, self.display_height))
+        # The fonts are referred to by (path, size) tuples and loaded only
+        # when the text is not found in the cache.
+        self.small_font = (large_font_path, 12)
+        self.medium_font = (medium_font_path, 24)
+        self.large_font = (large_font_path, 64)
+
+        self.image = Image.new(self.mode, (self.display_width, self.display_height))
 
         # Get drawing object to draw on image.
         self.draw = ImageDraw.Draw(self.image)
 
-    def draw_image(self, temp, co2, pressure):
+        # Text and bounding box of each drawn element, used to compute
+        # the regions of the image that changed since the previous frame.
+        self.elements = {}
+        self.dirty_rects = []
+
+        # Static labels drawn into the base layer and the rest of the text
+        # pasted over it, as (coordinates, text, font) tuples.
+        self.labels = []
+        self.texts = []
+        # Sparklines drawn over the text, as lists of vertical line segments.
+        self.sparklines = []
+
+        # The background with the labels changes only when the layout changes,
+        # the text bitmaps and measurements are cached by font and string.
+        self.render_base_layer = functools.lru_cache(maxsize=min(cache_size, 4))(
+            self._render_base_layer
+        )
+        self.text_cache = TextCache(
+            cache_size,
+            path=cache_path,
+            signature={
+                "mode": mode,
+                "fonts": get_font_signature({medium_font_path, large_font_path}),
+            },
+            save_interval=cache_save_interval,
+        )
+
+    def render_text(self, font, text, start):
         """
-        Refresh the display with weather metrics from the positonal arguments
-        (temperature, co2 and barometric pressure).
-        :return PIL image instance
+        Cached variant of _render_text().
+        """
+        return self.text_cache.get(
+            ("render", font, text, start),
+            lambda: self._render_text(font, text, start),
+        )
+
+    def text_bbox(self, font, text, start):
         """
+        Cached variant of _text_bbox().
+        """
+        return self.text_cache.get(
+            ("bbox", font, text, start), lambda: self._text_bbox(font, text, start)
+        )
 
-        # Draw a filled box as the background
-        self.draw.rectangle(
-            (0, 0, self.display_width - 1, self.display_height - 1),
-            fill=MetricsDrawer.BACKGROUND_COLOR,
+    def measure(self, font, text):
+        """
+        Cached variant of _measure().
+        """
+        return self.text_cache.get(
+            ("measure", font, text), lambda: self._measure(font, text)
         )
 
-        self.draw_date_time()
+    def text_length(self, font, text):
+        """
+        Cached variant of _text_length().
+        """
+        return self.text_cache.get(
+            ("length", font, text), lambda: self._text_length(font, text)
+        )
 
-        text_height = self.draw_outside_temperature(temp)
-        current_height = self.draw_co2(co2, text_height)
-        self.draw_pressure(current_height, pressure)
+    # pylint: disable=too-many-locals
+    def draw_image(self, *values, offline=False, trends=None, extremes=None):
+        """
+        Refresh the display with weather metrics from the positonal arguments,
+        one for each metric definition (by default temperature, co2 and barometric pressure).
+        Afterwards, the dirty_rects member contains the list of (left, upper, right, lower)
+        boxes that differ from the previous image.
+        :param offline: whether to indicate that the values are not being updated
+        :param trends: optional sequence with the recent history of each metric,
+        drawn as sparklines next to the metrics drawn with the large and medium font.
+        The history is a sequence of (minimum, maximum) tuples or None for gaps,
+        oldest first, e.g. as returned by Metrics.get_history_ranges().
+        :param extremes: optional sequence of (minimum, maximum, ...) tuples
+        or None for each metric, the minimum and maximum of the first metric
+        is drawn below it, e.g. as returned by Metrics.get_history_stats()
+        :return PIL image instance
+        """
+        start = time.perf_counter()
+        previous_elements = self.elements
+        self.elements = {}
+        self.labels = []
+        self.texts = []
+        self.sparklines = []
+
+        date_height = self.draw_date_time()
+
+        texts = [
+            (definition.name, definition.label, definition.format(value))
+            for definition, value in zip(self.definitions, values)
+        ]
+        if trends is None:
+            trends = [None] * len(texts)
+        if texts:
+            text_height = self.draw_large_metric(*texts[0])
+            self.draw_sparkline(texts[0][0], trends[0], date_height + 4)
+            if extremes and extremes[0] is not None:
+                self.draw_extremes(texts[0][0], *extremes[0][:2], text_height)
+            current_height = text_height + 10
+            medium_end = 1 + MetricsDrawer.MEDIUM_LINES
+            for (name, label, text), trend in zip(
+                texts[1:medium_end], trends[1:medium_end]
+            ):
+                current_height = self.draw_medium_metric(
+                    name, text, current_height, label=label
+                )
+                self.draw_sparkline(name, trend)
+            self.draw_small_metrics(
+                [(name, text) for name, _, text in texts[medium_end:]],
+                date_height + 5,
+            )
+
+        if offline:
+            self.draw_status("offline")
+
+        self.compose_image()
+
+        self.dirty_rects = self.get_dirty_rects(previous_elements)
+        TIMINGS.observe("render", time.perf_counter() - start)
+
+        self.text_cache.save(force=False)
 
         return self.image
 
-    def draw_pressure(self, current_height, pressure):
+    def save_cache(self):
         """
-        :param current_height:
-        :param pressure:
-        :return:
+        Persist the new cached text renderings, e.g. on shutdown.
         """
-        logger = logging.getLogger(__name__)
+        self.text_cache.save()
+
+    def compose_image(self):
+        """
+        Start from the background with the labels and paste the rest of the text.
+        """
+        self.image.paste(self.render_base_layer(tuple(self.labels)))
+        for coordinates, text, font in self.texts:
+            self.paste_text(coordinates, text, font)
+        for segments in self.sparklines:
+            for segment in segments:
+                self.draw.line(segment, fill=self.text_color)
+
+    def _render_base_layer(self, labels):
+        """
+        :param labels: tuple of (coordinates, text, font) tuples
+        :return: image with the background and the labels
+        """
+        image = Image.new(
+            self.mode, (self.display_width, self.display_height), self.background_color
+        )
+        for coordinates, text, font in labels:
+            mask, offset = self.render_text(font, text, 0)
+            if mask is not None:
+                position = (coordinates[0] + offset[0], coordinates[1] + offset[1])
+                image.paste(self.text_color, position, mask)
+
+        return image
 
-        # Draw atmospheric pressure level.
-        if pressure:
-            pressure = int(float(pressure))
-            text = f"Pressure: {pressure} hPa"
+    def _render_text(self, font, text, start):
+        """
+        Render text into a mask, the same way ImageDraw.text() would at horizontal
+        position with given fractional part.
+        :param font: (path, size) tuple of the font to use
+        :param text: text to render
+        :param start: fractional part of the horizontal position
+        :return: tuple of the mask (or None if there is nothing to draw)
+        and its offset from the integer position
+        """
+        bbox = self.text_bbox(font, text, start)
+        origin_x = max(0, -math.floor(bbox[0]))
+        origin_y = max(0, -math.floor(bbox[1]))
+        mask = Image.new(
+            "L",
+            (origin_x + math.ceil(bbox[2]) + 1, origin_y + math.ceil(bbox[3]) + 1),
+        )
+        draw = ImageDraw.Draw(mask)
+        draw.fontmode = self.draw.fontmode
+        draw.text((origin_x + start, origin_y), text, font=get_font(*font), fill=0xFF)
+
+        ink_box = mask.getbbox()
+        if not ink_box:
+            return None, (0, 0)
+
+        return mask.crop(ink_box), (ink_box[0] - origin_x, ink_box[1] - origin_y)
+
+    def _text_bbox(self, font, text, start):
+        """
+        :param font: (path, size) tuple of the font to use
+        :param text: text to measure
+        :param start: fractional part of the horizontal position
+        :return: bounding box of the text drawn at (start, 0)
+        """
+        return self.draw.textbbox((start, 0), text, font=get_font(*font))
+
+    def _text_length(self, font, text):
+        """
+        :param font: (path, size) tuple of the font to use
+        :param text: text to measure
+        :return: advance width of the text, as drawn on the image
+        """
+        return get_font(*font).getlength(text, mode=self.draw.fontmode)
+
+    def _measure(self, font, text):
+        """
+        :param font: (path, size) tuple of the font to use
+        :param text: text to measure
+        :return: (left, top, right, bottom) bounding box of the text
+        """
+        font = get_font(*font)
+        if hasattr(font, "getsize"):
+            (text_width, text_height) = font.getsize(text)
+            return 0, 0, text_width, text_height
+
+        return font.getbbox(text)
+
+    def paste_text(self, coordinates, text, font):
+        """
+        Paste the cached rendering of the text into the image.
+        :param coordinates: top left corner
+        :param text: text to draw
+        :param font: (path, size) tuple of the font to use
+        """
+        x = int(coordinates[0])
+        y = int(coordinates[1])
+        mask, offset = self.render_text(font, text, coordinates[0] - x)
+        if mask is not None:
+            self.image.paste(self.text_color, (x + offset[0], y + offset[1]), mask)
+
+    def get_dirty_rects(self, previous_elements):
+        """
+        :param previous_elements: elements of the previous image
+        :return: list of boxes covering the elements that changed
+        """
+        if not previous_elements:
+            return [(0, 0, self.display_width, self.display_height)]
+
+        dirty_rects = []
+        for name in set(previous_elements) | set(self.elements):
+            previous = previous_elements.get(name)
+            current = self.elements.get(name)
+            if previous == current:
+                continue
+
+            boxes = [element[1] for element in (previous, current) if element]
+            dirty_rects.append(
+                (
+                    min(box[0] for box in boxes),
+                    min(box[1] for box in boxes),
+                    max(box[2] for box in boxes),
+                    max(box[3] for box in boxes),
+                )
+            )
+
+        return dirty_rects
+
+    def draw_text(self, name, coordinates, text, font, label=""):
+        """
+        Lay out text and record it as an element of the image.
+        :param name: element name
+        :param coordinates: top left corner
+        :param text: text to draw, including the label
+        :param font: (path, size) tuple of the font to use
+        :param label: static prefix of the text drawn as part of the base layer
+        """
+        if label and text.startswith(label):
+            self.labels.append((coordinates, label, font))
+            value_coordinates = (
+                coordinates[0] + self.text_length(font, label),
+                coordinates[1],
+            )
+            value_text = text.removeprefix(label)
+            self.texts.append((value_coordinates, value_text, font))
         else:
-            text = "Pressure: N/A"
-        logger.debug(text)
-        coordinates = (0, current_height)  # use previous text height
-        logger.debug(f"coordinates = {coordinates}")
-        self.draw.text(
-            coordinates,
+            self.texts.append((coordinates, text, font))
+
+        box = self.text_bbox(font, text, 0)
+        self.elements[name] = (
             text,
-            font=self.medium_font,
-            fill=MetricsDrawer.TEXT_COLOR,
+            (
+                coordinates[0] + box[0],
+                coordinates[1] + box[1],
+                coordinates[0] + box[2],
+                coordinates[1] + box[3],
+            ),
         )
 
-    def draw_co2(self, co2, text_height):
+    def draw_small_metrics(self, texts, current_height):
+        """
+        Draw metrics with small font, aligned to the right.
+        :param texts: list of (name, text) tuples
+        :param current_height: height to start at
         """
-        :param co2:
-        :param text_height:
+        logger = logging.getLogger(__name__)
+
+        for name, text in texts:
+            (left, _, right, bottom) = self.measure(self.small_font, text)
+            coordinates = (self.display_width - (right - left) - 10, current_height)
+            logger.debug(f"'{text}' coordinates = {coordinates}")
+            self.draw_text(name, coordinates, text, self.small_font)
+            current_height = current_height + bottom
+
+    def draw_medium_metric(self, name, text, current_height, label=""):
+        """
+        :param name: metric name
+        :param text: text to draw
+        :param current_height: height to draw the text at
+        :param label: static prefix of the text
         :return: current text height
         """
         logger = logging.getLogger(__name__)
 
-        # Draw CO2 level.
-        co_text = "CO₂"
-        if co2:
-            co2 = int(float(co2))
-            text = f"{co_text} : {co2} ppm"
-        else:
-            text = f"{co_text} : N/A"
-        coordinates = (0, text_height + 10)  # use previous text height
-        current_height = text_height + 10
-        if hasattr(self.medium_font, "getsize"):
-            (_, text_height) = self.medium_font.getsize(text)
-        else:
-            text_height = self.medium_font.getbbox(text)[3]
+        coordinates = (0, current_height)  # use previous text height
+        text_height = self.measure(self.medium_font, text)[3]
         current_height = current_height + text_height
         logger.debug(f"'{text}' coordinates = {coordinates}")
-        self.draw.text(
-            coordinates,
-            text,
-            font=self.medium_font,
-            fill=MetricsDrawer.TEXT_COLOR,
-        )
+        self.draw_text(name, coordinates, text, self.medium_font, label=label)
 
         return current_height
 
-    def draw_outside_temperature(self, temp):
+    def draw_large_metric(self, name, label, text):
         """
-        :param temp: temperature value
+        :param name: metric name
+        :param label: static prefix of the text
+        :param text: text to draw
         :return: current text height
         """
         logger = logging.getLogger(__name__)
 
-        # Draw outside temperature.
-        if temp:
-            outside_temp = int(temp)
-            text = f"{outside_temp}°C"
-        else:
-            text = "N/A"
         logger.debug(text)
-        if hasattr(self.medium_font, "getsize"):
-            (text_width, text_height) = self.large_font.getsize(text)
-        else:
-            (text_width, text_height) = self.large_font.getbbox(text)[2:4]
+        (text_width, text_height) = self.measure(self.large_font, text)[2:4]
         logger.debug(f"text width={text_width}, height={text_height}")
         logger.debug(
             f"display width={self.display_width}, height={self.display_height}"
         )
         coordinates = (0, 0)
         logger.debug(f"coordinates = {coordinates}")
-        self.draw.text(
-            coordinates,
-            text,
-            font=self.large_font,
-            fill=MetricsDrawer.TEXT_COLOR,
-        )
+        self.draw_text(name, coordinates, text, self.large_font, label=label)
         return text_height
 
+    def draw_sparkline(self, name, ranges, top=None):
+        """
+        Draw the history of the metric as a sparkline right of its text,
+        aligned to the right edge, with the ranges downsampled to the pixel columns.
+        :param name: metric name
+        :param ranges: sequence of (minimum, maximum) tuples or None for gaps,
+        oldest first, or None to draw nothing
+        :param top: top of the sparkline, the top of the text if None
+        """
+        if not ranges:
+            return
+
+        _, text_box = self.elements[name]
+        top = int(text_box[1] if top is None else top)
+        bottom = int(text_box[3])
+        right = self.display_width - 10
+        columns = downsample(ranges, right - int(text_box[2]) - 6)
+        if len(columns) < MetricsDrawer.MIN_SPARKLINE_WIDTH or bottom - top < 4:
+            return
+        if all(column is None for column in columns):
+            return
+
+        left = right - len(columns)
+        threshold = self.definitions_by_name[name].threshold
+        segments = get_sparkline(columns, threshold, (left, top, right + 1, bottom))
+
+        self.sparklines.append(segments)
+        self.elements[f"{name}/trend"] = (
+            tuple(segments),
+            (left, top, right + 1, bottom),
+        )
+
+    def draw_extremes(self, name, low, high, text_height):
+        """
+        Draw the minimum and the maximum of the metric below it.
+        :param name: metric name
+        :param low: minimum value
+        :param high: maximum value
+        :param text_height: bottom of the text of the metric
+        """
+        definition = self.definitions_by_name[name]
+        unit = definition.unit
+        text = (
+            f"min {definition.formatter(low)}{unit}  "
+            f"max {definition.formatter(high)}{unit}"
+        )
+        self.draw_text(f"{name}/extremes", (0, text_height), text, self.small_font)
+
+    def draw_status(self, text):
+        """
+        Draw status text in the bottom right corner.
+        :param text: text to draw
+        """
+        (left, _, right, bottom) = self.measure(self.small_font, text)
+        coordinates = (
+            self.display_width - (right - left) - 10,
+            self.display_height - bottom - 2,
+        )
+        self.draw_text("status", coordinates, text, self.small_font)
+
     def draw_date_time(self):
         """
         Draw date and time in the top right corner.
+        :return: bottom of the text
         """
         logger = logging.getLogger(__name__)
 
@@ -170,15 +609,8 @@ class MetricsDrawer:
         now = datetime.now()
         text = now.strftime(f"{now.day}.{now.month}.")
         logger.debug(text)
-        if hasattr(self.medium_font, "getsize"):
-            (text_width, _) = self.medium_font.getsize(text)
-        else:
-            (text_width, _) = self.medium_font.getbbox(text)[2:4]
+        text_width = self.measure(self.medium_font, text)[2]
         coordinates = (self.display_width - text_width - 10, 10)
         logger.debug(f"coordinates = {coordinates}")
-        self.draw.text(
-            coordinates,
-            text,
-            font=self.medium_font,
-            fill=MetricsDrawer.TEXT_COLOR,
-        )
+        self.draw_text("date", coordinates, text, self.medium_font)
+        return self.elements["date"][1][3]
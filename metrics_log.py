@@ -0,0 +1,413 @@
+"""
+Append-only binary log of the metric values. The values are stored
+as fixed-size records (timestamp, metric id, value) in segment files of limited
+size, the oldest segments are removed so that the log does not grow without bound.
+The records are buffered and written (and synced to the storage) in batches,
+to keep the writes to the SD card few and large.
+"""
+
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+# Segment header: magic, format version and length of the metric names (JSON list)
+# following it. The metric id of the records is index to the list.
+HEADER = struct.Struct("<4sHH")
+MAGIC = b"ZDML"
+VERSION = 1
+
+# Record: seconds since the Epoch, metric id, padding and value.
+RECORD = struct.Struct("<dHxxf")
+# The timestamp at the start of the record.
+TIMESTAMP = struct.Struct("<d")
+
+SEGMENT_SUFFIX = ".seg"
+# Segment file name, the sequence number padded to 10 digits. Other files
+# in the directory (e.g. backup copies) are ignored.
+SEGMENT_NAME = re.compile(r"^\d{10}\.seg$")
+
+
+def encode_header(names):
+    """
+    :param names: list of metric names
+    :return: segment header, padded to the size of the record
+    """
+    encoded_names = json.dumps(names).encode("utf-8")
+    header = HEADER.pack(MAGIC, VERSION, len(encoded_names)) + encoded_names
+    return header + bytes(-len(header) % RECORD.size)
+
+
+def decode_header(buffer):
+    """
+    :param buffer: segment data
+    :return: tuple of the list of metric names and the offset of the first record
+    """
+    magic, version, names_length = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"not a metrics log segment: {magic!r} version {version}")
+
+    begin = HEADER.size
+    end = begin + names_length
+    names = json.loads(bytes(buffer[begin:end]).decode("utf-8"))
+    return names, end + -end % RECORD.size
+
+
+def list_segments(directory):
+    """
+    :param directory: log directory
+    :return: list of segment paths, oldest first
+    """
+    try:
+        files = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [
+        os.path.join(directory, name)
+        for name in sorted(files)
+        if SEGMENT_NAME.match(name)
+    ]
+
+
+# pylint: disable=too-many-instance-attributes
+class MetricsLog:
+    """
+    Writer of the log. Thread safe.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        directory,
+        names,
+        segment_size=1024 * 1024,
+        max_segments=16,
+        batch_size=256,
+        flush_interval=300,
+        clock_tolerance=60,
+    ):
+        """
+        :param directory: directory to store the segments in, created if needed
+        :param names: list of the metric names
+        :param segment_size: size of the segment in bytes after which a new one
+        is started
+        :param max_segments: number of segments to keep
+        :param batch_size: number of buffered records that triggers write
+        :param flush_interval: maximum time in seconds the records stay buffered
+        :param clock_tolerance: time in seconds the clock may go backwards
+        without starting a new segment
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.directory = directory
+        self.names = list(names)
+        self.ids = {name: index for index, name in enumerate(self.names)}
+        self.header = encode_header(self.names)
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock_tolerance = clock_tolerance
+
+        # Protects the buffer.
+        self.lock = threading.Lock()
+        # Serializes the writes.
+        self.write_lock = threading.Lock()
+        self.buffer = bytearray()
+        # Offsets in the buffer where the clock went backwards,
+        # the records from there on go to a new segment.
+        self.breaks = []
+        self.flushed = time.monotonic()
+        self.file = None
+
+        os.makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self.sequence = 0
+        if segments:
+            self.sequence = int(os.path.basename(segments[-1]).split(".")[0]) + 1
+        # Timestamps are kept increasing within a segment, also across restarts,
+        # so that the segment can be searched.
+        self.last_timestamp = self.read_last_timestamp(segments)
+
+    def read_last_timestamp(self, segments):
+        """
+        :param segments: list of segment paths, oldest first
+        :return: timestamp of the last complete record in the newest valid segment,
+        or negative infinity if there is none
+        """
+        for path in reversed(segments):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError, struct.error) as e:
+                self.logger.warning(f"Cannot read metrics log segment {path}: {e}")
+                continue
+            with segment:
+                if segment.count:
+                    return segment.timestamp(segment.count - 1)
+        return float("-inf")
+
+    def append(self, timestamp, name, value):
+        """
+        Buffer value of the metric. Values of unknown metrics are ignored.
+        Timestamps slightly older than the previous one, including the one logged
+        before the restart, are replaced by it. If the clock went backwards
+        by more than the tolerance (e.g. when it was corrected after boot
+        without RTC), new segment is started instead. Values out of the single
+        precision range are skipped.
+        :param timestamp: seconds since the Epoch
+        :param name: metric name
+        :param value: number
+        """
+        metric_id = self.ids.get(name)
+        if metric_id is None:
+            return
+
+        with self.lock:
+            clock_reset = timestamp < self.last_timestamp - self.clock_tolerance
+            if not clock_reset:
+                timestamp = max(timestamp, self.last_timestamp)
+            try:
+                record = RECORD.pack(timestamp, metric_id, value)
+            except (OverflowError, struct.error) as e:
+                # Out of the single precision range.
+                self.logger.warning(f"Cannot log {name} = {value}: {e}")
+                return
+            if clock_reset:
+                self.logger.warning(
+                    f"Clock went back from {self.last_timestamp} to {timestamp}, "
+                    "starting new metrics log segment"
+                )
+                self.breaks.append(len(self.buffer))
+            self.last_timestamp = timestamp
+            self.buffer += record
+
+    def is_due(self):
+        """
+        :return: True if the buffered records should be written
+        """
+        with self.lock:
+            if not self.buffer:
+                return False
+            full = len(self.buffer) >= self.batch_size * RECORD.size
+            return full or time.monotonic() - self.flushed >= self.flush_interval
+
+    def flush(self, force=True):
+        """
+        Write the buffered records and sync them to the storage.
+        :param force: if False, write only if the batch is full
+        or the flush interval elapsed
+        """
+        if not force and not self.is_due():
+            return
+
+        with self.write_lock:
+            with self.lock:
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                breaks = self.breaks
+                self.breaks = []
+                self.flushed = time.monotonic()
+            if not data:
+                return
+
+            offsets = [0] + breaks + [len(data)]
+            try:
+                for index in range(len(offsets) - 1):
+                    if index:
+                        self.close_segment()
+                    begin = offsets[index]
+                    end = offsets[index + 1]
+                    if begin < end:
+                        self.write(data[begin:end])
+            except OSError as e:
+                self.logger.warning(f"Cannot write metrics log: {e}")
+                self.close_segment()
+
+    def write(self, data):
+        """
+        Write the records to the current segment, starting new one if it is full.
+        Has to be called with the write lock held.
+        :param data: encoded records
+        """
+        if self.file is not None and self.file.tell() + len(data) > self.segment_size:
+            self.close_segment()
+        if self.file is None:
+            self.open_segment()
+
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def open_segment(self):
+        """
+        Start new segment and remove the oldest ones over the limit.
+        """
+        path = os.path.join(self.directory, f"{self.sequence:010d}{SEGMENT_SUFFIX}")
+        self.sequence += 1
+        self.logger.debug(f"Starting metrics log segment {path}")
+        # pylint: disable=consider-using-with
+        self.file = open(path, "xb")
+        self.file.write(self.header)
+
+        for old_path in list_segments(self.directory)[: -self.max_segments]:
+            self.logger.debug(f"Removing metrics log segment {old_path}")
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                self.logger.warning(f"Cannot remove {old_path}: {e}")
+
+    def close_segment(self):
+        """
+        Close the current segment, if any.
+        """
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError as e:
+                self.logger.warning(f"Cannot close metrics log segment: {e}")
+            self.file = None
+
+    def close(self):
+        """
+        Write the buffered records and close the log.
+        """
+        self.flush()
+        with self.write_lock:
+            self.close_segment()
+
+
+class Segment:
+    """
+    Memory mapped segment of the log. The records are searched by timestamp
+    in O(log n) time and decoded only within the requested range.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: segment path
+        """
+        with open(path, "rb") as segment_file:
+            self.mmap = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.names, self.offset = decode_header(self.mmap)
+        except (ValueError, struct.error):
+            self.close()
+            raise
+        # A record may be partially written if the writer was interrupted.
+        self.count = (len(self.mmap) - self.offset) // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the segment.
+        """
+        self.mmap.close()
+
+    def timestamp(self, index):
+        """
+        :param index: record index
+        :return: timestamp of the record
+        """
+        return TIMESTAMP.unpack_from(self.mmap, self.offset + index * RECORD.size)[0]
+
+    def bisect(self, timestamp):
+        """
+        :param timestamp: seconds since the Epoch
+        :return: index of the first record not older than the timestamp
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read(self, start=None, end=None):
+        """
+        :param start: seconds since the Epoch, or None to read from the first record
+        :param end: seconds since the Epoch (exclusive), or None to read
+        to the last record
+        :return: list of (timestamp, name, value) tuples
+        """
+        return list(self.iter_records(start, end))
+
+    def iter_records(self, start=None, end=None):
+        """
+        Decode the records lazily. The segment has to stay open until
+        the iteration is finished or the iterator closed.
+        :param start: seconds since the Epoch, or None to read from the first record
+        :param end: seconds since the Epoch (exclusive), or None to read
+        to the last record
+        :return: iterator of (timestamp, name, value) tuples
+        """
+        first = 0 if start is None else self.bisect(start)
+        last = self.count if end is None else self.bisect(end)
+        if first >= last:
+            return
+
+        begin = self.offset + first * RECORD.size
+        end = self.offset + last * RECORD.size
+        view = memoryview(self.mmap)
+        try:
+            records = view[begin:end]
+            names = self.names
+            for timestamp, metric_id, value in RECORD.iter_unpack(records):
+                yield timestamp, names[metric_id], value
+        finally:
+            view.release()
+
+
+def iter_log(directory, start=None, end=None, names=None):
+    """
+    Read the records of the log lazily, memory mapping one segment at a time.
+    The records are sorted within each segment, but not across the segments
+    if the clock went backwards in between. The segments outside the range
+    are skipped without reading them.
+    :param directory: log directory
+    :param start: seconds since the Epoch, or None to read from the first record
+    :param end: seconds since the Epoch (exclusive), or None to read to the last record
+    :param names: collection of the metric names to read, or None to read all
+    :return: iterator of (timestamp, name, value) tuples, in the order
+    they were logged
+    """
+    logger = logging.getLogger(__name__)
+
+    for path in list_segments(directory):
+        try:
+            segment = Segment(path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Cannot read metrics log segment {path}: {e}")
+            continue
+        with segment:
+            if not segment.count:
+                continue
+            if start is not None and segment.timestamp(segment.count - 1) < start:
+                continue
+            if end is not None and segment.timestamp(0) >= end:
+                continue
+            for record in segment.iter_records(start, end):
+                if names is None or record[1] in names:
+                    yield record
+
+
+def read_log(directory, start=None, end=None, names=None):
+    """
+    Read the records of the log, see iter_log().
+    :param directory: log directory
+    :param start: seconds since the Epoch, or None to read from the first record
+    :param end: seconds since the Epoch (exclusive), or None to read to the last record
+    :param names: collection of the metric names to read, or None to read all
+    :return: list of (timestamp, name, value) tuples, in the order they were logged
+    """
+    return list(iter_log(directory, start, end, names))
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+Load and soak testing of the MQTT processing: replay recorded or synthetic
+message streams through a local broker running in a separate process
+to Metrics connected to it, and report the CPU time, the latency from publishing
+a message to get_metrics() returning its value and the memory growth.
+
+The synthetic stream can contain bursts, timestamps going back in time,
+malformed JSON payloads and the broker can disconnect the client periodically.
+The recorded streams are JSON lines files with the "time" (seconds since the start),
+"topic" and "payload" keys, as written with the --record option.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import re
+import resource
+import time
+import tracemalloc
+
+from instrumentation import Histogram
+from local_broker import LocalBroker
+from metric_registry import MetricDefinition, MetricRegistry, load_registry
+from metrics import Metrics
+
+# Metrics carried by the synthetic stream, (topic, field) tuples.
+SYNTHETIC_METRICS = [
+    ("replay/outside", "temperature"),
+    ("replay/kitchen", "co2_ppm"),
+    ("replay/kitchen", "pressure_hpa"),
+]
+TIMESTAMP_FIELD = "timestamp"
+
+# Field with the monotonic time the message was published at. The monotonic clock
+# is shared by the processes so the latency can be computed by the receiver.
+SENT_FIELD = "_sent"
+# The field is the first one so that it can be found in malformed payloads too.
+SENT_RE = re.compile(r'"_sent": ([0-9.]+)')
+
+
+def get_synthetic_registry():
+    """
+    :return: MetricRegistry with the metrics of the synthetic stream
+    """
+    return MetricRegistry(
+        MetricDefinition(field, topic, field, timestamp_field=TIMESTAMP_FIELD)
+        for topic, field in SYNTHETIC_METRICS
+    )
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+def synthetic_messages(
+    rate,
+    duration,
+    burst_size=1,
+    malformed_ratio=0.0,
+    out_of_order_ratio=0.0,
+    seed=0,
+):
+    """
+    Generate synthetic message stream.
+    :param rate: average number of messages per second
+    :param duration: duration of the stream in seconds
+    :param burst_size: number of messages sent at once
+    :param malformed_ratio: fraction of payloads that are not valid JSON
+    :param out_of_order_ratio: fraction of payloads with timestamp older
+    than the previous one
+    :param seed: random seed
+    :return: generator of (time since the start, topic, payload) tuples,
+    the payload without the SENT_FIELD
+    """
+    rnd = random.Random(seed)
+    interval = burst_size / rate
+    start = time.time()
+    topics = sorted({topic for topic, _ in SYNTHETIC_METRICS})
+    index = 0
+    for burst in range(int(duration / interval)):
+        offset = burst * interval
+        for _ in range(burst_size):
+            topic = topics[index % len(topics)]
+            timestamp = start + offset
+            if rnd.random() < out_of_order_ratio:
+                timestamp -= rnd.uniform(1, 600)
+            payload = {
+                field: round(rnd.uniform(0, 1000), 1)
+                for metric_topic, field in SYNTHETIC_METRICS
+                if metric_topic == topic
+            }
+            payload[TIMESTAMP_FIELD] = timestamp
+            text = json.dumps(payload)
+            if rnd.random() < malformed_ratio:
+                truncated = len(text) // 2
+                text = text[:truncated]
+            yield offset, topic, text
+            index += 1
+
+
+def recorded_messages(path):
+    """
+    :param path: JSON lines file with the "time", "topic" and "payload" keys
+    :return: generator of (time since the start, topic, payload) tuples
+    """
+    with open(path, encoding="utf-8") as record_file:
+        for line in record_file:
+            if line.strip():
+                item = json.loads(line)
+                yield item["time"], item["topic"], item["payload"]
+
+
+def add_sent_time(payload, sent):
+    """
+    :param payload: payload text, the JSON object might be malformed
+    :param sent: monotonic time
+    :return: payload with the SENT_FIELD inserted as the first field of the object
+    """
+    if payload.startswith("{"):
+        rest = payload.removeprefix("{").lstrip()
+        separator = ", " if rest and not rest.startswith("}") else ""
+        return f'{{"{SENT_FIELD}": {sent!r}{separator}{rest}'
+    return payload
+
+
+def get_messages(source):
+    """
+    :param source: tuple of "recorded" and the file path,
+    or "synthetic" and dictionary with the synthetic_messages() arguments
+    :return: generator of (time since the start, topic, payload) tuples
+    """
+    kind, params = source
+    if kind == "recorded":
+        return recorded_messages(params)
+    return synthetic_messages(**params)
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def publish_messages(port_queue, start_event, done_event, stop_event, source, args):
+    """
+    Run the broker and publish the messages once the start event is set.
+    Runs in a separate process so that its CPU time and memory is not accounted
+    for in the statistics.
+    :param port_queue: queue to send the port of the broker to
+    :param start_event: event to wait for before publishing
+    :param done_event: event to set once all the messages are published
+    :param stop_event: event to wait for before stopping the broker
+    :param source: message source description, see get_messages()
+    :param args: dictionary with the "speed" (time multiplier), "qos" and
+    "disconnect_interval" (seconds, 0 to never disconnect) keys
+    """
+    with LocalBroker() as broker:
+        port_queue.put(broker.port)
+        start_event.wait()
+
+        start = time.monotonic()
+        last_disconnect = start
+        for offset, topic, payload in get_messages(source):
+            delay = start + offset / args["speed"] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.monotonic()
+            disconnect_due = now - last_disconnect > args["disconnect_interval"]
+            if args["disconnect_interval"] and disconnect_due:
+                broker.disconnect_clients()
+                last_disconnect = now
+            broker.publish(topic, add_sent_time(payload, now), qos=args["qos"])
+        done_event.set()
+        stop_event.wait()
+
+
+def get_rss():
+    """
+    :return: current resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_cpu_time():
+    """
+    :return: CPU time of the process in seconds
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+# pylint: disable=too-many-instance-attributes
+class LatencyProbe:
+    """
+    Read the metrics as soon as they are updated and compute the latency
+    of the messages that were read.
+    """
+
+    def __init__(self, metrics):
+        """
+        :param metrics: Metrics object
+        """
+        self.metrics = metrics
+        # Bounded memory even for long runs.
+        self.latency = Histogram()
+        self.max_latency = 0
+        self.reads = 0
+        self.start_cpu = get_cpu_time()
+        self.start_rss = get_rss()
+        self.start_time = time.monotonic()
+
+    def read(self, timeout):
+        """
+        Wait for update and read the metrics.
+        :param timeout: timeout in seconds
+        :return: True if the metrics were updated, False on timeout
+        """
+        if not self.metrics.update_event.wait(timeout):
+            return False
+        self.metrics.update_event.clear()
+
+        with self.metrics.lock:
+            pending = [message for message, _ in self.metrics.payloads.values()]
+        self.metrics.get_metrics()
+        now = time.monotonic()
+        self.reads += 1
+        for message in pending:
+            match = SENT_RE.search(message)
+            if match:
+                latency = now - float(match.group(1))
+                self.latency.observe(latency)
+                self.max_latency = max(self.max_latency, latency)
+        return True
+
+    def report(self):
+        """
+        :return: dictionary with the statistics so far
+        """
+        metrics = self.metrics
+        result = {
+            "elapsed": time.monotonic() - self.start_time,
+            "messages": metrics.updates,
+            "decoded": metrics.decoded_payloads,
+            "reads": self.reads,
+            "connected": metrics.is_connected(),
+            "cpu_seconds": get_cpu_time() - self.start_cpu,
+            "rss_bytes": get_rss(),
+            "rss_growth_bytes": get_rss() - self.start_rss,
+        }
+        if self.latency.count:
+            result["latency"] = {
+                "count": self.latency.count,
+                "mean": self.latency.sum / self.latency.count,
+                "median": self.latency.quantile(0.5),
+                "p95": self.latency.quantile(0.95),
+                "max": self.max_latency,
+            }
+        if tracemalloc.is_tracing():
+            result["traced_bytes"], result["traced_peak_bytes"] = (
+                tracemalloc.get_traced_memory()
+            )
+        return result
+
+
+def replay(source, registry, speed=1.0, qos=0, disconnect_interval=0, **kwargs):
+    """
+    Replay the messages to Metrics connected to local broker.
+    :param source: message source description, see get_messages()
+    :param registry: MetricRegistry object
+    :param speed: time multiplier of the message stream
+    :param qos: QoS of the messages and the subscriptions
+    :param disconnect_interval: interval in seconds of disconnecting the client
+    by the broker, 0 to never disconnect
+    :param kwargs: "report_interval" (seconds) and "report" (function called
+    with the intermediate statistics)
+    :return: dictionary with the statistics
+    """
+    report_interval = kwargs.get("report_interval", 0)
+    report = kwargs.get("report")
+
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    start_event = context.Event()
+    done_event = context.Event()
+    stop_event = context.Event()
+    publisher = context.Process(
+        target=publish_messages,
+        args=(
+            port_queue,
+            start_event,
+            done_event,
+            stop_event,
+            source,
+            {"speed": speed, "qos": qos, "disconnect_interval": disconnect_interval},
+        ),
+        name="publisher",
+        daemon=True,
+    )
+    publisher.start()
+    metrics = None
+    try:
+        port = port_queue.get(timeout=30)
+        metrics = Metrics("127.0.0.1", port, 3600, registry, background=True, qos=qos)
+        probe = LatencyProbe(metrics)
+        start_event.set()
+
+        last_report = time.monotonic()
+        while not done_event.is_set():
+            probe.read(0.1)
+            report_due = time.monotonic() - last_report >= report_interval
+            if report and report_interval and report_due:
+                report(probe.report())
+                last_report = time.monotonic()
+        # Pick up the last messages, until there is none for a while.
+        while probe.read(1):
+            pass
+
+        return probe.report()
+    finally:
+        if metrics is not None:
+            metrics.stop()
+        stop_event.set()
+        publisher.join(5)
+        if publisher.is_alive():
+            publisher.terminate()
+
+
+class Recorder(Metrics):
+    """
+    Record the messages on the topics of the metrics to JSON lines file.
+    """
+
+    def __init__(self, hostname, port, registry, path):
+        """
+        :param hostname: MQTT broker hostname
+        :param port: MQTT broker port
+        :param registry: MetricRegistry object with the topics to record
+        :param path: path to the file to write
+        """
+        # pylint: disable=consider-using-with
+        self.record_file = open(path, "w", encoding="utf-8")
+        self.record_start = time.monotonic()
+        super().__init__(hostname, port, 3600, registry, background=True)
+
+    def create_client(self, hostname, port):
+        """
+        :return: MQTT client object recording the messages
+        """
+        client = super().create_client(hostname, port)
+        client.on_message = self.record
+        return client
+
+    # pylint: disable=unused-argument
+    def record(self, client, topic, message):
+        """
+        Write the message to the file.
+        """
+        item = {
+            "time": time.monotonic() - self.record_start,
+            "topic": topic,
+            "payload": message,
+        }
+        self.record_file.write(json.dumps(item) + "\n")
+        self.record_file.flush()
+        self.updates += 1
+
+    def stop(self):
+        super().stop()
+        self.record_file.close()
+
+
+# pylint: disable=too-many-locals
+def main():
+    """
+    Replay the messages or record them.
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--input", help="JSON lines file with recorded messages")
+    parser.add_argument(
+        "--metrics_config",
+        help="JSON file with the metric definitions, for the recorded messages",
+    )
+    parser.add_argument("--rate", help="synthetic messages per second", type=float)
+    parser.add_argument(
+        "--duration", help="synthetic stream duration in seconds", type=float
+    )
+    parser.add_argument("--burst_size", help="messages sent at once", type=int)
+    parser.add_argument("--malformed_ratio", help="fraction of bad JSON", type=float)
+    parser.add_argument(
+        "--out_of_order_ratio",
+        help="fraction of payloads with timestamp going back in time",
+        type=float,
+    )
+    parser.add_argument("--speed", help="time multiplier", type=float, default=1.0)
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0)
+    parser.add_argument(
+        "--disconnect_interval",
+        help="disconnect the client every this many seconds, 0 never",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--report_interval",
+        help="print intermediate statistics every this many seconds",
+        type=float,
+        default=60,
+    )
+    parser.add_argument(
+        "--tracemalloc", help="trace Python memory allocations", action="store_true"
+    )
+    parser.add_argument("--output", help="JSON file to write the final statistics")
+    parser.add_argument(
+        "--record",
+        help="instead of replaying, record messages from the broker "
+        "given by --hostname to this file for --duration seconds",
+    )
+    parser.add_argument("--hostname", help="MQTT broker to record from")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    registry = (
+        load_registry(args.metrics_config)
+        if args.metrics_config
+        else get_synthetic_registry()
+    )
+
+    if args.record:
+        if not args.hostname or not args.duration:
+            parser.error("--record requires --hostname and --duration")
+        recorder = Recorder(args.hostname, args.port, registry, args.record)
+        time.sleep(args.duration)
+        recorder.stop()
+        print(f"Recorded {recorder.updates} messages to {args.record}")
+        return
+
+    if args.input:
+        source = ("recorded", args.input)
+    else:
+        source = (
+            "synthetic",
+            {
+                "rate": args.rate or 10,
+                "duration": args.duration or 60,
+                "burst_size": args.burst_size or 1,
+                "malformed_ratio": args.malformed_ratio or 0,
+                "out_of_order_ratio": args.out_of_order_ratio or 0,
+            },
+        )
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    def report(stats):
+        print(json.dumps(stats), flush=True)
+
+    result = replay(
+        source,
+        registry,
+        speed=args.speed,
+        qos=args.qos,
+        disconnect_interval=args.disconnect_interval,
+        report_interval=args.report_interval,
+        report=report,
+    )
+    report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(result, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,23 @@ import sys
 import time
 
 from cli import parse_args
-from display import get_e_ink_display
-from loop_cond import CondInfinite, FormalCondInterface
+from display import DisplayWorker, SimulatedDisplay, get_e_ink_display
+from instrumentation import StatsExporter
+from loop_cond import CondInfinite, CondLimit, FormalCondInterface
+from loop_profiler import Profiler
+from metric_registry import get_default_registry, load_registry
 from metrics import Metrics
 from metrics_drawer import MetricsDrawer
+from metrics_log import MetricsLog
+from scheduler import RedrawScheduler
+
+# Image size for the output file, the same as of the 2.13" HD Tri-color or mono display
+DISPLAY_WIDTH = 250
+DISPLAY_HEIGHT = 122
+
+# History windows of the sparklines and of the minimum and maximum drawn with --trends.
+TREND_WINDOW = "hour"
+EXTREMES_WINDOW = "day"
 
 
 def main():
@@ -25,28 +38,35 @@ def main():
     logger = logging.getLogger(__name__)
     logger.setLevel(args.loglevel)
 
-    # 2.13" HD Tri-color or mono display
-    display_height = 122
-    display_width = 250
+    registry = get_registry(args)
+    logger.debug(f"Metrics: {list(registry)}")
 
-    metrics = Metrics(
-        args.hostname,
-        args.port,
-        args.metric_timeout,
-        args.temp_sensor_topic,
-        args.temp_sensor_name,
-        args.co2_sensor_topic,
-        args.co2_sensor_name,
-        args.pressure_sensor_topic,
-        args.pressure_sensor_name,
-    )
+    metrics = get_metrics(args, registry)
+
+    profiler = get_profiler(args)
+    cond = get_cond(args, profiler)
+
+    if args.asyncio:
+        run_async(args, metrics, cond, profiler)
+        return
+
+    try:
+        run_sync(args, metrics, cond, profiler)
+    finally:
+        metrics.stop()
+
+
+def run_sync(args, metrics, cond, profiler):
+    """
+    Wait for the metrics and either draw them to the output file
+    or run the main loop to update the display.
+    :param args: parsed command line arguments
+    :param metrics: Metrics object
+    :param cond: loop condition
+    :param profiler: Profiler object or None
+    """
+    logger = logging.getLogger(__name__)
 
-    drawer = MetricsDrawer(
-        display_width,
-        display_height,
-        args.medium_font,
-        args.large_font,
-    )
     #
     # Wait for the metrics to become available.
     # Repurpose the refresh timeout for this.
@@ -56,7 +76,7 @@ def main():
     for _ in range(0, args.timeout):
         data = metrics.get_metrics()
         logger.debug(f"Metrics: {data}")
-        if all(data):
+        if None not in data:
             break
         time.sleep(1)
     logger.info("Done waiting for the metrics")
@@ -64,27 +84,269 @@ def main():
         logger.warning(f"Some metrics are missing: {data}")
 
     if args.output:
-        image = drawer.draw_image(*data)
+        drawer = get_drawer(
+            args, DISPLAY_WIDTH, DISPLAY_HEIGHT, "RGB", metrics.registry
+        )
+        image = draw_metrics(drawer, metrics, data, args.trends)
         image.save(args.output)
+        drawer.save_cache()
         return
 
     logger.debug("Getting display")
-    e_display = get_e_ink_display()
+    e_display = get_display(args)
     if e_display is None:
         logger.error("No display detected")
         sys.exit(1)
     logger.debug(f"Got e-display: {e_display.display}")
-    drawer = MetricsDrawer(
-        e_display.width,
-        e_display.height,
+    if args.display_thread:
+        e_display = DisplayWorker(e_display)
+    drawer = get_drawer(args, e_display.width, e_display.height, "1", metrics.registry)
+
+    loop_args = (cond, args.timeout, drawer, e_display, metrics)
+    loop_kwargs = {
+        "partial": args.partial_refresh > 0,
+        "scheduler": get_scheduler(args, metrics.registry),
+        "exporter": get_exporter(args, metrics),
+        "trends": args.trends,
+    }
+    try:
+        if profiler is not None:
+            profiler.run(loop, *loop_args, **loop_kwargs)
+        else:
+            loop(*loop_args, **loop_kwargs)
+    finally:
+        drawer.save_cache()
+        if args.display_thread:
+            # Display the last frame and stop the worker even if the loop failed.
+            e_display.stop()
+
+
+def get_registry(args):
+    """
+    :param args: parsed command line arguments
+    :return: MetricRegistry object
+    """
+    if args.metrics_config:
+        return load_registry(args.metrics_config)
+
+    return get_default_registry(
+        args.temp_sensor_topic,
+        args.temp_sensor_name,
+        args.co2_sensor_topic,
+        args.co2_sensor_name,
+        args.pressure_sensor_topic,
+        args.pressure_sensor_name,
+        thresholds=args.change_thresholds,
+        timestamp_field=args.timestamp_field,
+    )
+
+
+def get_metrics(args, registry):
+    """
+    :param args: parsed command line arguments
+    :param registry: MetricRegistry object
+    :return: Metrics object, AsyncMetrics object with --asyncio
+    """
+    metrics_class = Metrics
+    if args.asyncio:
+        # asyncio is slow to import so it is imported only when used.
+        # pylint: disable=import-outside-toplevel
+        from async_metrics import AsyncMetrics
+
+        metrics_class = AsyncMetrics
+
+    return metrics_class(
+        args.hostname,
+        args.port,
+        args.metric_timeout,
+        registry,
+        background=args.mqtt_thread,
+        state_file=args.state_file,
+        qos=args.qos,
+        clean_session=not args.persistent_session,
+        client_id=args.client_id,
+        metrics_log=get_metrics_log(args, registry),
+        history=args.trends,
+    )
+
+
+def get_metrics_log(args, registry):
+    """
+    :param args: parsed command line arguments
+    :param registry: MetricRegistry object
+    :return: MetricsLog object or None
+    """
+    if not args.metrics_log:
+        return None
+
+    return MetricsLog(
+        args.metrics_log,
+        [definition.name for definition in registry],
+        max_segments=args.metrics_log_segments,
+    )
+
+
+def run_async(args, metrics, cond, profiler):
+    """
+    Run async_main() in asyncio event loop.
+    :param args: parsed command line arguments
+    :param metrics: AsyncMetrics object
+    :param cond: loop condition
+    :param profiler: Profiler object or None
+    """
+    # pylint: disable=import-outside-toplevel
+    import asyncio
+
+    if profiler is not None:
+        profiler.run(asyncio.run, async_main(args, metrics, cond))
+    else:
+        asyncio.run(async_main(args, metrics, cond))
+
+
+def get_display(args):
+    """
+    :param args: parsed command line arguments
+    :return: Display object or None
+    """
+    if args.simulated_display:
+        return SimulatedDisplay(
+            DISPLAY_WIDTH,
+            DISPLAY_HEIGHT,
+            full_refresh_interval=args.partial_refresh,
+            realtime=True,
+            record=False,
+        )
+
+    return get_e_ink_display(full_refresh_interval=args.partial_refresh)
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def get_drawer(args, width, height, default_mode, registry):
+    """
+    :param args: parsed command line arguments
+    :param width: image width in pixels
+    :param height: image height in pixels
+    :param default_mode: PIL image mode to use unless specified on the command line
+    :param registry: MetricRegistry object
+    :return: MetricsDrawer object
+    """
+    return MetricsDrawer(
+        width,
+        height,
         args.medium_font,
         args.large_font,
+        mode=args.image_mode or default_mode,
+        definitions=registry,
+        cache_path=args.font_cache,
     )
 
-    loop(CondInfinite(), args.timeout, drawer, e_display, metrics)
 
+def get_scheduler(args, registry):
+    """
+    :param args: parsed command line arguments
+    :param registry: MetricRegistry object
+    :return: RedrawScheduler object or None
+    """
+    if not args.redraw_on_change:
+        return None
 
-def loop(cond, timeout, drawer, e_display, metrics):
+    return RedrawScheduler(
+        min(args.min_refresh_interval, args.timeout),
+        args.timeout,
+        [definition.threshold for definition in registry],
+    )
+
+
+def get_exporter(args, metrics):
+    """
+    :param args: parsed command line arguments
+    :param metrics: Metrics object
+    :return: StatsExporter object or None
+    """
+    if not args.stats_file and not args.stats_topic:
+        return None
+
+    return StatsExporter(path=args.stats_file, metrics=metrics, topic=args.stats_topic)
+
+
+def get_profiler(args):
+    """
+    :param args: parsed command line arguments
+    :return: Profiler object or None
+    """
+    if not args.profile:
+        return None
+
+    return Profiler(
+        args.profile,
+        deterministic=args.profiler in ["cprofile", "both"],
+        sampling=args.profiler in ["sampling", "both"],
+        interval=args.profile_interval,
+        memory=args.tracemalloc,
+    )
+
+
+def get_cond(args, profiler):
+    """
+    :param args: parsed command line arguments
+    :param profiler: Profiler object or None
+    :return: object implementing FormalCondInterface for the main loop,
+    limited to the number of profiled iterations when profiling
+    """
+    if profiler is None:
+        return CondInfinite()
+
+    return profiler.wrap_cond(CondLimit(args.profile_iterations))
+
+
+def draw_metrics(drawer, metrics, data, trends=False):
+    """
+    :param drawer: MetricsDrawer object
+    :param metrics: Metrics object
+    :param data: tuple of metric values
+    :param trends: whether to draw the history of the metrics
+    :return: the image
+    """
+    offline = not metrics.is_connected()
+    if not trends:
+        return drawer.draw_image(*data, offline=offline)
+
+    return drawer.draw_image(
+        *data,
+        offline=offline,
+        trends=metrics.get_history_ranges(TREND_WINDOW),
+        extremes=metrics.get_history_stats(EXTREMES_WINDOW),
+    )
+
+
+def get_deadline(scheduler, metrics, now):
+    """
+    :param scheduler: RedrawScheduler object
+    :param metrics: Metrics object
+    :param now: monotonic time
+    :return: monotonic time by which to check whether to redraw the display
+    """
+    deadline = scheduler.next_deadline(now)
+    # Expiry of a value changes what is displayed.
+    expiry = metrics.next_expiry()
+    if expiry is not None:
+        deadline = min(deadline, max(expiry, now))
+
+    return deadline
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+def loop(
+    cond,
+    timeout,
+    drawer,
+    e_display,
+    metrics,
+    partial=False,
+    scheduler=None,
+    exporter=None,
+    trends=False,
+):
     """
     conditional loop that retrieves the metrics and updates the display.
     :param cond: object implementing FormalCondInterface
@@ -92,6 +354,12 @@ def loop(cond, timeout, drawer, e_display, metrics):
     :param drawer: MetricsDrawer object
     :param e_display: display object
     :param metrics: Metrics object
+    :param partial: whether to refresh only the changed regions of the display
+    :param scheduler: optional RedrawScheduler object. If set, the display is redrawn
+    as decided by the scheduler rather than every timeout seconds.
+    :param exporter: optional StatsExporter object to export the timings
+    after each redraw
+    :param trends: whether to draw the history of the metrics
     """
     logger = logging.getLogger(__name__)
 
@@ -102,14 +370,220 @@ def loop(cond, timeout, drawer, e_display, metrics):
         data = metrics.get_metrics()
         logger.debug(f"Metrics: {data}")
         now = time.monotonic()
-        if redraw_ts == 0 or now - redraw_ts > timeout:
+        if scheduler is not None:
+            redraw = scheduler.should_redraw(data, now)
+        else:
+            redraw = redraw_ts == 0 or now - redraw_ts > timeout
+        if redraw:
             logger.info("Drawing image")
-            image = drawer.draw_image(*data)
-            e_display.update(image)
+            image = draw_metrics(drawer, metrics, data, trends)
+            if partial:
+                e_display.update(image, drawer.dirty_rects)
+            else:
+                e_display.update(image)
             redraw_ts = now
+            if scheduler is not None:
+                scheduler.redrawn(data, now)
+            if exporter is not None:
+                exporter.export()
+
+        if scheduler is not None:
+            delay = max(get_deadline(scheduler, metrics, now) - time.monotonic(), 0)
+            logger.debug(f"Sleeping for up to {delay} seconds")
+            metrics.sleep(delay)
+        else:
+            logger.debug(f"Sleeping for {timeout} seconds")
+            # Keep processing the MQTT traffic so that every message gets
+            # to the history and to the metrics log, not only the ones
+            # received right before the redraw.
+            deadline = now + timeout
+            while time.monotonic() < deadline:
+                metrics.sleep(deadline - time.monotonic())
+
+
+async def async_main(args, metrics, cond=None):
+    """
+    asyncio variant of the main function, after the metrics are created.
+    :param args: parsed command line arguments
+    :param metrics: AsyncMetrics object
+    :param cond: object implementing FormalCondInterface for the main loop,
+    infinite loop by default
+    """
+    logger = logging.getLogger(__name__)
+
+    metrics.start()
+    try:
+        #
+        # Wait for the metrics to become available.
+        # Repurpose the refresh timeout for this.
+        #
+        logger.info("Waiting for the metrics")
+        deadline = time.monotonic() + args.timeout
+        data = metrics.get_metrics()
+        while None in data and time.monotonic() < deadline:
+            await metrics.wait_for_update(deadline - time.monotonic())
+            data = metrics.get_metrics()
+            logger.debug(f"Metrics: {data}")
+        logger.info("Done waiting for the metrics")
+        if None in data:
+            logger.warning(f"Some metrics are missing: {data}")
+
+        if args.output:
+            drawer = get_drawer(
+                args, DISPLAY_WIDTH, DISPLAY_HEIGHT, "RGB", metrics.registry
+            )
+            image = draw_metrics(drawer, metrics, data, args.trends)
+            image.save(args.output)
+            drawer.save_cache()
+            return
+
+        logger.debug("Getting display")
+        e_display = get_display(args)
+        if e_display is None:
+            logger.error("No display detected")
+            sys.exit(1)
+        logger.debug(f"Got e-display: {e_display.display}")
+        drawer = get_drawer(
+            args, e_display.width, e_display.height, "1", metrics.registry
+        )
+
+        try:
+            await async_loop(
+                cond if cond is not None else CondInfinite(),
+                args.timeout,
+                drawer,
+                e_display,
+                metrics,
+                partial=args.partial_refresh > 0,
+                scheduler=get_scheduler(args, metrics.registry),
+                exporter=get_exporter(args, metrics),
+                trends=args.trends,
+            )
+        finally:
+            drawer.save_cache()
+    finally:
+        metrics.stop()
+
+
+async def display_frames(frames, e_display):
+    """
+    Push the frames from the queue to the display. The refresh is blocking
+    so it is performed in a worker thread.
+    :param frames: asyncio.Queue with (image, windows) tuples
+    :param e_display: display object
+    """
+    # pylint: disable=import-outside-toplevel
+    import asyncio
+
+    while True:
+        image, windows = await frames.get()
+        try:
+            if windows is None:
+                await asyncio.to_thread(e_display.update, image)
+            else:
+                await asyncio.to_thread(e_display.update, image, windows)
+        finally:
+            frames.task_done()
+
+
+async def wait_for_redraw(scheduler, metrics):
+    """
+    Wait until the scheduler decides to redraw the display.
+    :param scheduler: RedrawScheduler object
+    :param metrics: AsyncMetrics object
+    """
+    logger = logging.getLogger(__name__)
+
+    while True:
+        now = time.monotonic()
+        data = metrics.get_metrics()
+        if scheduler.should_redraw(data, now):
+            return
+
+        delay = max(scheduler.next_deadline(now) - now, 0)
+        logger.debug(f"Waiting for up to {delay} seconds")
+        await metrics.wait_for_update(delay)
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+async def async_loop(
+    cond,
+    timeout,
+    drawer,
+    e_display,
+    metrics,
+    partial=False,
+    scheduler=None,
+    exporter=None,
+    trends=False,
+):
+    """
+    asyncio variant of loop(). The image is drawn once the timeout elapses
+    and the display refresh is performed by a separate task, so that the event loop
+    stays responsive while the display is being refreshed.
+    :param cond: object implementing FormalCondInterface
+    :param timeout: timeout in seconds
+    :param drawer: MetricsDrawer object
+    :param e_display: display object
+    :param metrics: AsyncMetrics object
+    :param partial: whether to refresh only the changed regions of the display
+    :param scheduler: optional RedrawScheduler object. If set, the display is redrawn
+    as decided by the scheduler rather than every timeout seconds.
+    :param exporter: optional StatsExporter object to export the timings
+    after each redraw
+    :param trends: whether to draw the history of the metrics
+    """
+    # pylint: disable=import-outside-toplevel
+    import asyncio
+
+    logger = logging.getLogger(__name__)
+
+    assert isinstance(cond, FormalCondInterface)
+
+    # Holds the latest frame not yet pushed to the display.
+    frames = asyncio.Queue(maxsize=1)
+    display_task = asyncio.create_task(
+        display_frames(frames, e_display), name="display refresh"
+    )
+    try:
+        redraw_ts = 0
+        while cond.cond():
+            if scheduler is not None:
+                await wait_for_redraw(scheduler, metrics)
+            while redraw_ts != 0 and time.monotonic() - redraw_ts <= timeout:
+                remaining = redraw_ts + timeout - time.monotonic()
+                if await metrics.wait_for_update(max(remaining, 0)):
+                    logger.debug(f"Metrics updated: {metrics.get_metrics()}")
+
+            if display_task.done():
+                # Propagate the exception from the display refresh.
+                display_task.result()
+
+            data = metrics.get_metrics()
+            logger.debug(f"Metrics: {data}")
+            logger.info("Drawing image")
+            image = draw_metrics(drawer, metrics, data, trends)
+            windows = list(drawer.dirty_rects) if partial else None
+            if frames.full():
+                logger.warning("Display refresh in progress, dropping previous frame")
+                _, previous_windows = frames.get_nowait()
+                frames.task_done()
+                if windows is not None:
+                    windows = previous_windows + windows
+            # The drawer reuses the image so pass a copy.
+            frames.put_nowait((image.copy(), windows))
+            if scheduler is not None:
+                scheduler.redrawn(data, time.monotonic())
+            else:
+                redraw_ts = time.monotonic()
+            if exporter is not None:
+                exporter.export()
 
-        logger.debug(f"Sleeping for {timeout} seconds")
-        time.sleep(timeout)
+        await frames.join()
+        if display_task.done():
+            display_task.result()
+    finally:
+        display_task.cancel()
 
 
 if __name__ == "__main__":
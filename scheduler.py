@@ -0,0 +1,124 @@
+"""
+Redraw scheduling
+"""
+
+import logging
+import math
+from datetime import datetime, time, timedelta
+
+
+def to_number(value):
+    """
+    :param value: metric value, e.g. number or numeric string
+    :return: the value as float, or None if it is not a finite number
+    """
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+class RedrawScheduler:
+    """
+    Decide when to redraw the display: when some of the values changed significantly
+    since the last redraw, however not sooner than the minimum interval, or when
+    the maximum interval elapsed or the date changed.
+    """
+
+    def __init__(self, min_interval, max_interval, thresholds):
+        """
+        :param min_interval: minimum time between redraws in seconds
+        :param max_interval: maximum time between redraws in seconds
+        :param thresholds: sequence of minimum significant change, one for each value
+        """
+        if min_interval > max_interval:
+            raise ValueError(
+                "minimum interval must not be bigger than maximum interval"
+            )
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.thresholds = tuple(thresholds)
+
+        # Monotonic time, values and date of the last redraw.
+        self.redraw_ts = None
+        self.values = None
+        self.date = None
+
+    def changed(self, values):
+        """
+        :param values: sequence of values
+        :return: whether some of the values changed significantly since the last redraw
+        """
+        if self.values is None:
+            return True
+
+        for old, new, threshold in zip(self.values, values, self.thresholds):
+            old_number = to_number(old)
+            new_number = to_number(new)
+            if old_number is not None and new_number is not None:
+                if abs(new_number - old_number) >= threshold:
+                    return True
+            elif old != new:
+                # Values that are not numbers (e.g. status strings or None)
+                # change whenever they differ.
+                return True
+
+        return False
+
+    def should_redraw(self, values, now):
+        """
+        :param values: sequence of values to display
+        :param now: monotonic time
+        :return: whether the display should be redrawn
+        """
+        logger = logging.getLogger(__name__)
+
+        if self.redraw_ts is None:
+            return True
+
+        elapsed = now - self.redraw_ts
+        if elapsed < self.min_interval:
+            return False
+        if elapsed >= self.max_interval:
+            logger.debug(f"{elapsed} seconds since last redraw")
+            return True
+        if datetime.now().date() != self.date:
+            logger.debug("date changed")
+            return True
+        if self.changed(values):
+            logger.debug(f"values changed: {self.values} -> {values}")
+            return True
+
+        return False
+
+    def redrawn(self, values, now):
+        """
+        Record the redraw.
+        :param values: sequence of displayed values
+        :param now: monotonic time
+        """
+        self.redraw_ts = now
+        self.values = tuple(values)
+        self.date = datetime.now().date()
+
+    def next_deadline(self, now):
+        """
+        Until the returned time, only changes of the values can trigger redraw.
+        :param now: monotonic time
+        :return: monotonic time by which should_redraw() should be called again
+        """
+        if self.redraw_ts is None:
+            return now
+
+        earliest = self.redraw_ts + self.min_interval
+        if now < earliest:
+            return earliest
+
+        wall_now = datetime.now()
+        midnight = datetime.combine(wall_now.date() + timedelta(days=1), time.min)
+        date_change = now + (midnight - wall_now).total_seconds()
+        return max(min(self.redraw_ts + self.max_interval, date_change), earliest)
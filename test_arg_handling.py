@@ -43,3 +43,47 @@ def test_valid_timeout(timeout):
     """
     args = parse_args(["--timeout", str(timeout)] + required_options)
     assert args.timeout == timeout
+
+
+def test_metrics_config():
+    """
+    The sensor options should not be required with metrics config.
+    """
+    args = parse_args(["--hostname", "example.com", "--metrics_config", "foo.json"])
+    assert args.metrics_config == "foo.json"
+
+
+def test_missing_sensor_options():
+    """
+    The sensor options should be required without metrics config.
+    """
+    with pytest.raises(SystemExit):
+        parse_args(["--hostname", "example.com", "--temp_sensor_topic", "foo"])
+
+
+def test_persistent_session_client_id():
+    """
+    Persistent session should require client ID.
+    """
+    with pytest.raises(SystemExit):
+        parse_args(["--persistent_session"] + required_options)
+
+    options = ["--persistent_session", "--client_id", "display", "--qos", "1"]
+    args = parse_args(options + required_options)
+    assert args.persistent_session
+    assert args.qos == 1
+
+
+def test_profile_options():
+    """
+    Tracing memory allocations should require profiling.
+    """
+    with pytest.raises(SystemExit):
+        parse_args(["--tracemalloc"] + required_options)
+    with pytest.raises(SystemExit):
+        parse_args(["--profile", "out", "--profile_iterations", "0"] + required_options)
+
+    args = parse_args(["--profile", "out", "--tracemalloc"] + required_options)
+    assert args.profile == "out"
+    assert args.profile_iterations == 10
+    assert args.profiler == "both"
@@ -0,0 +1,34 @@
+"""
+Test the benchmark suite.
+"""
+
+from benchmark import compare, get_cases, run
+
+
+def test_run():
+    """
+    All the cases should run and produce the statistics.
+    """
+    results = run(get_cases(scale=0.01), repeat=1)
+
+    names = list(results["results"])
+    for prefix in ["draw_image/", "message_handler/", "pack_image/", "loop/"]:
+        assert any(name.startswith(prefix) for name in names)
+    for result in results["results"].values():
+        assert 0 < result["min"] <= result["median"] <= result["max"]
+
+
+def test_compare():
+    """
+    Only the cases slower than the tolerance allows should be reported.
+    """
+
+    def get_results(**medians):
+        return {
+            "results": {name: {"median": median} for name, median in medians.items()}
+        }
+
+    baseline = get_results(draw=1.0, pack=1.0, removed=1.0)
+    results = get_results(draw=1.1, pack=1.5, added=1.0)
+
+    assert compare(results, baseline, 0.2) == [("pack", 1.0, 1.5)]
@@ -0,0 +1,378 @@
+"""
+Test the display classes.
+"""
+
+import random
+import threading
+import unittest.mock
+
+import pytest
+from adafruit_epd.ssd1680 import Adafruit_SSD1680
+from PIL import Image
+
+from display import (
+    AdafruitDisplay,
+    Display,
+    DisplayWorker,
+    SimulatedDisplay,
+    native_window,
+    pack_image,
+)
+from metrics_drawer import MetricsDrawer
+
+MEDIUM_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+LARGE_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+
+class RecordingDisplay(Display):
+    """
+    Display that records the images pushed to it.
+    """
+
+    def __init__(self, width, height):
+        super().__init__(None, width, height)
+        self.refreshed = []
+
+    def refresh(self, image):
+        self.refreshed.append(image.copy())
+
+
+def test_identical_frame_skipped():
+    """
+    Pushing the same image twice should refresh the display only once.
+    """
+    display = RecordingDisplay(10, 10)
+    image = Image.new("1", (10, 10), 1)
+
+    assert display.update(image)
+    assert not display.update(image.copy())
+    assert len(display.refreshed) == 1
+    assert display.skipped_refreshes == 1
+
+
+def test_changed_frame_refreshed():
+    """
+    Changed image should always be pushed to the display.
+    """
+    display = RecordingDisplay(10, 10)
+    image = Image.new("1", (10, 10), 1)
+
+    assert display.update(image)
+    image.putpixel((5, 5), 0)
+    assert display.update(image)
+    assert len(display.refreshed) == 2
+    assert display.skipped_refreshes == 0
+
+
+def get_driver(rotation):
+    """
+    :param rotation: display rotation
+    :return: SSD1680 driver instance with mocked SPI and pins
+    """
+    driver = Adafruit_SSD1680(
+        122,
+        250,
+        unittest.mock.MagicMock(),
+        cs_pin=unittest.mock.MagicMock(),
+        dc_pin=unittest.mock.MagicMock(),
+        sramcs_pin=None,
+        rst_pin=None,
+        busy_pin=None,
+    )
+    driver.rotation = rotation
+    return driver
+
+
+def get_random_image(mode, width, height):
+    """
+    :return: image with random contents, including colors close to the thresholds
+    """
+    rnd = random.Random(42)
+    image = Image.new(mode, (width, height))
+    if mode == "RGB":
+        values = [0x00, 0x7F, 0x80, 0xFF]
+        data = [
+            tuple(rnd.choice(values) for _ in range(3)) for _ in range(width * height)
+        ]
+    elif mode == "L":
+        data = [rnd.choice([0x00, 0x7F, 0x80, 0xFF]) for _ in range(width * height)]
+    else:
+        data = [rnd.choice([0, 255]) for _ in range(width * height)]
+    image.putdata(data)
+    return image
+
+
+@pytest.mark.parametrize("rotation", [0, 1, 2, 3])
+@pytest.mark.parametrize("mode", ["1", "L", "RGB"])
+def test_framebuffer_packing(mode, rotation):
+    """
+    The packed framebuffer has to be bit identical to what the driver
+    produces by setting the pixels one by one.
+    :param mode: PIL image mode
+    :param rotation: display rotation
+    """
+    slow_driver = get_driver(rotation)
+    fast_driver = get_driver(rotation)
+    image = get_random_image(mode, slow_driver.width, slow_driver.height)
+
+    slow_driver.image(image if mode != "1" else image.convert("L"))
+    AdafruitDisplay(
+        fast_driver, fast_driver.width, fast_driver.height
+    ).load_framebuffer(image)
+
+    # pylint: disable=protected-access
+    assert fast_driver._buffer1 == slow_driver._buffer1
+    assert fast_driver._buffer2 == slow_driver._buffer2
+
+
+@pytest.mark.parametrize("rotation", [0, 1, 2, 3])
+def test_native_window(rotation):
+    """
+    The box converted to the framebuffer coordinates should cover
+    the same pixels as the box in the display coordinates.
+    :param rotation: display rotation
+    """
+    width, height = 122, 250
+    box = (10, 20, 50, 30) if rotation in {1, 3} else (20, 10, 30, 50)
+    image = Image.new(
+        "1", (height, width) if rotation in {1, 3} else (width, height), 1
+    )
+    image.paste(0, box)
+
+    black, _ = pack_image(image, width, height, rotation)
+    native = Image.frombytes("1", (128, height), black).crop((0, 0, width, height))
+    expected = native.point(lambda v: 255 - v).getbbox()
+    assert native_window(box, width, height, rotation) == expected
+
+
+def test_partial_refresh():
+    """
+    Only the changed regions should be refreshed, with periodic full refresh.
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    display = SimulatedDisplay(250, 122, full_refresh_interval=2)
+
+    for co2 in [400, 500, 600, 700]:
+        image = drawer.draw_image(21, co2, 1013)
+        assert display.update(image, drawer.dirty_rects)
+        assert display.panel.tobytes() == image.tobytes()
+
+    assert [kind for kind, _ in display.refreshes] == [
+        "full",
+        "partial",
+        "partial",
+        "full",
+    ]
+    _, windows = display.refreshes[1]
+    assert len(windows) == 1
+    assert windows[0][1] > 0
+
+
+def test_partial_refresh_disabled():
+    """
+    Without full refresh interval, the display should always be fully refreshed.
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    display = SimulatedDisplay(250, 122)
+
+    for co2 in [400, 500]:
+        display.update(drawer.draw_image(21, co2, 1013), drawer.dirty_rects)
+
+    assert [kind for kind, _ in display.refreshes] == ["full", "full"]
+
+
+def test_write_window():
+    """
+    The window sent to the display RAM should match the framebuffer contents.
+    """
+    driver = get_driver(1)
+    display = AdafruitDisplay(driver, driver.width, driver.height)
+    display.load_framebuffer(get_random_image("1", driver.width, driver.height))
+
+    with unittest.mock.patch.object(driver, "command") as command_mock:
+        display.write_window(0x24, (0, 8, 16, 24))
+
+    # Rows 0-15 of the framebuffer, columns 98-113 i.e. bytes 12-14.
+    command_mock.assert_any_call(0x44, bytearray([12, 14]))
+    command_mock.assert_any_call(0x45, bytearray([0, 0, 15, 0]))
+    # pylint: disable=protected-access
+    expected = bytearray()
+    for begin in range(12, 16 * 16, 16):
+        end = begin + 3
+        expected += driver._buffer1[begin:end]
+    command_mock.assert_any_call(0x24, expected)
+
+
+class BlockingDisplay(SimulatedDisplay):
+    """
+    Simulated display with the refresh blocked until released, like the display
+    waiting on the busy pin.
+    """
+
+    def __init__(self, width, height, full_refresh_interval=0):
+        super().__init__(width, height, full_refresh_interval=full_refresh_interval)
+        self.started = threading.Semaphore(0)
+        self.release = threading.Semaphore(0)
+        self.refreshed = []
+
+    def update(self, image, windows=None):
+        # pylint: disable=consider-using-with
+        self.started.release()
+        assert self.release.acquire(timeout=5)
+        self.refreshed.append(image.getpixel((0, 0)))
+        return super().update(image, windows)
+
+
+def test_display_worker_drops_intermediate_frames():
+    """
+    The frames submitted while the refresh is in progress should be replaced
+    by the latest one, without blocking the caller.
+    """
+    # pylint: disable=consider-using-with
+    display = BlockingDisplay(10, 10)
+    worker = DisplayWorker(display)
+    image = Image.new("L", (10, 10), 0)
+
+    assert worker.update(image)
+    assert display.started.acquire(timeout=5)
+    for color in [1, 2, 3]:
+        image.putpixel((0, 0), color)
+        assert worker.update(image)
+    # The image was copied so changing it does not affect the pending frame.
+    image.putpixel((0, 0), 4)
+
+    display.release.release()
+    display.release.release()
+    assert worker.flush(timeout=5)
+    worker.stop()
+
+    assert display.refreshed == [0, 3]
+    stats = worker.get_stats()
+    assert stats["submitted"] == 4
+    assert stats["dropped"] == 2
+    assert stats["displayed"] == 2
+    assert stats["max_queue_age"] >= stats["last_queue_age"] > 0
+    assert stats["max_refresh_duration"] >= stats["last_refresh_duration"] > 0
+
+
+def test_display_worker_merges_windows():
+    """
+    Dropping a frame should not lose the regions it changed.
+    """
+    # pylint: disable=consider-using-with
+    display = BlockingDisplay(10, 10, full_refresh_interval=10)
+    worker = DisplayWorker(display)
+    image = Image.new("1", (10, 10), 1)
+
+    worker.update(image)
+    assert display.started.acquire(timeout=5)
+    image.putpixel((1, 1), 0)
+    worker.update(image, [(0, 0, 2, 2)])
+    image.putpixel((8, 8), 0)
+    worker.update(image, [(8, 8, 10, 10)])
+
+    display.release.release()
+    display.release.release()
+    worker.stop()
+
+    assert display.refreshes[-1] == ("partial", [(0, 0, 2, 2), (8, 8, 10, 10)])
+    assert display.panel.tobytes() == image.tobytes()
+
+
+def test_display_worker_error():
+    """
+    The exception from the refresh should be raised to the caller on the next update.
+    """
+    display = SimulatedDisplay(10, 10)
+    worker = DisplayWorker(display)
+    image = Image.new("1", (10, 10), 1)
+
+    with unittest.mock.patch.object(
+        display, "refresh", side_effect=OSError("SPI failure")
+    ):
+        worker.update(image)
+        assert worker.flush(timeout=5)
+
+    with pytest.raises(OSError):
+        worker.update(image)
+    worker.update(image)
+    worker.stop()
+    assert display.panel is not None
+
+
+def test_display_worker_error_on_stop():
+    """
+    The exception from the last refresh should be raised by stop() rather than lost.
+    """
+    display = SimulatedDisplay(10, 10)
+    worker = DisplayWorker(display)
+    image = Image.new("1", (10, 10), 1)
+
+    with unittest.mock.patch.object(
+        display, "refresh", side_effect=OSError("SPI failure")
+    ):
+        worker.update(image)
+        with pytest.raises(OSError):
+            worker.stop()
+    assert not worker.thread.is_alive()
+    # The error is raised only once.
+    worker.stop()
+
+
+@pytest.mark.parametrize("rotation", [0, 1])
+def test_simulated_display_ram(rotation):
+    """
+    The RAM of the simulated display should hold the packed image after full
+    as well as partial refresh.
+    """
+    display = SimulatedDisplay(
+        250, 122, full_refresh_interval=2, rotation=rotation, record=False
+    )
+    ram_width, ram_height = (122, 250) if rotation else (250, 122)
+    image = get_random_image("1", 250, 122)
+
+    display.update(image)
+    black, _ = pack_image(image, ram_width, ram_height, rotation)
+    assert display.black_ram == black
+    assert display.red_ram == black
+
+    window = (40, 16, 80, 48)
+    image.paste(get_random_image("1", 40, 32), window[:2])
+    display.update(image, [window])
+    black, _ = pack_image(image, ram_width, ram_height, rotation)
+    assert display.black_ram == black
+    assert display.red_ram == black
+    assert display.panel.tobytes() == image.tobytes()
+    assert not display.refreshes
+    assert not display.frames
+
+
+def test_simulated_display_timing():
+    """
+    The modeled time should account for the data sent over SPI and the refresh.
+    """
+    timing = {
+        "spi_baudrate": 8000,
+        "power_up": 0,
+        "full_refresh": 2,
+        "partial_refresh": 0.5,
+    }
+    display = SimulatedDisplay(16, 8, full_refresh_interval=1, timing=timing)
+    image = Image.new("1", (16, 8), 1)
+
+    display.update(image)
+    image.putpixel((0, 0), 0)
+    display.update(image, [(0, 0, 1, 1)])
+
+    # B/W, RED and again RED RAM of 16 rows of 1 byte (rotated),
+    # then the byte with the pixel to both the B/W and RED RAM.
+    full_bytes = 16 * 3
+    window_bytes = 2
+    assert [kind for kind, _ in display.refreshes] == ["full", "partial"]
+    assert [(transfer, busy) for _, transfer, busy in display.frames] == [
+        (full_bytes / 1000, 2),
+        (window_bytes / 1000, 0.5),
+    ]
+    assert display.frames[1][0].getpixel((0, 0)) == 0
+    assert display.transfer_time == (full_bytes + window_bytes) / 1000
+    assert display.busy_time == 2.5
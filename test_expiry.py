@@ -0,0 +1,61 @@
+"""
+Test the expiry heap.
+"""
+
+from expiry import ExpiryHeap
+
+
+def test_expiry_order():
+    """
+    Names should expire in the order of their deadlines.
+    """
+    heap = ExpiryHeap()
+    heap.schedule("a", 30)
+    heap.schedule("b", 10)
+    heap.schedule("c", 20)
+
+    assert heap.next_expiry() == 10
+    assert not heap.pop_expired(10)
+    assert heap.pop_expired(25) == ["b", "c"]
+    assert heap.next_expiry() == 30
+    assert len(heap) == 1
+
+
+def test_reschedule():
+    """
+    Rescheduling should supersede the previous deadline.
+    """
+    heap = ExpiryHeap()
+    heap.schedule("a", 10)
+    heap.schedule("b", 20)
+    heap.schedule("a", 30)
+
+    assert heap.next_expiry() == 20
+    assert heap.pop_expired(25) == ["b"]
+    assert heap.pop_expired(35) == ["a"]
+    assert heap.next_expiry() is None
+
+
+def test_cancel():
+    """
+    Cancelled names should not expire.
+    """
+    heap = ExpiryHeap()
+    heap.schedule("a", 10)
+    heap.cancel("a")
+
+    assert heap.next_expiry() is None
+    assert not heap.pop_expired(20)
+
+
+def test_compaction():
+    """
+    Frequent rescheduling should not grow the heap without bounds.
+    """
+    heap = ExpiryHeap()
+    for i in range(1000):
+        heap.schedule(f"name{i % 10}", i)
+
+    assert len(heap) == 10
+    assert len(heap.heap) <= 2 * 10 + 16 + 1
+    assert heap.next_expiry() == 990
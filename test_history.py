@@ -0,0 +1,152 @@
+"""
+Test the metric history.
+"""
+
+import random
+
+import pytest
+
+from history import MetricHistory, RingBuffer, SlidingWindow, is_number
+
+
+def test_ring_buffer():
+    """
+    The oldest items should be overwritten once the buffer is full.
+    """
+    ring = RingBuffer(3)
+    assert not list(ring)
+
+    ring.append(1)
+    ring.append(2)
+    assert list(ring) == [1, 2]
+
+    for value in [3, 4, 5]:
+        ring.append(value)
+    assert list(ring) == [3, 4, 5]
+    assert len(ring) == 3
+    assert ring[0] == 3
+    assert ring[-1] == 5
+    with pytest.raises(IndexError):
+        ring[3]  # pylint: disable=pointless-statement
+    assert ring.nbytes == 3 * 8
+
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_window_stats():
+    """
+    The values should be aggregated over the window.
+    """
+    window = SlidingWindow(30, 10)
+    assert window.min() is None
+    assert window.mean() is None
+    assert not window.series()
+
+    window.add(0, 5)
+    window.add(5, 1)
+    window.add(12, 3)
+    window.add(25, 4)
+    assert (window.min(), window.max(), window.mean()) == (1, 5, 13 / 4)
+    assert window.series() == [(0, 1, 5, 3), (10, 3, 3, 3), (20, 4, 4, 4)]
+
+    # The first slot falls out of the window.
+    window.add(31, 2)
+    assert (window.min(), window.max(), window.mean()) == (2, 4, 3)
+
+    # All the slots fall out of the window.
+    assert window.min(now=100) is None
+    assert window.max() is None
+    assert window.mean() is None
+    assert not window.series()
+
+
+def test_window_ranges():
+    """
+    All the slots of the window should be returned, None for the empty ones.
+    """
+    window = SlidingWindow(30, 10)
+    assert window.ranges() == [None, None, None]
+
+    window.add(5, 1)
+    window.add(7, 3)
+    window.add(25, 2)
+    assert window.ranges() == [(1, 3), None, (2, 2)]
+    assert window.ranges(now=35) == [None, (2, 2), None]
+
+
+def test_window_out_of_order():
+    """
+    Value older than the latest one should be added to the current slot.
+    """
+    window = SlidingWindow(30, 10)
+    window.add(25, 4)
+    window.add(3, 1)
+
+    assert window.series() == [(20, 1, 4, 2.5)]
+
+
+def test_window_against_brute_force():
+    """
+    The statistics should match the ones computed from all the values.
+    """
+    rnd = random.Random(0)
+    window = SlidingWindow(100, 5)
+    values = []
+    timestamp = 0.0
+    for _ in range(5000):
+        timestamp += rnd.expovariate(1)
+        if rnd.random() < 0.001:
+            # gap longer than the window
+            timestamp += 200
+        value = rnd.uniform(-50, 50)
+        window.add(timestamp, value)
+        values.append((timestamp, value))
+
+        oldest = (int(timestamp // 5) - 19) * 5
+        in_window = [value for time, value in values if time >= oldest]
+        assert window.min() == min(in_window)
+        assert window.max() == max(in_window)
+        assert window.mean() == pytest.approx(sum(in_window) / len(in_window))
+        assert window.count == len(in_window)
+
+
+def test_metric_history():
+    """
+    The samples should be kept and the statistics computed for each window.
+    """
+    history = MetricHistory(capacity=4, windows={"minute": (60, 10)})
+    for timestamp, value in enumerate([20.5, 21.0, 22.5, 21.5, 19.0]):
+        history.add(timestamp * 20, value)
+
+    times, values = history.samples()
+    assert list(times) == [20, 40, 60, 80]
+    assert list(values) == [21.0, 22.5, 21.5, 19.0]
+    assert history.stats("minute") == (19.0, 22.5, pytest.approx(21))
+    assert history.stats("minute", now=200) is None
+
+
+def test_history_size():
+    """
+    The memory use should not depend on the number of values.
+    """
+    history = MetricHistory()
+    size = history.nbytes
+    for timestamp in range(100000):
+        history.add(timestamp, timestamp % 1000)
+
+    assert history.nbytes == size
+    assert size < 8 * 1024
+    assert history.stats("day") == (0, 999, pytest.approx(500, abs=5))
+
+
+def test_is_number():
+    """
+    Only finite numbers should be stored.
+    """
+    assert is_number(1)
+    assert is_number(2.5)
+    assert not is_number(True)
+    assert not is_number("1")
+    assert not is_number(None)
+    assert not is_number(float("nan"))
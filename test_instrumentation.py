@@ -0,0 +1,144 @@
+"""
+Test the timing instrumentation.
+"""
+
+import json
+import unittest.mock
+
+import pytest
+
+from display import SimulatedDisplay
+from instrumentation import (
+    TIMINGS,
+    Histogram,
+    StatsExporter,
+    Timings,
+    format_prometheus,
+)
+from metrics_drawer import MetricsDrawer
+
+MEDIUM_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+LARGE_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+
+def test_histogram():
+    """
+    The values should be counted in the buckets with matching upper bound.
+    """
+    histogram = Histogram((1, 2, 4))
+    for value in [0.5, 1, 1.5, 3, 10]:
+        histogram.observe(value)
+
+    assert histogram.count == 5
+    assert histogram.sum == 16
+    assert histogram.cumulative_counts() == [
+        (1, 2),
+        (2, 3),
+        (4, 4),
+        (float("inf"), 5),
+    ]
+
+
+def test_histogram_quantile():
+    """
+    The quantile should be interpolated within the bucket.
+    """
+    histogram = Histogram((1, 2, 4))
+    assert histogram.quantile(0.5) is None
+
+    for value in [1.5] * 4:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(1.5)
+    assert histogram.quantile(1) == 2
+
+    histogram.observe(10)
+    assert histogram.quantile(1) == 4
+
+
+def test_timed():
+    """
+    The duration of the block should be observed even if it raises an exception.
+    """
+    timings = Timings()
+    with timings.timed("render"):
+        pass
+    with pytest.raises(ValueError):
+        with timings.timed("render"):
+            raise ValueError("failure")
+
+    snapshot = timings.snapshot()
+    assert list(snapshot) == ["render"]
+    assert snapshot["render"].count == 2
+    timings.reset()
+    assert not timings.snapshot()
+
+
+def test_format_prometheus():
+    """
+    The histograms should be formatted with cumulative buckets.
+    """
+    histogram = Histogram((0.5, 1))
+    histogram.observe(0.25)
+    histogram.observe(2)
+
+    text = format_prometheus(
+        {"spi": histogram}, {"cpu_seconds": 1.5, "max_rss_bytes": 1024}
+    )
+
+    lines = text.splitlines()
+    assert 'zerodisplay_stage_duration_seconds_bucket{stage="spi",le="0.5"} 1' in lines
+    assert 'zerodisplay_stage_duration_seconds_bucket{stage="spi",le="1.0"} 1' in lines
+    assert 'zerodisplay_stage_duration_seconds_bucket{stage="spi",le="+Inf"} 2' in lines
+    assert 'zerodisplay_stage_duration_seconds_sum{stage="spi"} 2.25' in lines
+    assert 'zerodisplay_stage_duration_seconds_count{stage="spi"} 2' in lines
+    assert "zerodisplay_cpu_seconds_total 1.5" in lines
+    assert "zerodisplay_max_rss_bytes 1024" in lines
+
+
+def test_stages_observed():
+    """
+    Drawing and displaying image should record the timings of these stages.
+    """
+    TIMINGS.reset()
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    display = SimulatedDisplay(250, 122, record=False)
+    display.update(drawer.draw_image(21, 400, 1013))
+
+    snapshot = TIMINGS.snapshot()
+    for stage in ["render", "framebuffer", "spi", "busy"]:
+        assert snapshot[stage].count == 1
+    assert snapshot["busy"].sum == display.busy_time
+
+
+def test_exporter(tmp_path):
+    """
+    The exporter should write the file and publish the summary.
+    """
+    timings = Timings()
+    timings.observe("render", 0.01)
+    path = tmp_path / "zerodisplay.prom"
+    metrics = unittest.mock.Mock()
+
+    StatsExporter(
+        path=str(path), metrics=metrics, topic="stats", timings=timings
+    ).export()
+
+    assert 'stage="render"' in path.read_text(encoding="utf-8")
+    topic, payload = metrics.publish.call_args.args
+    assert topic == "stats"
+    summary = json.loads(payload)
+    assert summary["stages"]["render"]["count"] == 1
+    assert summary["stages"]["render"]["sum"] == 0.01
+    assert summary["cpu_seconds"] > 0
+
+
+def test_exporter_write_failure(tmp_path):
+    """
+    Failure to write the file should not be fatal.
+    """
+    timings = Timings()
+    timings.observe("render", 0.01)
+
+    StatsExporter(path=str(tmp_path / "missing" / "file"), timings=timings).export()
+
+    assert not (tmp_path / "missing").exists()
@@ -0,0 +1,103 @@
+"""
+Test the profiling of the main loop.
+"""
+
+import pstats
+import sys
+import threading
+
+from loop_cond import CondLimit
+from loop_profiler import CondCallback, Profiler, SamplingProfiler, collapse_stack
+
+
+def busy_function(stop_event):
+    """
+    Spin until stopped.
+    """
+    while not stop_event.is_set():
+        pass
+
+
+def test_collapse_stack():
+    """
+    The frames should be listed from the outermost.
+    """
+
+    def inner():
+        # pylint: disable=protected-access
+        return collapse_stack(sys._getframe())
+
+    stack = inner()
+    assert stack.endswith(
+        "test_loop_profiler.py:test_collapse_stack;test_loop_profiler.py:inner"
+    )
+
+
+def test_sampling_profiler(tmp_path):
+    """
+    The stacks of the other threads should be sampled.
+    """
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=busy_function, args=(stop_event,), name="busy", daemon=True
+    )
+    thread.start()
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    while profiler.samples < 10:
+        pass
+    profiler.stop()
+    stop_event.set()
+    thread.join()
+
+    path = tmp_path / "report.collapsed"
+    profiler.write_collapsed(path)
+    lines = path.read_text(encoding="utf-8").splitlines()
+    busy = [line for line in lines if line.startswith("busy;")]
+    assert busy
+    for line in busy:
+        stack, count = line.rsplit(" ", 1)
+        assert "test_loop_profiler.py:busy_function" in stack
+        assert int(count) > 0
+    assert not any(line.startswith("profiler;") for line in lines)
+
+
+def test_cond_callback():
+    """
+    The callback should be called between the iterations and after the last one.
+    """
+    completed = []
+    cond = CondCallback(CondLimit(3), completed.append)
+
+    iterations = 0
+    while cond.cond():
+        iterations += 1
+
+    assert iterations == 3
+    assert completed == [1, 2, 3]
+
+
+def test_profiler(tmp_path):
+    """
+    Profiling should write the results of all the profilers.
+    """
+    directory = tmp_path / "profile"
+    profiler = Profiler(str(directory), interval=0.001, memory=True)
+    cond = profiler.wrap_cond(CondLimit(3))
+    allocated = []
+
+    def loop():
+        while cond.cond():
+            allocated.append(bytearray(100000))
+        return len(allocated)
+
+    assert profiler.run(loop) == 3
+
+    stats = pstats.Stats(str(directory / "report.pstats"))
+    assert any(function == "loop" for _, _, function in stats.stats)
+    assert (directory / "report.collapsed").exists()
+    for iteration in [1, 2, 3]:
+        assert (directory / f"tracemalloc-{iteration}.snapshot").exists()
+    report = (directory / "tracemalloc.txt").read_text(encoding="utf-8")
+    assert "iteration 3" in report
+    assert "test_loop_profiler.py" in report
@@ -2,16 +2,22 @@
 Test how the main loop behaves in time.
 """
 
+import asyncio
 import time
 import unittest.mock
 
 import pytest
+from PIL import Image
 
-from display import Display
+from async_metrics import AsyncMetrics
+from cli import parse_args
+from display import Display, DisplayWorker, SimulatedDisplay
 from loop_cond import CondLimit
-from metrics import Metrics
+from metric_registry import get_default_registry
+from metrics import Metrics, message_handler
 from metrics_drawer import MetricsDrawer
-from report import loop
+from report import async_loop, loop, run_sync
+from scheduler import RedrawScheduler
 
 
 def mock_image_update(image):
@@ -29,7 +35,10 @@ def test_loop(timeout):
     Ensure that the display is not updated more often than the specified timeout
     in the main loop.
     """
-    metrics_attrs = {"get_metrics.return_value": (1, 2, 3)}
+    metrics_attrs = {
+        "get_metrics.return_value": (1, 2, 3),
+        "sleep.side_effect": time.sleep,
+    }
     metrics_mock = unittest.mock.Mock(spec=Metrics, **metrics_attrs)
     display_attrs = {"update.side_effect": mock_image_update}
     display_mock = unittest.mock.Mock(spec=Display, **display_attrs)
@@ -56,3 +65,247 @@ def test_loop(timeout):
         int_list[i] - int_list[i - 1] for i in range(len(int_list) - 1, 0, -1)
     ]:
         assert diff > timeout
+
+
+def test_run_sync_stops_display_worker():
+    """
+    The display worker should display the submitted frame and stop
+    even if the main loop fails.
+    """
+    args = parse_args(
+        [
+            "--hostname",
+            "example.com",
+            "--temp_sensor_topic",
+            "sensors/temperature",
+            "--temp_sensor_name",
+            "temperature",
+            "--co2_sensor_topic",
+            "sensors/co2",
+            "--co2_sensor_name",
+            "co2",
+            "--pressure_sensor_topic",
+            "sensors/pressure",
+            "--pressure_sensor_name",
+            "pressure",
+            "--simulated_display",
+            "--display_thread",
+        ]
+    )
+    metrics_mock = unittest.mock.Mock(
+        spec=Metrics, registry=[], **{"get_metrics.return_value": (1, 2, 3)}
+    )
+    workers = []
+
+    def failing_loop(_cond, _timeout, _drawer, e_display, _metrics, **_kwargs):
+        workers.append(e_display)
+        e_display.update(Image.new("1", (e_display.width, e_display.height), 1))
+        raise RuntimeError("loop failed")
+
+    with unittest.mock.patch(
+        "report.get_display", return_value=SimulatedDisplay(250, 122)
+    ), unittest.mock.patch(
+        "report.get_drawer", return_value=unittest.mock.Mock(spec=MetricsDrawer)
+    ) as drawer_mock, unittest.mock.patch(
+        "report.loop", side_effect=failing_loop
+    ):
+        with pytest.raises(RuntimeError):
+            run_sync(args, metrics_mock, CondLimit(1), None)
+
+    assert len(workers) == 1
+    worker = workers[0]
+    assert isinstance(worker, DisplayWorker)
+    assert not worker.thread.is_alive()
+    assert worker.get_stats()["displayed"] == 1
+    drawer_mock.return_value.save_cache.assert_called_once()
+
+
+def test_loop_scheduler():
+    """
+    With the scheduler, the display should be redrawn on significant change
+    once the minimum interval elapsed, rather than waiting for the timeout.
+    """
+    values = iter([(1, 2, 3), (1, 2, 3), (1, 500, 3), (1, 500, 3)])
+    metrics_attrs = {
+        "get_metrics.side_effect": lambda: next(values),
+        # Simulate metrics updates arriving right away.
+        "sleep.return_value": True,
+        "next_expiry.return_value": None,
+    }
+    metrics_mock = unittest.mock.Mock(spec=Metrics, **metrics_attrs)
+    display_mock = unittest.mock.Mock(spec=Display)
+    drawer_mock = unittest.mock.Mock(spec=MetricsDrawer)
+    scheduler = RedrawScheduler(0, 100, (1, 100, 1))
+
+    before = time.monotonic()
+    loop(
+        CondLimit(4), 100, drawer_mock, display_mock, metrics_mock, scheduler=scheduler
+    )
+    after = time.monotonic()
+
+    assert after - before < 1
+    assert drawer_mock.draw_image.call_args_list == [
+        unittest.mock.call(1, 2, 3, offline=False),
+        unittest.mock.call(1, 500, 3, offline=False),
+    ]
+    assert display_mock.update.call_count == 2
+
+
+def test_loop_trends():
+    """
+    With trends, the history of the metrics should be passed to the drawer.
+    """
+    metrics_attrs = {
+        "get_metrics.return_value": (1, 2, 3),
+        "get_history_ranges.return_value": ([(0, 1)], [], []),
+        "get_history_stats.return_value": ((0, 1, 0.5), None, None),
+    }
+    metrics_mock = unittest.mock.Mock(spec=Metrics, **metrics_attrs)
+    metrics_mock.is_connected.return_value = True
+    display_mock = unittest.mock.Mock(spec=Display)
+    drawer_mock = unittest.mock.Mock(spec=MetricsDrawer)
+
+    loop(CondLimit(1), 0, drawer_mock, display_mock, metrics_mock, trends=True)
+
+    drawer_mock.draw_image.assert_called_once_with(
+        1,
+        2,
+        3,
+        offline=False,
+        trends=([(0, 1)], [], []),
+        extremes=((0, 1, 0.5), None, None),
+    )
+    metrics_mock.get_history_ranges.assert_called_once_with("hour")
+    metrics_mock.get_history_stats.assert_called_once_with("day")
+
+
+def test_loop_trends_timeout():
+    """
+    Without the scheduler, the messages received while waiting for the timeout
+    should get to the history drawn as the trends.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT") as mqtt_mock:
+        registry = get_default_registry(
+            "outside/temperature",
+            "temperature",
+            "living_room/co2",
+            "co2",
+            "outside/pressure",
+            "pressure",
+        )
+        metrics = Metrics("localhost", 1883, 1800, registry, history=True)
+    client = mqtt_mock.return_value
+    metrics.mqtt.user_data = metrics
+    messages = iter([400, 450, 500, 5000, 600, 800])
+
+    def receive(timeout):
+        value = next(messages, None)
+        if value is not None:
+            message_handler(client, "living_room/co2", f'{{"co2": {value}}}')
+        time.sleep(min(timeout, 0.05))
+
+    client.loop.side_effect = receive
+    drawer_mock = unittest.mock.Mock(spec=MetricsDrawer)
+    display_mock = unittest.mock.Mock(spec=Display)
+
+    loop(CondLimit(2), 1, drawer_mock, display_mock, metrics, trends=True)
+
+    assert drawer_mock.draw_image.call_count == 2
+    co2_ranges = drawer_mock.draw_image.call_args.kwargs["trends"][1]
+    co2_slots = [item for item in co2_ranges if item is not None]
+    assert min(low for low, _ in co2_slots) == 400
+    assert max(high for _, high in co2_slots) == 5000
+
+
+async def wait_for_update(timeout):
+    """
+    Simulate no metric updates.
+    :param timeout: timeout in seconds
+    :return: False
+    """
+    await asyncio.sleep(timeout)
+    return False
+
+
+def get_async_mocks(update_side_effect):
+    """
+    :param update_side_effect: side effect of the display update() function
+    :return: tuple of metrics, display, image and drawer mocks
+    """
+    metrics_attrs = {
+        "get_metrics.return_value": (1, 2, 3),
+        "wait_for_update.side_effect": wait_for_update,
+    }
+    metrics_mock = unittest.mock.Mock(spec=AsyncMetrics, **metrics_attrs)
+    display_attrs = {"update.side_effect": update_side_effect}
+    display_mock = unittest.mock.Mock(spec=Display, **display_attrs)
+    mock_image = unittest.mock.Mock()
+    mock_image.call_times = []
+    # The loop passes a copy of the image to the display.
+    mock_image.copy.return_value = mock_image
+    drawer_attrs = {"draw_image.return_value": mock_image}
+    drawer_mock = unittest.mock.Mock(spec=MetricsDrawer, **drawer_attrs)
+
+    return metrics_mock, display_mock, mock_image, drawer_mock
+
+
+@pytest.mark.parametrize("timeout", [1, 2])
+def test_async_loop(timeout):
+    """
+    Ensure that the display is not updated more often than the specified timeout
+    in the asyncio main loop.
+    """
+    metrics_mock, display_mock, mock_image, drawer_mock = get_async_mocks(
+        mock_image_update
+    )
+    draw_times = []
+    drawer_mock.draw_image.side_effect = (
+        lambda *args, **kwargs: draw_times.append(time.monotonic()) or mock_image
+    )
+    iter_count = 3
+
+    before = time.monotonic()
+    asyncio.run(
+        async_loop(
+            CondLimit(iter_count), timeout, drawer_mock, display_mock, metrics_mock
+        )
+    )
+    after = time.monotonic()
+
+    assert after - before > timeout * (iter_count - 1)
+
+    display_mock.update.assert_has_calls(
+        [unittest.mock.call(mock_image) for _ in range(iter_count)]
+    )
+    # The images are handed over to the display task, so check the spacing
+    # of the drawing.
+    int_list = draw_times
+    for diff in [
+        int_list[i] - int_list[i - 1] for i in range(len(int_list) - 1, 0, -1)
+    ]:
+        assert diff > timeout
+
+
+def test_async_loop_slow_display():
+    """
+    Slow display refresh should not block the loop, intermediate frames are dropped.
+    """
+    timeout = 1
+
+    def slow_update(image):
+        mock_image_update(image)
+        time.sleep(timeout * 2.5)
+
+    metrics_mock, display_mock, mock_image, drawer_mock = get_async_mocks(slow_update)
+    iter_count = 4
+
+    asyncio.run(
+        async_loop(
+            CondLimit(iter_count), timeout, drawer_mock, display_mock, metrics_mock
+        )
+    )
+
+    # The frames are drawn according to the timeout, however the second one
+    # is replaced by the third one while the first one is being displayed.
+    assert drawer_mock.draw_image.call_count == iter_count
+    assert len(mock_image.call_times) == iter_count - 1
@@ -0,0 +1,82 @@
+"""
+Test the metric definitions and the registry.
+"""
+
+import json
+
+import pytest
+
+from metric_registry import (
+    MetricDefinition,
+    MetricRegistry,
+    get_default_registry,
+    load_registry,
+)
+
+
+def test_format():
+    """
+    Values should be formatted with the label and unit, missing values as N/A.
+    """
+    definition = MetricDefinition("co2", "topic", "co2", label="CO₂ : ", unit=" ppm")
+    assert definition.format(812.7) == "CO₂ : 812 ppm"
+    assert definition.format("812.7") == "CO₂ : 812 ppm"
+    assert definition.format(0) == "CO₂ : 0 ppm"
+    assert definition.format(None) == "CO₂ : N/A"
+
+
+def test_registry_index():
+    """
+    The registry should keep the order and index the definitions by topic.
+    """
+    registry = MetricRegistry(
+        [
+            MetricDefinition("temp", "weather", "temperature"),
+            MetricDefinition("co2", "air", "co2"),
+            MetricDefinition("humidity", "weather", "humidity"),
+        ]
+    )
+    assert [definition.name for definition in registry] == ["temp", "co2", "humidity"]
+    assert len(registry) == 3
+    assert registry.topics == ["weather", "air"]
+    assert [d.name for d in registry.by_topic["weather"]] == ["temp", "humidity"]
+
+    with pytest.raises(ValueError):
+        registry.add(MetricDefinition("co2", "other", "co2"))
+
+
+def test_default_registry():
+    """
+    The default registry should contain the 3 metrics with the thresholds.
+    """
+    registry = get_default_registry("t", "temp", "c", "co2", "p", "press", (1, 50, 3))
+    assert [d.name for d in registry] == ["temp", "co2", "pressure"]
+    assert [d.threshold for d in registry] == [1, 50, 3]
+    assert [d.format(None) for d in registry] == ["N/A", "CO₂ : N/A", "Pressure: N/A"]
+
+
+def test_load_registry(tmp_path):
+    """
+    Definitions should be loaded from JSON file.
+    """
+    config = [
+        {"name": "temp", "topic": "weather", "field": "temperature", "unit": "°C"},
+        {
+            "name": "humidity",
+            "topic": "weather",
+            "field": "humidity",
+            "label": "RH: ",
+            "unit": " %",
+            "format": "{:.1f}",
+            "threshold": 5,
+        },
+    ]
+    path = tmp_path / "metrics.json"
+    path.write_text(json.dumps(config), encoding="utf-8")
+
+    registry = load_registry(path)
+    assert registry.topics == ["weather"]
+    temp, humidity = registry
+    assert temp.format(21.56) == "21°C"
+    assert humidity.format(45.25) == "RH: 45.2 %"
+    assert humidity.threshold == 5
@@ -0,0 +1,618 @@
+"""
+Test the Metrics class.
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+import unittest.mock
+
+import pytest
+from adafruit_minimqtt.adafruit_minimqtt import MMQTTException
+
+from async_metrics import AsyncMetrics
+from local_broker import LocalBroker
+from metric_registry import MetricDefinition, MetricRegistry, get_default_registry
+from metrics import (
+    SOCKET_POOL,
+    ClosingMixin,
+    Metrics,
+    get_backoff,
+    get_brokers,
+    get_ssl_context,
+    message_handler,
+)
+from metrics_log import MetricsLog, read_log
+
+
+def get_registry():
+    """
+    :return: registry with the default metrics
+    """
+    return get_default_registry(
+        "temp/topic",
+        "temperature",
+        "co2/topic",
+        "co2_ppm",
+        "pressure/topic",
+        "pressure_hpa",
+    )
+
+
+def get_metrics(background=False, registry=None, state_file=None, history=False):
+    """
+    The MQTT client class needs to be mocked by the caller.
+    :param background: whether to run the MQTT thread
+    :param registry: MetricRegistry object, the default metrics if None
+    :param state_file: path to the state file
+    :param history: whether to keep the history of the values
+    :return: Metrics object
+    """
+    metrics = Metrics(
+        "localhost",
+        1883,
+        1800,
+        registry or get_registry(),
+        background=background,
+        state_file=state_file,
+        history=history,
+    )
+    metrics.mqtt.user_data = metrics
+    return metrics
+
+
+def test_message_handler():
+    """
+    Values from the messages should be stored according to the topic.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT") as mqtt_mock:
+        metrics = get_metrics()
+    message_handler(metrics.mqtt, "temp/topic", '{"temperature": 21.5}')
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 800, "foo": 1}')
+    message_handler(metrics.mqtt, "other/topic", '{"pressure_hpa": 1}')
+
+    assert metrics.get_metrics() == (21.5, 800, None)
+    mqtt_mock.return_value.loop.assert_called()
+
+
+def test_message_handler_multiple_fields():
+    """
+    Single message should update all the metrics carried by its topic.
+    """
+    registry = MetricRegistry(
+        [
+            MetricDefinition("temp", "weather/topic", "temperature"),
+            MetricDefinition("humidity", "weather/topic", "humidity"),
+            MetricDefinition("co2", "co2/topic", "co2_ppm"),
+        ]
+    )
+    with unittest.mock.patch("metrics.MQTT.MQTT") as mqtt_mock:
+        metrics = get_metrics(registry=registry)
+    mqtt_mock.return_value.subscribe.assert_called_with(
+        [("weather/topic", 0), ("co2/topic", 0)]
+    )
+
+    message_handler(
+        metrics.mqtt, "weather/topic", '{"temperature": 21.5, "humidity": 0}'
+    )
+
+    assert metrics.get_metrics() == (21.5, 0, None)
+    assert metrics.updates == 1
+
+
+def test_message_burst():
+    """
+    Only the latest payload for given topic should be decoded.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics()
+    for i in range(100):
+        message_handler(metrics.mqtt, "co2/topic", f'{{"co2_ppm": {i}}}')
+    message_handler(metrics.mqtt, "temp/topic", "not JSON")
+
+    assert metrics.updates == 101
+    assert metrics.decoded_payloads == 0
+    assert metrics.get_metrics() == (None, 99, None)
+    assert metrics.decoded_payloads == 2
+    assert metrics.get_metrics() == (None, 99, None)
+    assert metrics.decoded_payloads == 2
+
+
+def test_history():
+    """
+    The numeric values of all the messages should be kept in the history,
+    not only of the ones read.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics(history=True)
+    for value in [800, 1200, 1000]:
+        message_handler(metrics.mqtt, "co2/topic", f'{{"co2_ppm": {value}}}')
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": "invalid"}')
+    message_handler(metrics.mqtt, "temp/topic", '{"temperature": 21.5}')
+
+    assert metrics.get_history_stats("hour") == (
+        (21.5, 21.5, 21.5),
+        (800, 1200, 1000),
+        None,
+    )
+    assert len(metrics.history["co2"]) == 3
+    temp_ranges, co2_ranges, pressure_ranges = metrics.get_history_ranges("hour")
+    assert len(co2_ranges) == 60
+    # The values may fall into two slots if the minute changes meanwhile.
+    co2_slots = [item for item in co2_ranges if item is not None]
+    assert min(low for low, _ in co2_slots) == 800
+    assert max(high for _, high in co2_slots) == 1200
+    assert temp_ranges[-1] == (21.5, 21.5)
+    assert not any(pressure_ranges)
+    assert metrics.get_metrics() == (21.5, "invalid", None)
+
+
+def test_history_disabled():
+    """
+    Without the history the payloads should be decoded only when read.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics()
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 800}')
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 1200}')
+
+    assert metrics.get_history_stats("hour") == (None, None, None)
+    assert metrics.get_history_ranges("hour") == (None, None, None)
+    assert metrics.get_metrics() == (None, 1200, None)
+    assert metrics.decoded_payloads == 1
+
+
+def test_metrics_log(tmp_path):
+    """
+    The values should be recorded to the metrics log and the history
+    loaded from it on start.
+    """
+
+    def create_metrics(history):
+        with unittest.mock.patch("metrics.MQTT.MQTT"):
+            metrics = Metrics(
+                "localhost",
+                1883,
+                1800,
+                get_registry(),
+                metrics_log=MetricsLog(str(tmp_path), ["temp", "co2", "pressure"]),
+                history=history,
+            )
+        metrics.mqtt.user_data = metrics
+        return metrics
+
+    metrics = create_metrics(history=False)
+    before = time.time()
+    # Values of all the messages should be logged, not only of the ones read.
+    for value in [400, 5000, 800]:
+        message_handler(metrics.mqtt, "co2/topic", f'{{"co2_ppm": {value}}}')
+    message_handler(metrics.mqtt, "temp/topic", '{"temperature": 21.5}')
+    metrics.get_metrics()
+    assert not read_log(str(tmp_path))
+    metrics.stop()
+
+    records = read_log(str(tmp_path))
+    assert [record[1:] for record in records] == [
+        ("co2", 400),
+        ("co2", 5000),
+        ("co2", 800),
+        ("temp", 21.5),
+    ]
+    assert before <= records[0][0] <= time.time()
+
+    metrics = create_metrics(history=True)
+    assert metrics.get_metrics() == (None, None, None)
+    assert metrics.get_history_stats("hour") == (
+        (21.5, 21.5, 21.5),
+        (400, 5000, 6200 / 3),
+        None,
+    )
+
+
+def test_metrics_log_value_out_of_range(tmp_path):
+    """
+    Value that cannot be logged should not break reading the metrics.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = Metrics(
+            "localhost",
+            1883,
+            1800,
+            get_registry(),
+            metrics_log=MetricsLog(str(tmp_path), ["temp", "co2", "pressure"]),
+        )
+    metrics.mqtt.user_data = metrics
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 1e39}')
+    assert metrics.get_metrics() == (None, 1e39, None)
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 800}')
+    assert metrics.get_metrics() == (None, 800, None)
+    metrics.stop()
+
+    assert [record[1:] for record in read_log(str(tmp_path))] == [("co2", 800)]
+
+
+def test_state_file(tmp_path):
+    """
+    The values should be persisted and loaded on start unless stale.
+    """
+    state_file = tmp_path / "state.json"
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics(state_file=state_file)
+    message_handler(metrics.mqtt, "temp/topic", '{"temperature": 21.5}')
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 800}')
+    assert metrics.get_metrics() == (21.5, 800, None)
+    state = json.loads(state_file.read_text(encoding="utf-8"))
+    assert set(state["values"]) == {"temp", "co2"}
+
+    # Make the CO2 value stale and the temperature 1000 seconds old.
+    now = time.time()
+    state["values"]["temp"][1] = now - 1000
+    state["values"]["co2"][1] = now - 2000
+    state_file.write_text(json.dumps(state), encoding="utf-8")
+
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics(state_file=state_file)
+    assert metrics.get_metrics() == (21.5, None, None)
+    assert abs(metrics.next_expiry() - (time.monotonic() + 800)) < 10
+
+
+def test_invalid_state_file(tmp_path):
+    """
+    Invalid state file should be ignored.
+    """
+    state_file = tmp_path / "state.json"
+    state_file.write_text('{"values": {"temp": 1, "co2": [800', encoding="utf-8")
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics(state_file=state_file)
+    assert metrics.get_metrics() == (None, None, None)
+
+    state_file.write_text('{"values": {"temp": 1, "co2": [800]}}', encoding="utf-8")
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics(state_file=state_file)
+    assert metrics.get_metrics() == (None, None, None)
+
+
+def test_retained_messages():
+    """
+    Retained messages should provide the values right after connecting,
+    unless they are stale according to their timestamp.
+    """
+    registry = get_default_registry(
+        "temp/topic",
+        "temperature",
+        "co2/topic",
+        "co2_ppm",
+        "pressure/topic",
+        "pressure_hpa",
+        timestamp_field="time",
+    )
+    with LocalBroker() as broker:
+        now = time.time()
+        for topic, payload in [
+            ("temp/topic", {"temperature": 21.5, "time": now - 100}),
+            ("co2/topic", {"co2_ppm": 800, "time": now - 2000}),
+            ("pressure/topic", {"pressure_hpa": 1013, "time": now}),
+        ]:
+            broker.publish(topic, json.dumps(payload), retain=True)
+
+        start = time.monotonic()
+        metrics = Metrics("127.0.0.1", broker.port, 1800, registry)
+        try:
+            assert metrics.get_metrics() == (21.5, None, 1013)
+            # One MQTT loop.
+            assert time.monotonic() - start < 3
+            assert abs(metrics.next_expiry() - (start + 1700)) < 10
+        finally:
+            metrics.mqtt.disconnect()
+
+
+def test_persistent_session():
+    """
+    With persistent session, QoS 1 messages published while disconnected
+    should be delivered after reconnect.
+    """
+    with LocalBroker() as broker:
+
+        def connect(clean_session):
+            return Metrics(
+                "127.0.0.1",
+                broker.port,
+                1800,
+                get_registry(),
+                qos=1,
+                clean_session=clean_session,
+                client_id="display",
+            )
+
+        connect(False).mqtt.disconnect()
+        assert broker.wait_disconnected("display")
+        broker.publish("temp/topic", '{"temperature": 21.5}', qos=1)
+        broker.publish("co2/topic", '{"co2_ppm": 800}', qos=0)
+
+        metrics = connect(False)
+        assert metrics.get_metrics() == (21.5, None, None)
+        metrics.mqtt.disconnect()
+        assert broker.wait_disconnected("display")
+
+        broker.publish("temp/topic", '{"temperature": 22}', qos=1)
+        metrics = connect(True)
+        assert metrics.get_metrics() == (None, None, None)
+        metrics.mqtt.disconnect()
+
+
+def test_publish():
+    """
+    Message published via the Metrics object should be sent when polling.
+    """
+    with LocalBroker() as broker:
+        metrics = Metrics("127.0.0.1", broker.port, 1800, get_registry())
+        # Only the latest message should be published.
+        metrics.publish("temp/topic", '{"temperature": 20}')
+        metrics.publish("temp/topic", '{"temperature": 21}')
+        deadline = time.monotonic() + 5
+        while metrics.updates == 0 and time.monotonic() < deadline:
+            metrics.poll()
+        assert metrics.get_metrics() == (21, None, None)
+        assert broker.published == 1
+        metrics.mqtt.disconnect()
+
+
+def test_get_brokers():
+    """
+    Broker addresses should be parsed with the default port.
+    """
+    assert get_brokers("example.com", "1883") == [("example.com", 1883)]
+    assert get_brokers(
+        ["a.example.com:8883", "b.example.com", "::1", "[::1]:8883", "[::1]"], 1883
+    ) == [
+        ("a.example.com", 8883),
+        ("b.example.com", 1883),
+        ("::1", 1883),
+        ("::1", 8883),
+        ("::1", 1883),
+    ]
+
+
+def test_get_backoff():
+    """
+    The backoff should grow exponentially up to the maximum, with jitter.
+    """
+    for attempt, delay in [(0, 1), (1, 2), (3, 8), (10, 60), (1000, 60)]:
+        for _ in range(10):
+            assert delay / 2 <= get_backoff(attempt, base=1, maximum=60) <= delay
+
+
+def get_free_port():
+    """
+    :return: TCP port nobody listens on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_parallel_connect():
+    """
+    The first broker to connect should be used.
+    """
+    with LocalBroker() as broker:
+        broker.publish("temp/topic", '{"temperature": 21.5}', retain=True)
+        metrics = Metrics(
+            [f"127.0.0.1:{get_free_port()}", f"127.0.0.1:{broker.port}"],
+            1883,
+            1800,
+            get_registry(),
+        )
+        try:
+            assert metrics.is_connected()
+            assert metrics.mqtt.port == broker.port
+            assert metrics.get_metrics() == (21.5, None, None)
+        finally:
+            metrics.mqtt.disconnect()
+
+
+def test_reconnect():
+    """
+    After the connection is lost, get_metrics() should keep returning the values
+    right away while reconnecting in the background.
+    """
+    with LocalBroker() as broker, unittest.mock.patch(
+        "metrics.get_backoff", return_value=0.5
+    ):
+        broker.publish("temp/topic", '{"temperature": 21.5}', retain=True)
+        metrics = Metrics("127.0.0.1", broker.port, 1800, get_registry())
+        assert metrics.get_metrics() == (21.5, None, None)
+
+        client = metrics.mqtt
+        with unittest.mock.patch.object(
+            client, "loop", side_effect=MMQTTException("connection lost")
+        ):
+            assert metrics.get_metrics() == (21.5, None, None)
+            assert not metrics.is_connected()
+
+            before = time.monotonic()
+            assert metrics.get_metrics() == (21.5, None, None)
+            assert time.monotonic() - before < 2
+
+        assert metrics.connected.wait(5)
+        assert metrics.mqtt is not client
+        broker.publish("temp/topic", '{"temperature": 22}')
+        assert metrics.get_metrics() == (22, None, None)
+        metrics.stop()
+        metrics.mqtt.disconnect()
+
+
+def test_connect_failure():
+    """
+    Metrics should be created even if no broker is available.
+    """
+    with unittest.mock.patch("metrics.get_backoff", return_value=0.1):
+        metrics = Metrics("127.0.0.1", get_free_port(), 1800, get_registry())
+        try:
+            assert not metrics.is_connected()
+            assert metrics.get_metrics() == (None, None, None)
+        finally:
+            metrics.stop()
+
+
+def test_expiry():
+    """
+    Values should be expired once they become stale.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT"):
+        metrics = get_metrics()
+    metrics.metric_timeout = 0.5
+    assert metrics.next_expiry() is None
+
+    message_handler(metrics.mqtt, "temp/topic", '{"temperature": 21.5}')
+    message_handler(metrics.mqtt, "co2/topic", '{"co2_ppm": 800}')
+    assert metrics.next_expiry() == metrics.timestamps["temp"] + 0.5
+    assert metrics.get_metrics() == (21.5, 800, None)
+
+    time.sleep(0.6)
+    assert metrics.get_metrics() == (None, None, None)
+    assert metrics.next_expiry() is None
+
+
+def test_sleep():
+    """
+    sleep() should return early once a message arrives.
+    """
+    with unittest.mock.patch("metrics.MQTT.MQTT") as mqtt_mock:
+        metrics = get_metrics()
+    client = mqtt_mock.return_value
+    client.loop.side_effect = lambda timeout: (
+        message_handler(client, "temp/topic", '{"temperature": 21.5}')
+        if client.loop.call_count > 1
+        else None
+    )
+
+    before = time.monotonic()
+    assert metrics.sleep(100)
+    assert time.monotonic() - before < 10
+    assert client.loop.call_count == 2
+    assert not metrics.sleep(0)
+
+
+def test_background_thread():
+    """
+    With the MQTT thread, get_metrics() should not touch the MQTT client
+    and should return the values received by the thread.
+    """
+    received = threading.Event()
+    # Threads calling the client loop, recorded by the side effect installed
+    # before the thread starts, so the mock is never patched while it runs.
+    loop_threads = set()
+
+    with unittest.mock.patch("metrics.MQTT.MQTT") as mqtt_mock:
+        client = mqtt_mock.return_value
+
+        def loop(_timeout):
+            loop_threads.add(threading.current_thread())
+            client.user_data = mqtt_mock.call_args.kwargs["user_data"]
+            message_handler(client, "pressure/topic", '{"pressure_hpa": 1013}')
+            received.set()
+
+        client.loop.side_effect = loop
+        metrics = get_metrics(background=True)
+
+    try:
+        assert received.wait(5)
+        assert metrics.get_metrics() == (None, None, 1013)
+    finally:
+        metrics.stop()
+    assert threading.current_thread() not in loop_threads
+    assert loop_threads == {metrics.thread}
+    assert not metrics.thread.is_alive()
+
+
+def test_async_metrics_expiry():
+    """
+    AsyncMetrics should signal the update and the expiry of the values.
+    """
+    messages = [("co2/topic", '{"co2_ppm": 800}')]
+
+    def loop(_timeout):
+        time.sleep(0.1)
+        while messages:
+            message_handler(metrics.mqtt, *messages.pop())
+
+    async def run():
+        metrics.start()
+        try:
+            assert await metrics.wait_for_update(5)
+            assert metrics.get_metrics() == (None, 800, None)
+            # metric timeout is 1 second
+            assert await metrics.wait_for_update(5)
+            assert metrics.get_metrics() == (None, None, None)
+        finally:
+            metrics.stop()
+
+    with unittest.mock.patch("metrics.MQTT.MQTT") as mqtt_mock:
+        mqtt_mock.return_value.loop.side_effect = loop
+        metrics = AsyncMetrics(
+            "localhost",
+            1883,
+            1,
+            get_registry(),
+        )
+        metrics.mqtt.user_data = metrics
+        asyncio.run(run())
+
+
+def test_closing_socket():
+    """
+    Receiving from the socket closed by the peer should raise ConnectionError
+    right away rather than return no data.
+    """
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        with SOCKET_POOL.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
+            client.settimeout(10)
+            client.connect(server.getsockname())
+            peer, _ = server.accept()
+            peer.sendall(b"ab")
+            peer.close()
+
+            buffer = bytearray(4)
+            assert client.recv_into(buffer) == 2
+            start = time.monotonic()
+            with pytest.raises(ConnectionError):
+                client.recv_into(buffer)
+            assert time.monotonic() - start < 1
+
+
+def test_closing_ssl_socket():
+    """
+    The TLS connections should detect the close too.
+    """
+    with SOCKET_POOL.socket(socket.AF_INET, socket.SOCK_STREAM) as plain:
+        with get_ssl_context().wrap_socket(
+            plain, server_hostname="example.com", do_handshake_on_connect=False
+        ) as tls:
+            assert isinstance(tls, ClosingMixin)
+
+
+def test_broker_disconnect():
+    """
+    Connection closed by the broker should be detected right away.
+    """
+    with LocalBroker() as broker:
+        metrics = Metrics("127.0.0.1", broker.port, 1800, get_registry())
+        broker.disconnect_clients()
+
+        start = time.monotonic()
+        while metrics.is_connected() and time.monotonic() - start < 5:
+            metrics.poll()
+        assert not metrics.is_connected()
+        assert time.monotonic() - start < 2
+
+        assert metrics.connected.wait(5)
+        broker.publish("temp/topic", '{"temperature": 21}')
+        deadline = time.monotonic() + 5
+        while metrics.updates == 0 and time.monotonic() < deadline:
+            metrics.poll()
+        assert metrics.get_metrics() == (21, None, None)
+        metrics.stop()
+        metrics.mqtt.disconnect()
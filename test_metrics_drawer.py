@@ -0,0 +1,230 @@
+"""
+Test the MetricsDrawer class.
+"""
+
+import unittest.mock
+
+import pytest
+from PIL import Image, ImageDraw
+
+from metrics_drawer import MetricsDrawer, downsample, get_font
+
+MEDIUM_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+LARGE_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+
+@pytest.mark.parametrize("mode", ["1", "L", "RGB"])
+def test_image_mode(mode):
+    """
+    The image should be drawn in the requested mode.
+    :param mode: PIL image mode
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode=mode)
+    image = drawer.draw_image(21.3, 800, 1013)
+    assert image.mode == mode
+    assert image.size == (250, 122)
+    assert len(image.getcolors()) > 1
+
+
+def test_invalid_image_mode():
+    """
+    unsupported image mode should raise ValueError
+    """
+    with pytest.raises(ValueError):
+        MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="CMYK")
+
+
+@pytest.mark.parametrize("mode", ["1", "L", "RGB"])
+@pytest.mark.parametrize("font_size", [12, 24, 64])
+@pytest.mark.parametrize("label", ["CO₂ : ", "Pressure: ", "Humidity: "])
+def test_label_split(mode, font_size, label):
+    """
+    Drawing the label into the base layer and pasting the rest of the text
+    should produce the same image as drawing the whole text.
+    :param mode: PIL image mode
+    :param font_size: font size
+    :param label: static prefix of the text
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode=mode)
+    font = (MEDIUM_FONT, font_size)
+    text = label + "1013 hPa"
+    drawer.labels = []
+    drawer.texts = []
+    drawer.draw_text("text", (3, 7), text, font, label=label)
+    drawer.compose_image()
+
+    expected = Image.new(mode, (250, 122), drawer.background_color)
+    draw = ImageDraw.Draw(expected)
+    draw.text((3, 7), text, font=get_font(*font), fill=drawer.text_color)
+    assert drawer.image.tobytes() == expected.tobytes()
+    assert drawer.elements["text"] == (
+        text,
+        draw.textbbox((3, 7), text, font=get_font(*font)),
+    )
+
+
+@pytest.mark.parametrize("mode", ["1", "L", "RGB"])
+def test_cache(mode):
+    """
+    Cached rendering should produce the same images as uncached rendering
+    and drawing the same values again should not render any text.
+    :param mode: PIL image mode
+    """
+    cached = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode=mode)
+    uncached = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode=mode, cache_size=0)
+    for values in [(21.3, 800, 1013), (-5, None, 0), (21.3, 800, 1013), (7, 1200, 990)]:
+        image = cached.draw_image(*values)
+        assert image.tobytes() == uncached.draw_image(*values).tobytes()
+        assert cached.elements == uncached.elements
+
+    misses = cached.text_cache.misses
+    cached.draw_image(7, 1200, 990)
+    assert cached.text_cache.misses == misses
+    assert not cached.dirty_rects
+
+
+@pytest.mark.parametrize("mode", ["1", "RGB"])
+def test_persistent_cache(tmp_path, mode):
+    """
+    Drawer with the cache loaded from file should draw the text seen before
+    without loading the fonts.
+    :param mode: PIL image mode
+    """
+    cache_path = tmp_path / "text_cache.json"
+    drawer = MetricsDrawer(
+        250, 122, MEDIUM_FONT, LARGE_FONT, mode=mode, cache_path=cache_path
+    )
+    expected = drawer.draw_image(21.3, 800, 1013).copy()
+    drawer.save_cache()
+    assert cache_path.exists()
+
+    with unittest.mock.patch("metrics_drawer.get_font") as get_font_mock:
+        drawer = MetricsDrawer(
+            250, 122, MEDIUM_FONT, LARGE_FONT, mode=mode, cache_path=cache_path
+        )
+        image = drawer.draw_image(21.3, 800, 1013)
+        get_font_mock.assert_not_called()
+    assert image.tobytes() == expected.tobytes()
+    assert drawer.text_cache.misses == 0
+
+    # Cache of different image mode should not be used.
+    other_mode = "L" if mode == "1" else "1"
+    drawer = MetricsDrawer(
+        250, 122, MEDIUM_FONT, LARGE_FONT, mode=other_mode, cache_path=cache_path
+    )
+    assert len(drawer.text_cache) == 0
+
+
+def test_cache_saving(tmp_path):
+    """
+    The cache should be saved while drawing only once the save interval elapses
+    and drawing text that is already cached should not write the file.
+    """
+    cache_path = tmp_path / "text_cache.json"
+    drawer = MetricsDrawer(
+        250, 122, MEDIUM_FONT, LARGE_FONT, mode="1", cache_path=cache_path
+    )
+    drawer.draw_image(21.3, 800, 1013)
+    assert not cache_path.exists()
+    drawer.save_cache()
+    assert cache_path.exists()
+
+    drawer.text_cache.save_interval = 0
+    with unittest.mock.patch("text_cache.write_atomically") as write_mock:
+        drawer.draw_image(21.3, 800, 1013)
+        write_mock.assert_not_called()
+        drawer.draw_image(7, 1200, 990)
+        write_mock.assert_called_once()
+
+
+def test_offline():
+    """
+    The offline status should be drawn and reported as changed region.
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    online = drawer.draw_image(21.3, 800, 1013).copy()
+    offline = drawer.draw_image(21.3, 800, 1013, offline=True)
+    assert online.tobytes() != offline.tobytes()
+    assert drawer.elements["status"][0] == "offline"
+    assert drawer.dirty_rects == [drawer.elements["status"][1]]
+
+
+def test_downsample():
+    """
+    The ranges falling into each column should be merged, the gaps kept.
+    """
+    ranges = [(1, 2), (0, 1), None, None, (5, 6), None]
+
+    assert downsample(ranges, 3) == [(0, 2), None, (5, 6)]
+    assert downsample(ranges, 10) == ranges
+    assert not downsample([], 10)
+
+
+def test_downsample_few_slots():
+    """
+    With fewer slots than columns each slot should get its own column.
+    """
+    assert downsample([(1, 2)], 10) == [(1, 2)]
+    assert downsample([None, (3, 4)], 10) == [None, (3, 4)]
+
+
+def test_downsample_empty_slots():
+    """
+    Slots without values should give columns without values
+    and no sparkline should be drawn for them.
+    """
+    assert downsample([None] * 5, 3) == [None] * 3
+    assert downsample([None] * 5, 10) == [None] * 5
+
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    drawer.draw_image(21.3, 800, 1013, trends=[[None] * 60, None, None])
+    assert "temp/trend" not in drawer.elements
+
+
+def test_trends():
+    """
+    The sparklines should be drawn right of the metrics, within the image,
+    and reported as changed region when the history changes.
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    temp_trend = [(20 + i / 10, 20.5 + i / 10) for i in range(60)]
+    co2_trend = [None] * 30 + [(800, 900)] * 30
+    plain = drawer.draw_image(21.3, 800, 1013).copy()
+    image = drawer.draw_image(21.3, 800, 1013, trends=[temp_trend, co2_trend, None])
+
+    assert image.tobytes() != plain.tobytes()
+    for name in ["temp", "co2"]:
+        segments, box = drawer.elements[f"{name}/trend"]
+        assert box[0] > drawer.elements[name][1][2]
+        assert box[2] <= 250
+        for (x, upper), (_, lower) in segments:
+            assert box[0] <= x < box[2]
+            assert box[1] <= upper <= lower < box[3]
+    assert "pressure/trend" not in drawer.elements
+    assert len(drawer.dirty_rects) == 2
+
+    # The temperature rises, so the last column is at the top.
+    segments, box = drawer.elements["temp/trend"]
+    assert segments[-1][0][1] == box[1]
+    assert segments[0][1][1] == box[3] - 1
+    # The CO2 history starts in the middle of the sparkline.
+    segments, box = drawer.elements["co2/trend"]
+    third = (box[2] - box[0]) // 3
+    assert box[0] + third < segments[0][0][0] < box[2] - third
+
+    temp_trend[-1] = (10, 10)
+    drawer.draw_image(21.3, 800, 1013, trends=[temp_trend, co2_trend, None])
+    assert drawer.dirty_rects == [drawer.elements["temp/trend"][1]]
+
+
+def test_extremes():
+    """
+    The minimum and maximum of the first metric should be drawn below it.
+    """
+    drawer = MetricsDrawer(250, 122, MEDIUM_FONT, LARGE_FONT, mode="1")
+    drawer.draw_image(21.3, 800, 1013, extremes=[(17.2, 23.9, 20.1), None, None])
+
+    text, box = drawer.elements["temp/extremes"]
+    assert text == "min 17°C  max 23°C"
+    assert box[1] >= drawer.elements["temp"][1][3]
+    assert box[3] <= drawer.elements["co2"][1][1]
@@ -0,0 +1,259 @@
+"""
+Test the binary metrics log.
+"""
+
+import os
+
+import pytest
+
+from metrics_log import RECORD, MetricsLog, iter_log, list_segments, read_log
+
+
+def test_batching(tmp_path):
+    """
+    The records should be written once the batch is complete or when forced.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp", "co2"], batch_size=3)
+    metrics_log.append(1000.0, "temp", 21.5)
+    metrics_log.append(1001.0, "co2", 800)
+    metrics_log.append(1002.0, "other", 1)
+    metrics_log.flush(force=False)
+    assert not read_log(str(tmp_path))
+
+    metrics_log.append(1003.0, "co2", 900)
+    metrics_log.flush(force=False)
+    assert read_log(str(tmp_path)) == [
+        (1000.0, "temp", 21.5),
+        (1001.0, "co2", 800),
+        (1003.0, "co2", 900),
+    ]
+
+    metrics_log.append(1004.0, "temp", 22)
+    metrics_log.close()
+    assert read_log(str(tmp_path))[-1] == (1004.0, "temp", 22)
+
+
+def test_flush_interval(tmp_path):
+    """
+    The records should not stay buffered longer than the flush interval.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"], flush_interval=0)
+    metrics_log.append(1000.0, "temp", 21.5)
+    metrics_log.flush(force=False)
+    assert read_log(str(tmp_path)) == [(1000.0, "temp", 21.5)]
+
+
+def test_rotation(tmp_path):
+    """
+    New segment should be started once the current one is full
+    and the oldest segments removed.
+    """
+    segment_size = 1024
+    metrics_log = MetricsLog(
+        str(tmp_path), ["temp"], segment_size=segment_size, max_segments=3, batch_size=1
+    )
+    for timestamp in range(1000):
+        metrics_log.append(timestamp, "temp", timestamp % 50)
+        metrics_log.flush(force=False)
+    metrics_log.close()
+
+    segments = list_segments(str(tmp_path))
+    assert len(segments) == 3
+    for path in segments:
+        assert os.path.getsize(path) <= segment_size
+    records = read_log(str(tmp_path))
+    assert records[-1] == (999, "temp", 49)
+    assert [record[0] for record in records] == list(range(1000 - len(records), 1000))
+
+    # Restart continues with a new segment.
+    metrics_log = MetricsLog(str(tmp_path), ["temp"], max_segments=3)
+    metrics_log.append(1000, "temp", 0)
+    metrics_log.close()
+    assert list_segments(str(tmp_path)) == segments[1:] + [
+        str(tmp_path / f"{int(os.path.basename(segments[-1])[:10]) + 1:010d}.seg")
+    ]
+
+
+def test_range_scan(tmp_path):
+    """
+    Only the records within the range should be read.
+    """
+    metrics_log = MetricsLog(
+        str(tmp_path), ["temp", "co2"], segment_size=512, batch_size=1
+    )
+    for timestamp in range(100):
+        metrics_log.append(timestamp, "temp" if timestamp % 2 else "co2", timestamp)
+        metrics_log.flush(force=False)
+    metrics_log.close()
+    assert len(list_segments(str(tmp_path))) > 3
+
+    records = read_log(str(tmp_path), start=10, end=20)
+    assert [record[0] for record in records] == list(range(10, 20))
+    records = read_log(str(tmp_path), start=95)
+    assert [record[0] for record in records] == list(range(95, 100))
+    records = read_log(str(tmp_path), end=3, names={"co2"})
+    assert records == [(0, "co2", 0), (2, "co2", 2)]
+    assert not read_log(str(tmp_path), start=100)
+    assert not read_log(str(tmp_path / "missing"))
+
+
+def test_iter_log(tmp_path):
+    """
+    The records should be decoded lazily and the iteration may stop early.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"], segment_size=512, batch_size=1)
+    for timestamp in range(100):
+        metrics_log.append(timestamp, "temp", timestamp)
+        metrics_log.flush(force=False)
+    metrics_log.close()
+
+    records = iter_log(str(tmp_path), start=10)
+    assert next(records) == (10, "temp", 10)
+    assert next(records) == (11, "temp", 11)
+    records.close()
+    assert list(iter_log(str(tmp_path), start=10)) == read_log(str(tmp_path), start=10)
+
+
+def test_timestamps_increasing(tmp_path):
+    """
+    Timestamps slightly older than the previous one should be replaced by it.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1000.0, "temp", 1)
+    metrics_log.append(990.0, "temp", 2)
+    metrics_log.close()
+
+    assert read_log(str(tmp_path)) == [(1000.0, "temp", 1), (1000.0, "temp", 2)]
+
+
+def test_timestamps_increasing_after_restart(tmp_path):
+    """
+    Timestamps slightly older than the last one logged before the restart
+    should be replaced by it.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1000.0, "temp", 1)
+    metrics_log.close()
+    (tmp_path / "0000000001.seg").write_bytes(b"garbage" * 10)
+
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(990.0, "temp", 2)
+    metrics_log.append(1100.0, "temp", 3)
+    metrics_log.close()
+
+    assert read_log(str(tmp_path)) == [
+        (1000.0, "temp", 1),
+        (1000.0, "temp", 2),
+        (1100.0, "temp", 3),
+    ]
+
+
+def test_clock_reset(tmp_path):
+    """
+    When the clock goes backwards by more than the tolerance, the records
+    should not be stamped with the future time but written to a new segment,
+    both while running and after restart.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"], clock_tolerance=60)
+    metrics_log.append(5000.0, "temp", 1)
+    metrics_log.close()
+
+    metrics_log = MetricsLog(str(tmp_path), ["temp"], clock_tolerance=60)
+    metrics_log.append(1000.0, "temp", 2)
+    metrics_log.append(1001.0, "temp", 3)
+    metrics_log.append(1000.0, "temp", 4)
+    metrics_log.flush()
+    metrics_log.append(900.0, "temp", 5)
+    metrics_log.append(950.0, "temp", 6)
+    metrics_log.append(100.0, "temp", 7)
+    metrics_log.close()
+
+    assert len(list_segments(str(tmp_path))) == 4
+    assert read_log(str(tmp_path)) == [
+        (5000.0, "temp", 1),
+        (1000.0, "temp", 2),
+        (1001.0, "temp", 3),
+        (1001.0, "temp", 4),
+        (900.0, "temp", 5),
+        (950.0, "temp", 6),
+        (100.0, "temp", 7),
+    ]
+    # Each segment is searched separately.
+    assert read_log(str(tmp_path), start=950, end=1001) == [
+        (1000.0, "temp", 2),
+        (950.0, "temp", 6),
+    ]
+
+
+def test_damaged_segments(tmp_path):
+    """
+    Partially written record should be skipped and invalid segments ignored.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1000.0, "temp", 1.5)
+    metrics_log.close()
+    path = list_segments(str(tmp_path))[0]
+    with open(path, "ab") as segment_file:
+        segment_file.write(bytes(RECORD.size // 2))
+    (tmp_path / "0000000098.seg").write_bytes(b"")
+    (tmp_path / "0000000099.seg").write_bytes(b"garbage" * 10)
+
+    assert read_log(str(tmp_path)) == [(1000.0, "temp", 1.5)]
+
+
+def test_foreign_files(tmp_path):
+    """
+    Files not named as segments should be ignored.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1000.0, "temp", 1.5)
+    metrics_log.close()
+    (tmp_path / "backup.seg").write_bytes((tmp_path / "0000000000.seg").read_bytes())
+    (tmp_path / "0000000001.seg.tmp").write_bytes(b"")
+
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1001.0, "temp", 2.5)
+    metrics_log.close()
+
+    assert list_segments(str(tmp_path)) == [
+        str(tmp_path / "0000000000.seg"),
+        str(tmp_path / "0000000001.seg"),
+    ]
+    assert read_log(str(tmp_path)) == [(1000.0, "temp", 1.5), (1001.0, "temp", 2.5)]
+
+
+def test_write_failure(tmp_path):
+    """
+    Failure to write the log should not be fatal.
+    """
+    metrics_log = MetricsLog(str(tmp_path / "log"), ["temp"])
+    os.rmdir(tmp_path / "log")
+    metrics_log.append(1000.0, "temp", 1.5)
+    metrics_log.close()
+
+    assert not read_log(str(tmp_path / "log"))
+
+
+@pytest.mark.parametrize("value", [0.0, -40.25, 1013.5])
+def test_value_precision(tmp_path, value):
+    """
+    The values should be stored in single precision.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1700000000.123, "temp", value)
+    metrics_log.close()
+
+    assert read_log(str(tmp_path)) == [(1700000000.123, "temp", value)]
+
+
+def test_value_out_of_range(tmp_path):
+    """
+    Values out of the single precision range should be skipped.
+    """
+    metrics_log = MetricsLog(str(tmp_path), ["temp"])
+    metrics_log.append(1000.0, "temp", 1e39)
+    metrics_log.append(1001.0, "temp", -1e39)
+    metrics_log.append(1002.0, "temp", 3e38)
+    metrics_log.close()
+
+    assert read_log(str(tmp_path)) == [(1002.0, "temp", pytest.approx(3e38))]
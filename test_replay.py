@@ -0,0 +1,110 @@
+"""
+Test the MQTT replay harness.
+"""
+
+import json
+import time
+
+import pytest
+
+from local_broker import LocalBroker
+from replay import (
+    SENT_RE,
+    Recorder,
+    add_sent_time,
+    get_synthetic_registry,
+    recorded_messages,
+    replay,
+    synthetic_messages,
+)
+
+
+@pytest.mark.parametrize(
+    "payload, expected",
+    [
+        ('{"a": 1}', '{"_sent": 1.5, "a": 1}'),
+        ("{}", '{"_sent": 1.5}'),
+        ('{"a": ', '{"_sent": 1.5, "a": '),
+        ("[1]", "[1]"),
+    ],
+)
+def test_add_sent_time(payload, expected):
+    """
+    The sent time should be the first field, even in malformed payloads.
+    """
+    assert add_sent_time(payload, 1.5) == expected
+    if payload.startswith("{"):
+        assert SENT_RE.search(expected).group(1) == "1.5"
+
+
+def test_synthetic_messages():
+    """
+    The stream should have the requested rate, bursts and defects.
+    """
+    messages = list(synthetic_messages(100, 2, burst_size=10))
+    assert len(messages) == 200
+    offsets = [offset for offset, _, _ in messages]
+    assert offsets == sorted(offsets)
+    assert len(set(offsets)) == 20
+    for _, _, payload in messages:
+        assert "timestamp" in json.loads(payload)
+
+    messages = list(synthetic_messages(100, 1, malformed_ratio=1))
+    for _, _, payload in messages:
+        with pytest.raises(ValueError):
+            json.loads(payload)
+
+    messages = list(synthetic_messages(100, 1, out_of_order_ratio=0.5))
+    timestamps = [json.loads(payload)["timestamp"] for _, _, payload in messages]
+    assert timestamps != sorted(timestamps)
+
+
+def test_replay():
+    """
+    The messages should be delivered despite the disconnects and malformed payloads,
+    with the statistics reported periodically.
+    """
+    source = (
+        "synthetic",
+        {"rate": 200, "duration": 2, "burst_size": 5, "malformed_ratio": 0.1},
+    )
+    reports = []
+
+    result = replay(
+        source,
+        get_synthetic_registry(),
+        disconnect_interval=1,
+        report_interval=0.5,
+        report=reports.append,
+    )
+
+    assert reports
+    assert 0 < result["messages"] <= 400
+    assert result["decoded"] > 0
+    assert result["latency"]["count"] > 0
+    assert 0 < result["latency"]["median"] <= result["latency"]["max"]
+    assert result["cpu_seconds"] > 0
+
+
+def test_record_and_replay(tmp_path):
+    """
+    The recorded messages should be replayable.
+    """
+    path = tmp_path / "messages.jsonl"
+    registry = get_synthetic_registry()
+    with LocalBroker() as broker:
+        recorder = Recorder("127.0.0.1", broker.port, registry, str(path))
+        for _, topic, payload in synthetic_messages(100, 0.2):
+            broker.publish(topic, payload)
+        deadline = time.monotonic() + 5
+        while recorder.updates < 20 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        recorder.stop()
+        recorder.mqtt.disconnect()
+
+    messages = list(recorded_messages(str(path)))
+    assert len(messages) == 20
+    assert messages[0][1] in registry.topics
+
+    result = replay(("recorded", str(path)), registry, speed=10)
+    assert result["messages"] == 20
@@ -0,0 +1,87 @@
+"""
+Test the redraw scheduler.
+"""
+
+import pytest
+
+from scheduler import RedrawScheduler
+
+
+def test_first_redraw():
+    """
+    The display should be redrawn right away at the start.
+    """
+    scheduler = RedrawScheduler(180, 900, (1, 100, 2))
+    assert scheduler.should_redraw((20, 800, 1000), 5)
+    assert scheduler.next_deadline(5) == 5
+
+
+@pytest.mark.parametrize(
+    "values,redraw",
+    [
+        ((20.5, 850, 1001), False),
+        ((21, 800, 1000), True),
+        ((20, 900, 1000), True),
+        ((20, 800, 998), True),
+        ((None, 800, 1000), True),
+    ],
+)
+def test_significant_change(values, redraw):
+    """
+    Only significant change should trigger redraw, however only after the minimum interval.
+    :param values: new values
+    :param redraw: whether the display should be redrawn
+    """
+    scheduler = RedrawScheduler(180, 900, (1, 100, 2))
+    scheduler.redrawn((20, 800, 1000), 1000)
+
+    assert not scheduler.should_redraw(values, 1000 + 179)
+    assert scheduler.should_redraw(values, 1000 + 181) == redraw
+    assert scheduler.should_redraw(values, 1000 + 900)
+
+
+@pytest.mark.parametrize(
+    "old,new,redraw",
+    [
+        ("ok", "ok", False),
+        ("ok", "error", True),
+        ("ok", 20, True),
+        (20, "ok", True),
+        (None, None, False),
+        ("1013.1", "1013.2", False),
+        ("1013.1", "1015", True),
+        ("20", 20.5, False),
+    ],
+)
+def test_non_numeric_change(old, new, redraw):
+    """
+    Numeric strings should be compared against the threshold,
+    other values that are not numbers for equality.
+    :param old: displayed value
+    :param new: new value
+    :param redraw: whether the display should be redrawn
+    """
+    scheduler = RedrawScheduler(0, 900, (1,))
+    scheduler.redrawn((old,), 1000)
+
+    assert scheduler.should_redraw((new,), 1001) == redraw
+
+
+def test_next_deadline():
+    """
+    Before the minimum interval elapses, nothing can trigger redraw.
+    Afterwards, the maximum interval is the deadline.
+    """
+    scheduler = RedrawScheduler(180, 900, (1, 100, 2))
+    scheduler.redrawn((20, 800, 1000), 1000)
+
+    assert scheduler.next_deadline(1010) == 1180
+    assert 1180 <= scheduler.next_deadline(1200) <= 1900
+
+
+def test_invalid_intervals():
+    """
+    minimum interval bigger than the maximum interval should raise ValueError
+    """
+    with pytest.raises(ValueError):
+        RedrawScheduler(900, 180, (1, 100, 2))
@@ -0,0 +1,59 @@
+"""
+Test that the modules not needed at startup are imported lazily.
+"""
+
+from benchmark_startup import (
+    LAZY_MODULES,
+    compare,
+    get_loaded_modules,
+    parse_importtime,
+)
+from metrics import TLS_PORT, get_ssl_context
+
+
+def test_lazy_imports():
+    """
+    Importing the report module should not load the hardware and asyncio modules.
+    """
+    loaded = get_loaded_modules("report")
+
+    assert "report" in loaded
+    for name in LAZY_MODULES:
+        assert name not in loaded
+
+
+def test_parse_importtime():
+    """
+    The header should be skipped and the times converted to seconds.
+    """
+    output = "\n".join(
+        [
+            "import time: self [us] | cumulative | imported package",
+            "import time:       120 |        120 |   fileutil",
+            "import time:      1500 |       2000 | report",
+            "unrelated line",
+        ]
+    )
+
+    assert parse_importtime(output) == {
+        "fileutil": (0.00012, 0.00012),
+        "report": (0.0015, 0.002),
+    }
+
+
+def test_compare():
+    """
+    Only the times slower than the tolerance allows should be reported.
+    """
+    baseline = {"results": {"import_report": 0.1, "first_pixel": 0.2}}
+    results = {"results": {"import_report": 0.11, "first_pixel": 0.3}}
+
+    assert compare(results, baseline, 0.2) == [("first_pixel", 0.2, 0.3)]
+
+
+def test_ssl_context():
+    """
+    The SSL context should be created once and only for the TLS port.
+    """
+    assert TLS_PORT == 8883
+    assert get_ssl_context() is get_ssl_context()
@@ -0,0 +1,80 @@
+"""
+Test the TextCache class.
+"""
+
+from PIL import Image
+
+from text_cache import TextCache
+
+
+def test_lru_eviction():
+    """
+    The least recently used entries should be evicted.
+    """
+    cache = TextCache(2)
+    assert cache.get("a", lambda: 1) == 1
+    assert cache.get("b", lambda: 2) == 2
+    assert cache.get("a", lambda: None) == 1
+    assert cache.get("c", lambda: 3) == 3
+    assert list(cache.entries) == ["a", "c"]
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_disabled():
+    """
+    With zero size nothing should be cached.
+    """
+    cache = TextCache(0)
+    assert cache.get("a", lambda: 1) == 1
+    assert len(cache) == 0
+
+
+def test_persistence(tmp_path):
+    """
+    The entries should survive save and load, as long as the signature matches.
+    """
+    path = tmp_path / "cache.json"
+    mask = Image.linear_gradient("L").resize((10, 20))
+    cache = TextCache(10, path=path, signature={"mode": "1"})
+    cache.get(("render", ("font.ttf", 12), "21°C", 0.5), lambda: (mask, (1, -2)))
+    cache.get(("length", ("font.ttf", 12), "CO₂ : "), lambda: 42.25)
+    cache.save()
+    assert not cache.dirty
+
+    cache = TextCache(10, path=path, signature={"mode": "1"})
+    loaded_mask, offset = cache.get(
+        ("render", ("font.ttf", 12), "21°C", 0.5), lambda: None
+    )
+    assert loaded_mask.tobytes() == mask.tobytes()
+    assert offset == (1, -2)
+    assert cache.get(("length", ("font.ttf", 12), "CO₂ : "), lambda: None) == 42.25
+    assert cache.misses == 0
+
+    assert len(TextCache(10, path=path, signature={"mode": "L"})) == 0
+    assert len(TextCache(1, path=path, signature={"mode": "1"})) == 1
+
+
+def test_corrupted_file(tmp_path):
+    """
+    Corrupted file should be ignored.
+    """
+    path = tmp_path / "cache.json"
+    path.write_text("{", encoding="utf-8")
+    cache = TextCache(10, path=path)
+    assert len(cache) == 0
+
+
+def test_save_interval(tmp_path):
+    """
+    Save that is not forced should write the file only once the interval elapses.
+    """
+    path = tmp_path / "cache.json"
+    cache = TextCache(10, path=path, save_interval=60)
+    cache.get("a", lambda: 1)
+    cache.save(force=False)
+    assert not path.exists()
+
+    cache.saved -= 60
+    cache.save(force=False)
+    assert path.exists()
+    assert not cache.dirty
@@ -0,0 +1,170 @@
+"""
+Bounded LRU cache of text renderings and measurements that can be persisted
+to a file, so that the text seen before can be drawn right after start
+without loading the fonts.
+"""
+
+import base64
+import json
+import logging
+import time
+import zlib
+from collections import OrderedDict
+
+import PIL
+from PIL import Image
+
+from fileutil import write_atomically
+
+# Version of the file format, bump on incompatible changes.
+FORMAT_VERSION = 1
+
+
+def encode(value):
+    """
+    :param value: value to encode (number, string, None, PIL image or tuple of these)
+    :return: JSON serializable representation of the value
+    """
+    if isinstance(value, Image.Image):
+        data = base64.b64encode(zlib.compress(value.tobytes())).decode("ascii")
+        return {"image": [value.mode, value.width, value.height, data]}
+    if isinstance(value, tuple):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value):
+    """
+    :param value: value produced by encode(), after JSON round trip
+    :return: the original value
+    """
+    if isinstance(value, dict):
+        mode, width, height, data = value["image"]
+        return Image.frombytes(
+            mode, (width, height), zlib.decompress(base64.b64decode(data))
+        )
+    if isinstance(value, list):
+        return tuple(decode(item) for item in value)
+    return value
+
+
+# pylint: disable=too-many-instance-attributes
+class TextCache:
+    """
+    Mapping with bounded number of entries, evicting the least recently used ones.
+    The keys and values should be numbers, strings, None, PIL images and tuples
+    of these so that they can be persisted.
+    """
+
+    def __init__(self, maxsize, path=None, signature=None, save_interval=600):
+        """
+        :param maxsize: maximum number of entries, 0 disables the caching
+        :param path: path to the file to persist the entries to, or None
+        :param signature: JSON serializable value describing what the entries
+        depend on (e.g. fonts and image mode). Persisted entries with different
+        signature are discarded.
+        :param save_interval: minimum time in seconds between the saves
+        that are not forced, to limit the writes to the SD card
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.maxsize = maxsize
+        self.path = path
+        self.signature = json.loads(json.dumps(signature))
+        self.save_interval = save_interval
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Whether there are entries not persisted yet.
+        self.dirty = False
+        self.saved = time.monotonic()
+
+        if self.path:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, compute):
+        """
+        :param key: cache key
+        :param compute: function to compute the value if not cached
+        :return: the cached or computed value
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            if self.maxsize > 0:
+                self.entries[key] = value
+                self.dirty = True
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return value
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def header(self):
+        """
+        :return: header of the file, entries are valid only with matching header
+        """
+        return {
+            "version": FORMAT_VERSION,
+            "pillow": PIL.__version__,
+            "signature": self.signature,
+        }
+
+    def load(self):
+        """
+        Load the entries from the file, if valid.
+        """
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                content = json.load(cache_file)
+            if content["header"] != self.header():
+                self.logger.info(f"Discarding outdated text cache {self.path}")
+                return
+            entries = [
+                (decode(key), decode(value)) for key, value in content["entries"]
+            ]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+            self.logger.warning(f"Cannot load text cache {self.path}: {e}")
+            return
+
+        if self.maxsize > 0:
+            first = max(len(entries) - self.maxsize, 0)
+            self.entries.update(entries[first:])
+        self.logger.debug(f"Loaded {len(self.entries)} entries from {self.path}")
+
+    def save(self, force=True):
+        """
+        Persist the entries to the file, if there are any new ones.
+        The file is replaced atomically.
+        :param force: if False, save only if the save interval elapsed
+        since the previous save
+        """
+        if not self.path or not self.dirty:
+            return
+        if not force and time.monotonic() - self.saved < self.save_interval:
+            return
+
+        content = {
+            "header": self.header(),
+            "entries": [
+                [encode(key), encode(value)] for key, value in self.entries.items()
+            ],
+        }
+        try:
+            write_atomically(self.path, json.dumps(content))
+        except OSError as e:
+            self.logger.warning(f"Cannot save text cache {self.path}: {e}")
+            return
+
+        self.dirty = False
+        self.saved = time.monotonic()